@@ -0,0 +1,225 @@
+import re
+import time
+import random
+import asyncio
+import logging
+
+from request_builder import RequestStats
+from instrumentation import record_llm_call
+
+# Azure puts the wait in the Retry-After header and/or the message text
+RETRY_AFTER_RE = re.compile(r'retry after (\d+) seconds', re.IGNORECASE)
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after, message="Rate limit error"):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class NonRetryableError(Exception):
+    # 4xx responses other than 429 (e.g. context_length_exceeded) fail the same way every time
+    pass
+
+
+class TokenBucket:
+    # Continuous-refill bucket sized in units per minute (requests or tokens)
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self._refill()
+        # Requests larger than the bucket are allowed once it is full
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    # Shared requests-per-minute and tokens-per-minute budget for every in-flight call.
+    # A 429 pauses all callers until the server's Retry-After has passed.
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        async with self.lock:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                wait = max(pause, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    return
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated, actual):
+        # Give back over-estimated tokens once the real usage is known
+        if actual is not None and actual < estimated:
+            self.tokens.refund(estimated - actual)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrency:
+    # AIMD limit on in-flight requests: grows by one after a window of successes,
+    # halves on every 429
+    def __init__(self, initial, minimum=1, maximum=64, window=10):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def on_success(self):
+        async with self.condition:
+            self.successes += 1
+            if self.successes >= self.window and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    async def on_throttle(self):
+        async with self.condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.successes = 0
+        logging.warning(f"Throttled: concurrency reduced to {self.limit}")
+
+
+def parse_retry_after(headers, text, default=60):
+    for header in ('retry-after-ms', 'Retry-After-Ms'):
+        if header in headers:
+            return float(headers[header]) / 1000
+    for header in ('retry-after', 'Retry-After'):
+        if header in headers:
+            try:
+                return float(headers[header])
+            except ValueError:
+                pass
+    match = RETRY_AFTER_RE.search(text or '')
+    if match:
+        return int(match.group(1))
+    return default
+
+
+def estimate_tokens(messages, max_tokens):
+    # Azure charges max_tokens against the TPM quota up front; ~4 characters per token
+    chars = sum(len(m.get('content') or '') for m in messages)
+    return chars // 4 + max_tokens
+
+
+class AsyncChatClient:
+    # Pooled aiohttp session in front of an Azure chat-completions deployment
+    def __init__(self, url, api_key, limiter, concurrency, max_retries=5, timeout=120, component='generation'):
+        import aiohttp
+
+        self.url = url
+        self.headers = {"Content-Type": "application/json", "api-key": api_key}
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.component = component
+        connector = aiohttp.TCPConnector(limit=concurrency.maximum, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+        self.stats = {"requests": 0, "throttled": 0, "errors": 0}
+        # Token usage (including cached prompt tokens) and latency of successful calls
+        self.usage = RequestStats()
+
+    async def close(self):
+        await self.session.close()
+
+    async def complete(self, messages, max_tokens=4096, operation='request'):
+        payload = {"messages": messages, "max_tokens": max_tokens}
+        estimated = estimate_tokens(messages, max_tokens)
+        # Time spent waiting on the rate limiter and the concurrency limit, over all attempts
+        queue_wait = 0.0
+        started = time.monotonic()
+
+        for attempt in range(1, self.max_retries + 1):
+            waiting = time.monotonic()
+            await self.limiter.acquire(estimated)
+            try:
+                async with self.concurrency:
+                    queue_wait += time.monotonic() - waiting
+                    self.stats["requests"] += 1
+                    sent = time.monotonic()
+                    async with self.session.post(self.url, headers=self.headers, json=payload) as response:
+                        text = await response.text()
+                        if response.status == 200:
+                            data = await response.json(content_type=None)
+                            self.limiter.settle(estimated, data.get('usage', {}).get('total_tokens'))
+                            self.usage.record(time.monotonic() - sent, data)
+                            await self.concurrency.on_success()
+                            record_llm_call(self.component, operation, 'ok', time.monotonic() - started, queue_wait,
+                                            attempt - 1, data)
+                            return data
+                        if response.status == 429:
+                            raise RateLimitError(parse_retry_after(response.headers, text))
+                        if 400 <= response.status < 500:
+                            raise NonRetryableError(f"Request failed: {response.status} - {text}")
+                        raise Exception(f"Request failed: {response.status} - {text}")
+            except RateLimitError as e:
+                self.stats["throttled"] += 1
+                logging.warning(f"Rate limit hit: pausing all requests for {e.retry_after} seconds.")
+                self.limiter.pause(e.retry_after)
+                await self.concurrency.on_throttle()
+            except Exception as e:
+                self.stats["errors"] += 1
+                if attempt == self.max_retries or isinstance(e, NonRetryableError):
+                    record_llm_call(self.component, operation, 'error', time.monotonic() - started, queue_wait,
+                                    attempt - 1, error=e)
+                    raise
+                backoff = min(120, 5 * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                logging.warning(f"API call failed: {str(e)}. Retrying in {backoff:.1f} seconds...")
+                await asyncio.sleep(backoff)
+
+        record_llm_call(self.component, operation, 'throttled', time.monotonic() - started, queue_wait,
+                        self.max_retries - 1)
+        raise RateLimitError(0, f"Still rate limited after {self.max_retries} attempts")
+
+
+async def run_bounded(items, handler, max_pending):
+    # Feed items to handler as tasks, keeping at most max_pending outstanding
+    pending = set()
+    results = []
+    for item in items:
+        if len(pending) >= max_pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            results += [task.result() for task in done]
+        pending.add(asyncio.ensure_future(handler(item)))
+    if pending:
+        done, _ = await asyncio.wait(pending)
+        results += [task.result() for task in done]
+    return results
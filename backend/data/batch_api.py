@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import uuid
+import logging
+import requests
+
+# Azure global-batch limits per input file
+MAX_REQUESTS_PER_FILE = 100000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def make_custom_id(subreddit, row_id):
+    return f"{subreddit}:{row_id}"
+
+
+def split_custom_id(custom_id):
+    subreddit, _, row_id = custom_id.partition(':')
+    return subreddit, row_id
+
+
+def write_batch_files(requests_iter, batch_dir, deployment, max_tokens=4096,
+                      max_requests=MAX_REQUESTS_PER_FILE, max_bytes=MAX_BYTES_PER_FILE):
+    # requests_iter yields (custom_id, messages); rolls over to a new JSONL file at either limit
+    os.makedirs(batch_dir, exist_ok=True)
+    paths = []
+    file = None
+    count = size = 0
+
+    for custom_id, messages in requests_iter:
+        line = json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {"model": deployment, "messages": messages, "max_tokens": max_tokens}
+        }, default=str) + "\n"
+        encoded = len(line.encode('utf-8'))
+        if file is None or count >= max_requests or size + encoded > max_bytes:
+            if file is not None:
+                file.close()
+            paths.append(os.path.join(batch_dir, f"batch-{len(paths):04d}.jsonl"))
+            file = open(paths[-1], 'w', encoding='utf-8')
+            count = size = 0
+        file.write(line)
+        count += 1
+        size += encoded
+
+    if file is not None:
+        file.close()
+    return paths
+
+
+class AzureBatchService:
+    # Thin wrapper over the Azure OpenAI files and batches endpoints
+    def __init__(self, endpoint, api_key, api_version):
+        self.endpoint = endpoint.rstrip('/')
+        self.api_version = api_version
+        self.session = requests.Session()
+        self.session.headers.update({"api-key": api_key})
+
+    def _url(self, path):
+        return f"{self.endpoint}/openai/{path}?api-version={self.api_version}"
+
+    def _check(self, response):
+        if response.status_code >= 400:
+            raise Exception(f"Request failed: {response.status_code} - {response.text}")
+        return response
+
+    def upload_file(self, path):
+        with open(path, 'rb') as file:
+            response = self.session.post(self._url("files"), data={"purpose": "batch"},
+                                         files={"file": (os.path.basename(path), file)})
+        return self._check(response).json()['id']
+
+    def create_batch(self, input_file_id):
+        response = self.session.post(self._url("batches"), json={
+            "input_file_id": input_file_id,
+            "endpoint": "/chat/completions",
+            "completion_window": "24h"
+        })
+        return self._check(response).json()['id']
+
+    def get_batch(self, batch_id):
+        return self._check(self.session.get(self._url(f"batches/{batch_id}"))).json()
+
+    def download_file(self, file_id):
+        return self._check(self.session.get(self._url(f"files/{file_id}/content"))).text
+
+
+class LocalBatchService:
+    # In-process stand-in with the same surface; responder(custom_id, body) returns a
+    # chat-completions response dict or raises to simulate a per-request failure
+    def __init__(self, responder):
+        self.responder = responder
+        self.files = {}
+        self.batches = {}
+
+    def upload_file(self, path):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(path, 'r', encoding='utf-8') as file:
+            self.files[file_id] = file.read()
+        return file_id
+
+    def create_batch(self, input_file_id):
+        output_lines, error_lines = [], []
+        for line in self.files[input_file_id].splitlines():
+            request = json.loads(line)
+            try:
+                body = self.responder(request['custom_id'], request['body'])
+                output_lines.append(json.dumps({
+                    "custom_id": request['custom_id'],
+                    "response": {"status_code": 200, "body": body},
+                    "error": None
+                }))
+            except Exception as e:
+                error_lines.append(json.dumps({
+                    "custom_id": request['custom_id'],
+                    "response": None,
+                    "error": {"message": str(e)}
+                }))
+
+        batch_id = f"batch-{uuid.uuid4().hex}"
+        output_file_id = f"file-{uuid.uuid4().hex}"
+        error_file_id = f"file-{uuid.uuid4().hex}"
+        self.files[output_file_id] = "\n".join(output_lines)
+        self.files[error_file_id] = "\n".join(error_lines)
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "status": "completed",
+            "output_file_id": output_file_id,
+            "error_file_id": error_file_id if error_lines else None
+        }
+        return batch_id
+
+    def get_batch(self, batch_id):
+        return self.batches[batch_id]
+
+    def download_file(self, file_id):
+        return self.files[file_id]
+
+
+def submit_batches(service, paths):
+    # Uploads and submits every file up front so the batches run concurrently on the
+    # service side; returns {batch id: path}
+    submitted = {}
+    for path in paths:
+        batch_id = service.create_batch(service.upload_file(path))
+        logging.info(f"Submitted {os.path.basename(path)} as batch {batch_id}")
+        submitted[batch_id] = path
+    return submitted
+
+
+def read_results(service, batch):
+    # (output lines, error lines) of a finished batch
+    output_lines, error_lines = [], []
+    if batch.get('output_file_id'):
+        output_lines = [json.loads(l) for l in service.download_file(batch['output_file_id']).splitlines() if l.strip()]
+    if batch.get('error_file_id'):
+        error_lines = [json.loads(l) for l in service.download_file(batch['error_file_id']).splitlines() if l.strip()]
+    return output_lines, error_lines
+
+
+def wait_for_batches(service, batch_ids, poll_interval=60, timeout=26 * 3600):
+    # Polls all outstanding batches together and yields (batch, output lines, error lines)
+    # as each reaches a terminal status, so N files take about as long as the slowest one
+    deadline = time.time() + timeout
+    pending = list(batch_ids)
+    while pending:
+        for batch_id in list(pending):
+            batch = service.get_batch(batch_id)
+            if batch['status'] in TERMINAL_STATUSES:
+                logging.info(f"Batch {batch_id} finished with status {batch['status']}")
+                pending.remove(batch_id)
+                yield (batch, *read_results(service, batch))
+        if pending:
+            if time.time() > deadline:
+                raise TimeoutError(f"Batches {', '.join(pending)} did not finish within {timeout} seconds")
+            time.sleep(poll_interval)
+
+
+def submit_and_wait(service, path, poll_interval=60, timeout=26 * 3600):
+    # Returns (batch, output lines, error lines) once the batch reaches a terminal status
+    submitted = submit_batches(service, [path])
+    return next(wait_for_batches(service, submitted, poll_interval, timeout))
@@ -0,0 +1,266 @@
+import os
+import csv
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import resource
+import tempfile
+import threading
+import tracemalloc
+
+from fake_llm import serve_in_thread, add_server_arguments, fake_from_args
+
+# End-to-end throughput benchmarks against the local fake LLM (fake_llm.py). The pipeline
+# modules read their settings from the environment at import time, so they are imported
+# only after configure_environment has pointed them at the fake server.
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TOPIC_SENTENCES = [
+    "My earnings dropped by a third since they changed the pay rates.",
+    "Income is so unstable now that I cannot plan my rent.",
+    "I read a report saying driver pay fell across the city last year.",
+    "Honestly I think the algorithm decides who gets the good trips.",
+    "Weekly earnings used to be predictable, not anymore.",
+]
+FILLER_WORDS = ("the app ride passenger airport traffic night shift rating tip surge city car insurance gas "
+                "weekend downtown friend account support message update map route customer").split()
+
+
+def synthetic_comment(rng, words=40):
+    text = ' '.join(rng.choice(FILLER_WORDS) for _ in range(words)).capitalize() + '.'
+    if rng.random() < 0.3:
+        text += ' ' + rng.choice(TOPIC_SENTENCES)
+    return text
+
+
+def write_corpus(directory, subreddit, rows, comments_per_row, seed=0):
+    # <directory>/<subreddit>_llm.csv in the layout combine_submissions_comments writes
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{subreddit}_llm.csv")
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(['id', 'title', 'selftext', 'body'])
+        for i in range(rows):
+            comments = [synthetic_comment(rng) for _ in range(rng.randint(1, comments_per_row * 2))]
+            writer.writerow([f"b{i:07d}", synthetic_comment(rng, 8), synthetic_comment(rng, 30), "\n\n".join(comments)])
+    return path
+
+
+def synthetic_quotes(count, seed=0):
+    rng = random.Random(seed)
+    return [synthetic_comment(rng, rng.randint(10, 40)) for _ in range(count)]
+
+
+def synthetic_catalog(size, seed=0):
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < size:
+        names.add("r/" + ''.join(w.capitalize() for w in rng.sample(FILLER_WORDS, 2)) + str(rng.randint(0, 999)))
+    return sorted(names)
+
+
+def configure_environment(url, workdir):
+    os.environ.update({
+        'AZURE_OPENAI_ENDPOINT': url,
+        'AZURE_OPENAI_API_KEY': 'fake-key',
+        'AZURE_OPENAI_API_VERSION': '2024-08-01-preview',
+        'DEPLOYMENT_NAME': 'fake',
+        'SYSTEM_PROMPT_PATH': os.environ.get('SYSTEM_PROMPT_PATH') or
+        os.path.join(BACKEND_DIR, 'prompts', 'prompt_generation_AI_work.txt'),
+        'RESPONSE_CACHE_PATH': os.path.join(workdir, 'responses.sqlite3'),
+        'SUBREDDIT_INDEX_DIR': os.path.join(workdir, 'subreddit_index'),
+    })
+    # The async engine's client-side quota would otherwise cap throughput at 60 RPM; use
+    # --rpm on the fake server to benchmark against a real limit
+    os.environ.setdefault('RATE_LIMIT_RPM', '1000000')
+    os.environ.setdefault('RATE_LIMIT_TPM', '1000000000')
+    if BACKEND_DIR not in sys.path:
+        sys.path.append(BACKEND_DIR)
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+
+def measure(name, fake, items, run, trace_memory=False):
+    # run() returns per-item latencies (or None); LLM-side latency and retries come from the
+    # fake server's counters for the same interval
+    fake.reset_stats()
+    peak = {'rss': rss_mb()}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.05):
+            peak['rss'] = max(peak['rss'], rss_mb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        item_latencies = run()
+    finally:
+        elapsed = time.perf_counter() - started
+        done.set()
+        sampler.join()
+    traced = tracemalloc.get_traced_memory()[1] / 2 ** 20 if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    stats, llm_latencies = fake.snapshot()
+    return {
+        "benchmark": name,
+        "items": items,
+        "seconds": round(elapsed, 3),
+        "items_per_sec": round(items / elapsed, 2) if elapsed else None,
+        "p50": percentile(item_latencies or llm_latencies, 0.5),
+        "p95": percentile(item_latencies or llm_latencies, 0.95),
+        "llm_requests": stats["requests"],
+        "llm_p50": percentile(llm_latencies, 0.5),
+        "llm_p95": percentile(llm_latencies, 0.95),
+        "retries": stats["throttled"] + stats["errors"],
+        "malformed": stats["malformed"],
+        "cached_token_share": round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0,
+        "peak_rss_mb": round(peak['rss'], 1),
+        "traced_peak_mb": round(traced, 1) if traced is not None else None,
+        "children_max_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def bench_process_file(fake, workdir, rows, comments, engine, trace_memory):
+    import generation
+    from output_store import get_sink
+    from run_manifest import RunManifest
+
+    input_dir = os.path.join(workdir, 'corpus')
+    path = write_corpus(input_dir, 'benchsub', rows, comments)
+    output_dir = os.path.join(workdir, f'out-{engine}')
+    shutil.rmtree(output_dir, ignore_errors=True)  # a warm manifest would skip every row
+    sink = get_sink('sqlite', output_dir)
+    manifest = RunManifest(os.path.join(output_dir, 'run_manifest.sqlite3'), generation.get_builder().version)
+
+    def run():
+        if engine == 'async':
+            asyncio.run(generation.process_file_async(path, sink, manifest))
+        else:
+            generation.process_file(path, sink, manifest)
+
+    try:
+        result = measure(f"process_file[{engine}]", fake, rows, run, trace_memory)
+    finally:
+        sink.close()
+        result_summary = manifest.summary()
+        manifest.close()
+    result["rows_by_status"] = result_summary
+    return result
+
+
+def bench_relevant_subreddits(fake, workdir, topics, catalog_size, trace_memory):
+    cwd = os.getcwd()
+    os.chdir(BACKEND_DIR)  # server.py loads data/subreddits.csv relative to backend/
+    try:
+        import server
+    finally:
+        os.chdir(cwd)
+
+    if catalog_size:
+        from subreddit_index import load_index
+
+        catalog = synthetic_catalog(catalog_size)
+        csv_path = os.path.join(workdir, 'subreddits.csv')
+        with open(csv_path, 'w', newline='') as file:
+            csv.writer(file).writerows([['name']] + [[name] for name in catalog])
+        server.subreddits = catalog
+        if server.subreddit_index is not None:
+            server.subreddit_index = load_index(csv_path, os.path.join(workdir, 'synthetic_index'))
+
+    queries = [f"{a} {b}" for a, b in zip(random.Random(1).choices(FILLER_WORDS, k=topics),
+                                          random.Random(2).choices(FILLER_WORDS, k=topics))]
+
+    def run():
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            server.get_relevant_subreddits(query)
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    result = measure(f"get_relevant_subreddits[{server.SUBREDDIT_SEARCH_MODE}]", fake, topics, run, trace_memory)
+    result["catalog_size"] = len(server.subreddits)
+    return result
+
+
+def bench_map_quotes(fake, quotes, trace_memory):
+    import subtopics
+
+    all_quotes = synthetic_quotes(quotes)
+    themes = ["Earnings concerns", "Income stability", "Pay rates", "Algorithm control", "Rent and costs"]
+    return measure(f"map_quotes_to_themes[{subtopics.CLASSIFY_MODE}]", fake, quotes,
+                   lambda: subtopics.map_quotes_to_themes(all_quotes, themes) and None, trace_memory)
+
+
+BENCHMARKS = ('process_file', 'get_relevant_subreddits', 'map_quotes_to_themes')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Throughput benchmarks against the local fake LLM")
+    parser.add_argument("--only", default=','.join(BENCHMARKS), help="Comma-separated subset of " + ', '.join(BENCHMARKS))
+    parser.add_argument("--rows", type=int, default=200, help="Synthetic submissions for process_file")
+    parser.add_argument("--comments", type=int, default=20, help="Average comments per submission")
+    parser.add_argument("--engine", choices=['async', 'pool'], default='async',
+                        help="process_file engine")
+    parser.add_argument("--topics", type=int, default=20, help="Queries for get_relevant_subreddits")
+    parser.add_argument("--catalog-size", type=int, default=0, help="Synthetic subreddit catalog size (0 = data/subreddits.csv)")
+    parser.add_argument("--quotes", type=int, default=1000, help="Quotes for map_quotes_to_themes")
+    parser.add_argument("--trace-memory", action="store_true", help="Also report the tracemalloc peak (slower)")
+    parser.add_argument("--workdir", help="Keep corpora and outputs here instead of a temporary directory")
+    parser.add_argument("--output", help="Append the results as JSON lines to this file")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    fake = fake_from_args(args)
+    url, stop = serve_in_thread(fake)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench-')
+    configure_environment(url, workdir)
+
+    selected = [name.strip() for name in args.only.split(',') if name.strip()]
+    results = []
+    try:
+        if 'process_file' in selected:
+            results.append(bench_process_file(fake, workdir, args.rows, args.comments, args.engine, args.trace_memory))
+        if 'get_relevant_subreddits' in selected:
+            results.append(bench_relevant_subreddits(fake, workdir, args.topics, args.catalog_size, args.trace_memory))
+        if 'map_quotes_to_themes' in selected:
+            results.append(bench_map_quotes(fake, args.quotes, args.trace_memory))
+    finally:
+        stop()
+
+    columns = ('benchmark', 'items', 'seconds', 'items_per_sec', 'p50', 'p95', 'llm_requests', 'retries', 'peak_rss_mb')
+    print(' '.join(f"{c:>14}" for c in columns), file=sys.stderr)
+    for result in results:
+        print(' '.join(f"{str(result[c]):>14}" for c in columns), file=sys.stderr)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'a') as file:
+            for result in results:
+                file.write(json.dumps(dict(result, config=vars(args))) + "\n")
@@ -1,11 +1,21 @@
 import os
 import json
 import csv
+import time
+import shutil
+import tempfile
 from collections import defaultdict
+from multiprocessing import Pool
 from tqdm import tqdm
+from prompt_packing import COMMENT_SEPARATOR
+from ndjson_ingest import (open_text, loads, iter_tasks, task_lines, partition_of, bounded_imap_unordered,
+                           SpillWriter, read_spill)
 
 import os
 
+# Separator of the original combined_data.csv layout written by process_subreddit
+LEGACY_COMMENT_SEPARATOR = ' '
+
 def process_subreddit(submissions_file, comments_file, output_folder):
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
@@ -22,7 +32,9 @@ def process_subreddit(submissions_file, comments_file, output_folder):
             'id': submission_id,
             'title': submission['title'],
             'selftext': submission['selftext'],
-            'body': ' '.join(comments.get(submission_id, []))
+            # Kept space-joined so existing combined_data.csv files and their row digests do
+            # not change; prompt windows fall back to sentence boundaries for these bodies
+            'body': LEGACY_COMMENT_SEPARATOR.join(comments.get(submission_id, []))
         }
 
     # Process comments without matching submissions
@@ -32,7 +44,7 @@ def process_subreddit(submissions_file, comments_file, output_folder):
                 'id': comment_id,
                 'title': '',
                 'selftext': '',
-                'body': ' '.join(comments[comment_id])
+                'body': LEGACY_COMMENT_SEPARATOR.join(comments[comment_id])
             }
 
     # Specify the output file path
@@ -53,7 +65,7 @@ def process_subreddit(submissions_file, comments_file, output_folder):
 
 def read_submissions(file_path):
     submissions = {}
-    with open(file_path, 'r', encoding='utf-8') as f:
+    with open_text(file_path) as f:
         for line in f:
             try:
                 data = json.loads(line)  # Parse each line as JSON
@@ -68,7 +80,7 @@ def read_submissions(file_path):
 
 def read_comments(file_path):
     comments = defaultdict(list)
-    with open(file_path, 'r', encoding='utf-8') as f:
+    with open_text(file_path) as f:
         for line in f:
             try:
                 data = json.loads(line)  # Parse each line as JSON
@@ -84,17 +96,306 @@ def is_valid_content(text):
         return False
     return len(text.split()) >= 5
 
-                
+
+def created_key(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def route_subreddit(data, routes):
+    # None means "keep everything"; otherwise only subreddits in the routing table are kept,
+    # mapped to their catalog spelling
+    if routes is None:
+        return ''
+    return routes.get(str(data.get('subreddit', '')).lower())
+
+def parse_submission_block(args):
+    # Worker: parse and filter one block of submission lines, grouped by join partition
+    task, partitions, routes = args
+    spilled = defaultdict(list)
+    errors = 0
+    for line in task_lines(task):
+        try:
+            data = loads(line)
+            submission_id = data['id']
+        except (ValueError, KeyError):
+            errors += 1
+            continue
+        subreddit = route_subreddit(data, routes)
+        if subreddit is None:
+            continue
+        selftext = data.get('selftext', '')
+        record = [submission_id, data.get('title', '') or '', selftext if is_valid_content(selftext) else '',
+                  created_key(data.get('created_utc')), subreddit]
+        spilled[partition_of(submission_id, partitions)].append(json.dumps(record) + "\n")
+    return spilled, errors
+
+def parse_comment_block(args):
+    # Worker: parse one block of comment lines, dropping invalid bodies before they are spilled
+    task, partitions, routes = args
+    spilled = defaultdict(list)
+    errors = 0
+    for line in task_lines(task):
+        try:
+            data = loads(line)
+            submission_id = data['link_id'][3:]  # Remove 't3_' prefix to get the ID
+        except (ValueError, KeyError, TypeError):
+            errors += 1
+            continue
+        subreddit = route_subreddit(data, routes)
+        if subreddit is not None and is_valid_content(data.get('body', '')):
+            record = [submission_id, data['body'], created_key(data.get('created_utc')), subreddit, data.get('id')]
+            spilled[partition_of(submission_id, partitions)].append(json.dumps(record) + "\n")
+    return spilled, errors
+
+def spill_file(pool, file_path, worker, writer, partitions, max_pending, routes=None):
+    errors = 0
+    tasks = ((task, partitions, routes) for task in iter_tasks(file_path))
+    for result in tqdm(bounded_imap_unordered(pool, worker, tasks, max_pending),
+                       desc=f"Parsing {os.path.basename(file_path)}", unit="block"):
+        if isinstance(result, Exception):
+            raise result
+        spilled, block_errors = result
+        for partition, lines in spilled.items():
+            writer.write(partition, lines)
+        errors += block_errors
+    if errors:
+        print(f"Skipped {errors} unreadable lines in {file_path}")
+
+def join_partition(args):
+    # Worker: join one hash partition of submissions and comments in memory. Rows go to
+    # output_path, or, when split is set, to output_path/<subreddit>.csv.
+    submissions_path, comments_path, output_path, split = args
+    submissions = {}
+    for submission_id, title, selftext, _, subreddit in read_spill(submissions_path):
+        submissions[submission_id] = (title, selftext, subreddit)
+
+    comments = defaultdict(list)
+    comment_subreddits = {}
+    for submission_id, body, created, subreddit, _ in read_spill(comments_path):
+        comments[submission_id].append((created, body))
+        comment_subreddits.setdefault(submission_id, subreddit)
+
+    if split:
+        os.makedirs(output_path, exist_ok=True)
+    files = {}
+    rows = defaultdict(int)
+    try:
+        ids = list(submissions) + [c for c in comments if c not in submissions]
+        for submission_id in ids:
+            title, selftext, subreddit = submissions.get(submission_id, ('', '', comment_subreddits.get(submission_id)))
+            # Comments are joined in creation order, as they appear in the dumps
+            body = COMMENT_SEPARATOR.join(b for _, b in sorted(comments.get(submission_id, []), key=lambda c: c[0]))
+            if not (is_valid_content(selftext) or is_valid_content(body)):
+                continue
+            key = subreddit if split else ''
+            if key not in files:
+                path = os.path.join(output_path, f"{key}.csv") if split else output_path
+                files[key] = open(path, 'w', newline='', encoding='utf-8')
+            csv.writer(files[key]).writerow([submission_id, title, selftext, body])
+            rows[key] += 1
+    finally:
+        for file in files.values():
+            file.close()
+    return dict(rows)
+
+def concatenate_parts(part_paths, output_file):
+    with open(output_file, 'w', newline='', encoding='utf-8') as out:
+        csv.writer(out).writerow(['id', 'title', 'selftext', 'body'])
+        for part_path in part_paths:
+            if not os.path.exists(part_path):
+                continue
+            with open(part_path, 'r', encoding='utf-8', newline='') as part:
+                shutil.copyfileobj(part, out)
+
+def spill_and_join(submissions_file, comments_file, spill_root, workers, partitions, routes=None):
+    # Shared by the parallel and split modes: parse + spill both inputs, then join every
+    # partition. Returns (joined part paths, rows per subreddit key).
+    with Pool(workers) as pool:
+        submission_writer = SpillWriter(spill_root, "submissions", partitions)
+        comment_writer = SpillWriter(spill_root, "comments", partitions)
+        try:
+            spill_file(pool, submissions_file, parse_submission_block, submission_writer, partitions,
+                       workers * 2, routes)
+            spill_file(pool, comments_file, parse_comment_block, comment_writer, partitions, workers * 2, routes)
+        finally:
+            submission_writer.close()
+            comment_writer.close()
+
+        split = routes is not None
+        part_paths = [os.path.join(spill_root, f"joined-{p:03d}" if split else f"joined-{p:03d}.csv")
+                      for p in range(partitions)]
+        jobs = ((s, c, o, split) for s, c, o in zip(submission_writer.paths, comment_writer.paths, part_paths))
+        rows = defaultdict(int)
+        for counts in tqdm(pool.imap_unordered(join_partition, jobs), total=partitions, desc="Joining partitions"):
+            for key, count in counts.items():
+                rows[key] += count
+    return part_paths, rows
+
+def process_subreddit_parallel(submissions_file, comments_file, output_folder, workers=None, partitions=64,
+                               spill_dir=None, output_name="combined_data.csv"):
+    # Parallel ingest: NDJSON is parsed and filtered across a process pool, both inputs are
+    # hash-partitioned on the submission ID into spill files, and each partition is joined
+    # on its own, so memory is bounded by the largest partition rather than the dump
+    os.makedirs(output_folder, exist_ok=True)
+    workers = workers or os.cpu_count()
+    spill_root = tempfile.mkdtemp(prefix="combine-", dir=spill_dir)
+    try:
+        part_paths, rows = spill_and_join(submissions_file, comments_file, spill_root, workers, partitions)
+        output_file = os.path.join(output_folder, output_name)
+        concatenate_parts(part_paths, output_file)
+        print(f"Wrote {sum(rows.values())} rows to {output_file}")
+        return output_file
+    finally:
+        shutil.rmtree(spill_root, ignore_errors=True)
+
+def load_subreddit_routes(subreddits_csv):
+    # {lowercase dump name: catalog name without the r/ prefix}
+    routes = {}
+    with open(subreddits_csv, 'r', encoding='utf-8', newline='') as f:
+        for record in csv.DictReader(f):
+            name = record['name'].strip()
+            name = name[2:] if name.lower().startswith('r/') else name
+            if name:
+                routes[name.lower()] = name
+    return routes
+
+def split_subreddits(submissions_file, comments_file, subreddits_csv, output_folder, workers=None, partitions=64,
+                     spill_dir=None, dedup_index=None):
+    # One streaming pass over full-site dumps: records are routed by their subreddit field,
+    # joined per partition and emitted as <subreddit>_llm.csv, the inputs generation.py expects.
+    # With dedup_index (a path), near-duplicate rows are then dropped across all outputs.
+    os.makedirs(output_folder, exist_ok=True)
+    workers = workers or os.cpu_count()
+    routes = load_subreddit_routes(subreddits_csv)
+    spill_root = tempfile.mkdtemp(prefix="split-", dir=spill_dir)
+    try:
+        part_paths, rows = spill_and_join(submissions_file, comments_file, spill_root, workers, partitions, routes)
+        outputs = {}
+        for subreddit in sorted(rows):
+            output_file = os.path.join(output_folder, f"{subreddit}_llm.csv")
+            concatenate_parts([os.path.join(part, f"{subreddit}.csv") for part in part_paths], output_file)
+            outputs[subreddit] = output_file
+        print(f"Wrote {sum(rows.values())} rows across {len(outputs)} of {len(routes)} subreddits to {output_folder}")
+        if dedup_index:
+            dedup_outputs(outputs, dedup_index)
+        return outputs
+    finally:
+        shutil.rmtree(spill_root, ignore_errors=True)
+
+def new_delta_dir(output_folder):
+    # <output_folder>/delta/<YYYYmmdd-HHMMSS>[-n]/, created empty
+    base = os.path.join(output_folder, 'delta', time.strftime('%Y%m%d-%H%M%S'))
+    run_dir, n = base, 1
+    while os.path.exists(run_dir):
+        run_dir, n = f"{base}-{n}", n + 1
+    os.makedirs(run_dir)
+    return run_dir
+
+def ingest_incremental(submissions_file, comments_file, subreddits_csv, output_folder, state_path, workers=None,
+                       dedup_index=None):
+    # Like split_subreddits, but against an ingest store holding everything from earlier
+    # dumps: records below a subreddit's high-water mark are dropped, and only threads that
+    # gained a submission or comments are written out, each with its full history, so
+    # generation.py re-extracts exactly those. Each run writes its delta to a fresh
+    # <output_folder>/delta/<run id>/ (with a delta.json listing the files) and never
+    # touches other files in output_folder. Returns (run directory, {subreddit: csv path}).
+    from ingest_state import IngestStore, StoreWriter
+
+    run_dir = new_delta_dir(output_folder)
+    workers = workers or os.cpu_count()
+    routes = load_subreddit_routes(subreddits_csv)
+    store = IngestStore(state_path)
+    try:
+        with Pool(workers) as pool:
+            spill_file(pool, submissions_file, parse_submission_block, StoreWriter(store.add_submission), 1,
+                       workers * 2, routes)
+            spill_file(pool, comments_file, parse_comment_block, StoreWriter(store.add_comment), 1,
+                       workers * 2, routes)
+
+        outputs = {}
+        for subreddit in store.touched_subreddits():
+            output_file = os.path.join(run_dir, f"{subreddit}_llm.csv")
+            rows = 0
+            with open(output_file, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['id', 'title', 'selftext', 'body'])
+                for submission_id, title, selftext, bodies in store.touched_threads(subreddit):
+                    body = COMMENT_SEPARATOR.join(bodies)
+                    if is_valid_content(selftext) or is_valid_content(body):
+                        writer.writerow([submission_id, title, selftext, body])
+                        rows += 1
+            outputs[subreddit] = output_file
+            print(f"{subreddit}: {rows} new or updated threads")
+        if dedup_index:
+            dedup_outputs(outputs, dedup_index)
+        with open(os.path.join(run_dir, 'delta.json'), 'w') as f:
+            json.dump({"created": time.time(), "state": state_path,
+                       "files": {subreddit: os.path.basename(path) for subreddit, path in outputs.items()}}, f, indent=2)
+        store.finish()
+        print(f"Wrote {len(outputs)} subreddit deltas to {run_dir}; run generation.py with --input-dir {run_dir}")
+        return run_dir, outputs
+    finally:
+        store.close()
+
+def dedup_outputs(outputs, index_path):
+    from near_dup import NearDupIndex, dedup_files
+
+    index = NearDupIndex(index_path)
+    try:
+        report = dedup_files(outputs, index)
+    finally:
+        index.close()
+    for subreddit, counts in report.items():
+        print(f"{subreddit}: dropped {counts['duplicates']} of {counts['rows']} rows as near-duplicates "
+              f"({counts['ratio']:.1%})")
+    return report
+
 import argparse
 
 def main():
     parser = argparse.ArgumentParser(description="Process subreddit data")
-    parser.add_argument("submissions_file", help="Path to the submissions file")
-    parser.add_argument("comments_file", help="Path to the comments file")
+    parser.add_argument("submissions_file", help="Path to the submissions file (.ndjson or .zst)")
+    parser.add_argument("comments_file", help="Path to the comments file (.ndjson or .zst)")
     parser.add_argument("output_folder", help="Path to the folder where output files will be saved")
+    parser.add_argument("--parallel", action="store_true",
+                        help="Parse across a process pool and join through on-disk hash partitions")
+    parser.add_argument("--split-by-subreddit", metavar="SUBREDDITS_CSV",
+                        help="Treat the inputs as full-site dumps and write one <subreddit>_llm.csv per "
+                             "subreddit listed in this CSV, in a single pass (implies --parallel)")
+    parser.add_argument("--incremental", nargs="?", const="", metavar="STATE_PATH",
+                        help="Split mode: ingest only what earlier runs have not seen, keeping history in "
+                             "STATE_PATH (default <output_folder>/ingest_state.sqlite3), and write only new or "
+                             "updated threads, to a new <output_folder>/delta/<run id>/ directory")
+    parser.add_argument("--dedup", nargs="?", const="", metavar="INDEX_PATH",
+                        help="Split mode: drop near-duplicate rows (cross-posts, reposts) across the outputs, "
+                             "keeping links in INDEX_PATH (default <output_folder>/near_dup.sqlite3)")
+    parser.add_argument("--workers", type=int, default=None, help="Parallel mode: number of worker processes")
+    parser.add_argument("--partitions", type=int, default=64, help="Parallel mode: number of join partitions")
+    parser.add_argument("--spill-dir", default=None, help="Parallel mode: where to put temporary spill files")
     args = parser.parse_args()
-    
-    process_subreddit(args.submissions_file, args.comments_file, args.output_folder)
+    if args.dedup is not None and not args.split_by_subreddit:
+        parser.error("--dedup needs --split-by-subreddit; run near_dup.py on *_llm.csv inputs otherwise")
+    if args.incremental is not None and not args.split_by_subreddit:
+        parser.error("--incremental needs --split-by-subreddit")
+
+    if args.split_by_subreddit:
+        dedup_index = None
+        if args.dedup is not None:
+            dedup_index = args.dedup or os.path.join(args.output_folder, 'near_dup.sqlite3')
+        if args.incremental is not None:
+            ingest_incremental(args.submissions_file, args.comments_file, args.split_by_subreddit, args.output_folder,
+                               args.incremental or os.path.join(args.output_folder, 'ingest_state.sqlite3'),
+                               args.workers, dedup_index)
+        else:
+            split_subreddits(args.submissions_file, args.comments_file, args.split_by_subreddit, args.output_folder,
+                             args.workers, args.partitions, args.spill_dir, dedup_index)
+    elif args.parallel:
+        process_subreddit_parallel(args.submissions_file, args.comments_file, args.output_folder,
+                                   args.workers, args.partitions, args.spill_dir)
+    else:
+        process_subreddit(args.submissions_file, args.comments_file, args.output_folder)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,76 @@
+import os
+import re
+import zlib
+import numpy as np
+
+# Splits "r/AskNYC_food" or "OutdoorSeating" into lowercase word tokens
+CAMEL_RE = re.compile(r'(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    text = CAMEL_RE.sub(' ', str(text or ''))
+    return TOKEN_RE.findall(text.lower())
+
+
+class HashingEmbedder:
+    # Deterministic, dependency-free embedder: word unigrams/bigrams and character
+    # trigrams are hashed into a fixed number of signed buckets, then L2-normalized.
+    def __init__(self, dim=512, char_ngram=3):
+        self.dim = dim
+        self.char_ngram = char_ngram
+        self.name = f"hashing-{dim}-{char_ngram}"
+
+    def _features(self, text):
+        words = tokenize(text)
+        features = list(words)
+        features += [f"{a}_{b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"#{word}#"
+            features += [padded[i:i + self.char_ngram] for i in range(len(padded) - self.char_ngram + 1)]
+        return features
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                sign = 1.0 if (h >> 31) & 1 else -1.0
+                vectors[row, h % self.dim] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+class SentenceTransformerEmbedder:
+    # Optional local model; only imported when selected through EMBEDDER
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.name = f"sentence-transformers-{model_name}"
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), convert_to_numpy=True, normalize_embeddings=True)
+        return vectors.astype(np.float32)
+
+
+def get_embedder(spec=None):
+    # EMBEDDER=hashing (default), hashing:<dim>, or sentence-transformers:<model name>
+    spec = spec or os.getenv('EMBEDDER', 'hashing')
+    kind, _, arg = spec.partition(':')
+    if kind == 'hashing':
+        return HashingEmbedder(dim=int(arg) if arg else 512)
+    if kind == 'sentence-transformers':
+        return SentenceTransformerEmbedder(arg or 'all-MiniLM-L6-v2')
+    raise ValueError(f"Unknown embedder: {spec}")
+
+
+def top_k(matrix, query_vector, k):
+    # Cosine similarity against row-normalized vectors; returns (indices, scores) best first
+    scores = np.asarray(matrix @ query_vector, dtype=np.float32)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    idx = idx[np.argsort(-scores[idx])]
+    return idx, scores[idx]
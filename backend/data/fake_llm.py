@@ -0,0 +1,354 @@
+import re
+import ast
+import json
+import time
+import zlib
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+
+# Local stand-in for an Azure OpenAI chat-completions deployment. It answers the prompts that
+# generation.py, server.py and subtopics.py send with deterministic, well-formed content
+# derived from the input, so the pipelines can be run and timed without a live endpoint.
+# Point AZURE_OPENAI_ENDPOINT at it; both requests/aiohttp callers and the openai client work.
+
+CATEGORIES = ('anecdotes', 'media_reports', 'opinions', 'other')
+WORD_RE = re.compile(r"[a-z][a-z']{3,}")
+STOP_WORDS = {'this', 'that', 'with', 'have', 'from', 'they', 'were', 'what', 'when', 'your', 'about', 'there',
+              'their', 'would', 'could', 'should', 'just', 'like', 'been', 'more', 'than', 'them', 'then', 'into',
+              'some', 'only', 'also', 'very', 'much', 'because', 'quote', 'summary', 'themes', 'theme'}
+SUBREDDIT_LIST_RE = re.compile(r"Here is a list of subreddits: (\[.*?\])\. Based on the topic '(.*?)'", re.DOTALL)
+THEME_COUNT_RE = re.compile(r'identify (?:the top|up to) (\d+) common themes')
+SUBREDDIT_THEMES_RE = re.compile(r"Generate a list of (\d+) themes .*? subreddit '(.*?)'", re.DOTALL)
+QUOTE_LINE_RE = re.compile(r'^\[(\d+)\] ', re.MULTILINE)
+THEME_LINE_RE = re.compile(r'^(\d+)\. ', re.MULTILINE)
+
+
+def stable_hash(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def approx_tokens(text):
+    return len(text or '') // 4 + 1
+
+
+def parse_latency(spec):
+    # fixed:<s> | uniform:<lo>,<hi> | normal:<mean>,<sd> | lognormal:<median>,<sigma>
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',') if v] if args else []
+    if kind == 'fixed':
+        return lambda rng: values[0] if values else 0.0
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        import math
+
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def top_words(text, count):
+    counts = {}
+    for word in WORD_RE.findall(text.lower()):
+        if word not in STOP_WORDS:
+            counts[word] = counts.get(word, 0) + 1
+    return [w for w, _ in sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:count]]
+
+
+def analyze_submission(submission, quote_rate=30, max_quotes=8):
+    # Picks a stable subset of comments as quotes; the category follows from the hash
+    body = submission.get('Comments') or ''
+    comments = [c for c in re.split(r'\n\n|(?<=[.!?])\s+', body) if len(c.strip()) > 20]
+    analysis = {category: [] for category in CATEGORIES}
+    picked = 0
+    for comment in comments:
+        h = stable_hash(comment)
+        if h % 100 >= quote_rate:
+            continue
+        words = ' '.join(comment.split()[:12])
+        analysis[CATEGORIES[h % len(CATEGORIES)]].append({"quote": comment.strip()[:400],
+                                                          "summary": f"Commenter says: {words}"})
+        picked += 1
+        if picked >= max_quotes:
+            break
+    return analysis
+
+
+def canned_content(messages, quote_rate=30):
+    system = next((m['content'] for m in messages if m['role'] == 'system'), '')
+    user = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+
+    # generation.py, packed submissions
+    if user.startswith('The input below contains several Reddit submissions'):
+        submissions = json.loads(user.split('\n\n', 1)[1])['Submissions']
+        return json.dumps({"results": [dict(ID=s.get('ID'), **analyze_submission(s, quote_rate)) for s in submissions]})
+
+    # generation.py, one submission (or one comment window)
+    if system and user.startswith('{'):
+        try:
+            submission = json.loads(user)
+        except json.JSONDecodeError:
+            submission = None
+        if isinstance(submission, dict) and 'Comments' in submission:
+            return json.dumps(analyze_submission(submission, quote_rate))
+
+    # server.py, chunk scan and rerank: catalog names that share a word with the topic, plus
+    # a stable ~2% of the rest
+    match = SUBREDDIT_LIST_RE.search(user)
+    if match:
+        names = ast.literal_eval(match.group(1))
+        topic_words = set(WORD_RE.findall(match.group(2).lower()))
+        chosen = [n for n in names
+                  if topic_words & set(WORD_RE.findall(n.lower())) or stable_hash(n + match.group(2)) % 50 == 0]
+        return ", ".join(chosen)
+
+    # server.py, themes for one subreddit
+    match = SUBREDDIT_THEMES_RE.search(user)
+    if match:
+        count, subreddit = int(match.group(1)), match.group(2)
+        themes = [{"title": f"{subreddit} theme {i}", "description": f"Policy topic {i} discussed in {subreddit}"}
+                  for i in range(1, count + 1)]
+        return "```json\n" + json.dumps(themes, indent=2) + "\n```"
+
+    # subtopics.py, themes from summaries (single prompt, map and reduce steps)
+    match = THEME_COUNT_RE.search(user)
+    if match:
+        count = int(match.group(1))
+        words = top_words(user, count)
+        themes = [f"{w.capitalize()} concerns" for w in words] + [f"Theme {i}" for i in range(len(words) + 1, count + 1)]
+        return json.dumps({"themes": themes[:count]})
+
+    # subtopics.py, batched classification
+    if user.startswith('Please classify each of the following quotes'):
+        head, _, quotes = user.partition('Quotes:')
+        theme_count = len(THEME_LINE_RE.findall(head))
+        assignments = []
+        for n in QUOTE_LINE_RE.findall(quotes):
+            line = quotes.split(f'[{n}] ', 1)[1].split('\n', 1)[0]
+            choice = stable_hash(line) % (theme_count + 1)
+            assignments.append({"quote": int(n), "theme": choice if choice else "none"})
+        return json.dumps({"assignments": assignments})
+
+    # subtopics.py, one quote
+    if user.startswith('Please classify the following quote'):
+        theme_count = len(THEME_LINE_RE.findall(user))
+        choice = stable_hash(user) % (theme_count + 1)
+        return str(choice) if choice else "none"
+
+    return "OK"
+
+
+class FakeLLM:
+    # Configurable stand-in: latency distribution (+ optional per-output-token time), injected
+    # 429s (with Retry-After in the header and the message, as Azure sends them), 500s and
+    # malformed JSON, an optional requests-per-minute limit, and canned responses
+    # [{"match": <regex on the last user message>, "content": <text>}] checked first.
+    def __init__(self, latency='fixed:0', seconds_per_token=0.0, rate_429=0.0, retry_after=1, rate_500=0.0,
+                 malformed_rate=0.0, rpm=None, canned=None, quote_rate=30, seed=0):
+        self.latency = parse_latency(latency)
+        self.seconds_per_token = seconds_per_token
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rate_500 = rate_500
+        self.malformed_rate = malformed_rate
+        self.rpm = rpm
+        self.canned = [(re.compile(c['match'], re.DOTALL), c['content']) for c in canned or []]
+        self.quote_rate = quote_rate
+        self.rng = random.Random(seed)
+        self.recent = deque()
+        self.seen_prefixes = set()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0, "malformed": 0,
+                      "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self.latencies = []
+
+    def snapshot(self):
+        return dict(self.stats), list(self.latencies)
+
+    def throttle_wait(self):
+        # Seconds until the RPM window has room, or 0
+        if self.rpm is None:
+            return 0
+        now = time.monotonic()
+        while self.recent and now - self.recent[0] > 60:
+            self.recent.popleft()
+        if len(self.recent) >= self.rpm:
+            return int(60 - (now - self.recent[0])) + 1
+        self.recent.append(now)
+        return 0
+
+    def respond(self, messages):
+        user = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+        for pattern, content in self.canned:
+            if pattern.search(user):
+                return content
+        return canned_content(messages, self.quote_rate)
+
+    def usage(self, messages, content):
+        prompt_tokens = sum(approx_tokens(m.get('content')) for m in messages)
+        # Providers cache whole 128-token blocks of a repeated prefix of at least 1024 tokens
+        prefix = messages[0].get('content') or ''
+        prefix_tokens = approx_tokens(prefix)
+        cached = 0
+        if prefix_tokens >= 1024:
+            key = stable_hash(prefix)
+            if key in self.seen_prefixes:
+                cached = prefix_tokens // 128 * 128
+            self.seen_prefixes.add(key)
+        completion_tokens = approx_tokens(content)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached}}
+
+    async def chat(self, request):
+        from aiohttp import web
+
+        started = time.monotonic()
+        self.stats["requests"] += 1
+        body = await request.json()
+        messages = body.get('messages') or []
+
+        wait = self.throttle_wait()
+        if wait or self.rng.random() < self.rate_429:
+            wait = wait or self.retry_after
+            self.stats["throttled"] += 1
+            return web.json_response(
+                {"error": {"code": "429", "message": f"Requests to the ChatCompletions_Create Operation have exceeded "
+                                                     f"the rate limit. Please retry after {wait} seconds."}},
+                status=429, headers={"Retry-After": str(wait)})
+        if ((body.get('response_format') or {}).get('type') == 'json_object'
+                and not any('json' in str(m.get('content', '')).lower() for m in messages)):
+            # The real service rejects json_object requests whose messages never mention JSON
+            self.stats["errors"] += 1
+            return web.json_response({"error": {"code": "BadRequest", "message": "'messages' must contain the word "
+                                                                                 "'json' in some form, to use "
+                                                                                 "'response_format' of type "
+                                                                                 "'json_object'."}}, status=400)
+        if self.rng.random() < self.rate_500:
+            self.stats["errors"] += 1
+            return web.json_response({"error": {"code": "500", "message": "Injected server error"}}, status=500)
+
+        content = self.respond(messages)
+        if self.rng.random() < self.malformed_rate:
+            self.stats["malformed"] += 1
+            content = content[:len(content) // 2]
+        usage = self.usage(messages, content)
+        max_tokens = body.get('max_tokens')
+        finish_reason = 'stop'
+        if max_tokens and usage['completion_tokens'] > max_tokens:
+            content = content[:max_tokens * 4]
+            usage = self.usage(messages, content)
+            finish_reason = 'length'
+
+        await asyncio.sleep(self.latency(self.rng) + self.seconds_per_token * usage['completion_tokens'])
+
+        for key in ('prompt_tokens', 'completion_tokens'):
+            self.stats[key] += usage[key]
+        self.stats["cached_tokens"] += usage['prompt_tokens_details']['cached_tokens']
+        self.stats["ok"] += 1
+        self.latencies.append(time.monotonic() - started)
+        return web.json_response({
+            "id": f"chatcmpl-fake-{self.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.match_info.get('deployment', body.get('model', 'fake')),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": usage,
+        })
+
+    async def get_stats(self, request):
+        from aiohttp import web
+
+        return web.json_response(self.stats)
+
+    async def post_reset(self, request):
+        from aiohttp import web
+
+        self.reset_stats()
+        return web.json_response({"ok": True})
+
+    def make_app(self):
+        from aiohttp import web
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/openai/deployments/{deployment}/chat/completions', self.chat)
+        app.router.add_post('/v1/chat/completions', self.chat)
+        app.router.add_post('/chat/completions', self.chat)
+        app.router.add_get('/stats', self.get_stats)
+        app.router.add_post('/reset', self.post_reset)
+        return app
+
+
+def serve_in_thread(fake, host='127.0.0.1', port=0):
+    # Runs the server on its own event loop in a daemon thread; returns (base url, stop())
+    from aiohttp import web
+
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(fake.make_app())
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, host, port)
+        loop.run_until_complete(site.start())
+        state['port'] = runner.addresses[0][1]
+        ready.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+
+    return f"http://{host}:{state['port']}", stop
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--latency", default="fixed:0.05",
+                        help="fixed:<s>, uniform:<lo>,<hi>, normal:<mean>,<sd> or lognormal:<median>,<sigma>")
+    parser.add_argument("--seconds-per-token", type=float, default=0.0, help="Extra latency per output token")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds on injected 429s")
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of responses cut in half")
+    parser.add_argument("--rpm", type=int, help="Requests-per-minute limit enforced with real 429s")
+    parser.add_argument("--canned", help="JSON file of [{\"match\": regex, \"content\": text}]")
+    parser.add_argument("--quote-rate", type=int, default=30, help="Percent of comments returned as quotes")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def fake_from_args(args):
+    canned = None
+    if args.canned:
+        with open(args.canned, 'r') as file:
+            canned = json.load(file)
+    return FakeLLM(args.latency, args.seconds_per_token, args.rate_429, args.retry_after, args.rate_500,
+                   args.malformed_rate, args.rpm, canned, args.quote_rate, args.seed)
+
+
+if __name__ == '__main__':
+    import argparse
+    from aiohttp import web
+
+    parser = argparse.ArgumentParser(description="Deterministic local stand-in for an Azure OpenAI chat deployment")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.info(f"Fake LLM on http://{args.host}:{args.port} (set AZURE_OPENAI_ENDPOINT to this URL)")
+    web.run_app(fake_from_args(args).make_app(), host=args.host, port=args.port, print=None)
@@ -1,16 +1,30 @@
 import os
 import json
-import pandas as pd
+import csv
+import sys
 import logging
 import time
-import random
-import requests
+import functools
+import threading
+import asyncio
 from multiprocessing import Pool
 from tqdm import tqdm
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_not_exception_type
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel
 from typing import List
 from dotenv import load_dotenv
+from async_engine import (RateLimiter, AdaptiveConcurrency, AsyncChatClient, NonRetryableError, RateLimitError,
+                          parse_retry_after, run_bounded)
+from batch_api import (AzureBatchService, write_batch_files, submit_batches, wait_for_batches, make_custom_id,
+                       split_custom_id)
+from run_manifest import RunManifest, DONE, EMPTY, FAILED, SKIPPED
+from output_store import CATEGORIES, get_sink, default_store_path, TeeSink
+from ndjson_ingest import bounded_imap_unordered
+from prompt_packing import plan_units, merge_analyses, packed_user_prompt, split_packed_content
+from prefilter import load_prefilter, apply_prefilter, ScoreStore
+from request_builder import RequestBuilder, RequestStats, load_prompt, get_session, is_truncated
+from instrumentation import METRICS, llm_call, record_llm_call, summary as metrics_summary
 
 # Load environment variables
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
@@ -39,11 +53,66 @@ def get_env(key, default=None, var_type=str):
 
 # Global variables
 POOL_SIZE = get_env('POOL_SIZE', 2, int)
+MAX_PENDING_PER_WORKER = get_env('MAX_PENDING_PER_WORKER', 4, int)
 DEPLOYMENT_NAME = get_env('DEPLOYMENT_NAME')
 MAX_RETRIES = get_env('MAX_RETRIES', 5, int)
 MIN_RETRY_WAIT = get_env('MIN_RETRY_WAIT', 1, int)
 MAX_RETRY_WAIT = get_env('MAX_RETRY_WAIT', 60, int)
 
+# Async engine settings: deployment quota and concurrency bounds
+ENGINE = get_env('ENGINE', 'async')
+RATE_LIMIT_RPM = get_env('RATE_LIMIT_RPM', 60, int)
+RATE_LIMIT_TPM = get_env('RATE_LIMIT_TPM', 80000, int)
+INITIAL_CONCURRENCY = get_env('INITIAL_CONCURRENCY', 4, int)
+MAX_CONCURRENCY = get_env('MAX_CONCURRENCY', 32, int)
+
+# Prompt sizing: oversized threads are split into comment windows, small submissions can be
+# packed several to a request. Packing is opt-in: set PACK_MAX_ROWS above 1 to enable it.
+MAX_PROMPT_TOKENS = get_env('MAX_PROMPT_TOKENS', 100000, int)
+PACK_MAX_TOKENS = get_env('PACK_MAX_TOKENS', 6000, int)
+PACK_MAX_ROWS = get_env('PACK_MAX_ROWS', 1, int)
+WINDOW_CONCURRENCY = get_env('WINDOW_CONCURRENCY', 4, int)
+
+# max_tokens is sized from the input (MIN_OUTPUT_TOKENS + OUTPUT_TOKEN_RATIO * input tokens);
+# a truncated response is retried once at MAX_OUTPUT_TOKENS
+MIN_OUTPUT_TOKENS = get_env('MIN_OUTPUT_TOKENS', 512, int)
+MAX_OUTPUT_TOKENS = get_env('MAX_OUTPUT_TOKENS', 4096, int)
+OUTPUT_TOKEN_RATIO = get_env('OUTPUT_TOKEN_RATIO', 0.5, float)
+
+# Batch API settings (needs a global-batch deployment)
+BATCH_DIRECTORY = get_env('BATCH_DIRECTORY', 'batches')
+BATCH_POLL_INTERVAL = get_env('BATCH_POLL_INTERVAL', 60, int)
+
+# Where validated analyses go: json (one file per row), sqlite or parquet
+OUTPUT_SINK = get_env('OUTPUT_SINK', 'json')
+OUTPUT_STORE_PATH = get_env('OUTPUT_STORE_PATH')
+
+# Local relevance prefilter: rows with no sign of the filter prompt's topic are skipped
+# before any request is made
+PREFILTER = get_env('PREFILTER', 'false', bool)
+PREFILTER_PROMPT_PATH = get_env('PREFILTER_PROMPT_PATH',
+                                os.path.join(os.path.dirname(__file__), '..', 'prompts', 'filter_prompt.txt'))
+PREFILTER_TERMS = [t for t in get_env('PREFILTER_TERMS', '').split(',') if t.strip()]
+PREFILTER_TERMS_PATH = get_env('PREFILTER_TERMS_PATH')
+PREFILTER_MIN_SCORE = get_env('PREFILTER_MIN_SCORE', 1.0, float)
+PREFILTER_CLASSIFIER = get_env('PREFILTER_CLASSIFIER')
+PREFILTER_MIN_SIMILARITY = get_env('PREFILTER_MIN_SIMILARITY', 0.2, float)
+PREFILTER_SCORES_PATH = get_env('PREFILTER_SCORES_PATH')
+
+# Near-duplicate index written by near_dup.py / combine_submissions_comments --dedup; when it
+# exists, results of representative rows are copied to their dropped duplicates after a run
+DEDUP_INDEX_PATH = get_env('DEDUP_INDEX_PATH')
+
+# Full-text quote search index (quote_index.py), kept current as results are written;
+# QUOTE_INDEX_INGEST_STATE (an ingest_state.sqlite3) supplies post dates
+QUOTE_INDEX_PATH = get_env('QUOTE_INDEX_PATH')
+QUOTE_INDEX_INGEST_STATE = get_env('QUOTE_INDEX_INGEST_STATE')
+
+# Multi-topic extraction: TOPICS_PATH is a JSON list of topic definitions (see topics.py).
+# Each thread is sent once and the response has one section per topic; every topic gets its
+# own output store under <output_dir>/<topic key>/. TOPIC_PROMPT_PATH overrides the
+# prompts/multi_topic_prompt.txt template. Read at use, so --topics reaches pool workers.
+
 # Azure OpenAI settings
 endpoint = get_env('AZURE_OPENAI_ENDPOINT')
 api_key = get_env('AZURE_OPENAI_API_KEY')
@@ -53,42 +122,102 @@ def read_file(file_path):
     with open(file_path, 'r') as file:
         return file.read()
 
-import re
-import time
+
+# Comment threads can be far larger than the csv module's default field limit
+csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+ROW_FIELDS = ('id', 'title', 'selftext', 'body')
+
+
+_builder = None
+_topics = None
+
+# Token and latency counters for this process; pool workers hand theirs back per unit
+REQUEST_STATS = RequestStats()
+
+# HTTP attempts made by the current call, for the retry count in the call metrics
+_attempts = threading.local()
+
+
+def get_topics():
+    # (topic definitions, response model) in multi-topic mode, otherwise None
+    global _topics
+    if _topics is None and get_env('TOPICS_PATH'):
+        from topics import load_topics, topic_model
+
+        topics = load_topics(get_env('TOPICS_PATH'))
+        _topics = topics, topic_model(topics, AIImpactAnalysis)
+    return _topics
+
+
+def get_builder():
+    # The system prompt is read and hashed once per process
+    global _builder
+    if _builder is None:
+        if get_topics():
+            from topics import topic_prompt
+
+            # Output grows with the number of topics; the input does not
+            topics, _ = get_topics()
+            system_prompt = topic_prompt(topics, get_env('TOPIC_PROMPT_PATH'))
+            _builder = RequestBuilder(system_prompt, MIN_OUTPUT_TOKENS * len(topics), MAX_OUTPUT_TOKENS,
+                                      OUTPUT_TOKEN_RATIO * len(topics))
+        else:
+            system_prompt, _ = load_prompt(get_env('SYSTEM_PROMPT_PATH'))
+            _builder = RequestBuilder(system_prompt, MIN_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS, OUTPUT_TOKEN_RATIO)
+    return _builder
+
+
+def iter_rows(file_path):
+    # Streams lightweight dict rows with only the fields the prompt needs
+    with open(file_path, 'r', newline='', encoding='utf-8') as file:
+        for record in csv.DictReader(file):
+            yield {field: record.get(field) or '' for field in ROW_FIELDS}
+
+
+_backoff = wait_exponential(multiplier=2, min=5, max=120)
+
+
+def wait_retry_after(retry_state):
+    # A 429 waits exactly as long as the service asks; other failures back off exponentially
+    error = retry_state.outcome.exception()
+    if isinstance(error, RateLimitError):
+        return error.retry_after
+    return _backoff(retry_state)
+
 
 @retry(
     stop=stop_after_attempt(MAX_RETRIES),
-    wait=wait_exponential(multiplier=2, min=5, max=120),
-    retry=retry_if_exception_type(Exception)
+    wait=wait_retry_after,
+    retry=retry_if_not_exception_type(NonRetryableError)
 )
-def make_api_call(messages):
+def make_api_call(messages, max_tokens=MAX_OUTPUT_TOKENS):
+    _attempts.count = getattr(_attempts, 'count', 0) + 1
     try:
         headers = {
             "Content-Type": "application/json",
             "api-key": api_key
         }
-        data = {
-            "messages": messages,
-            "max_tokens": 4096
-        }
-        
-        response = requests.post(
+        data = get_builder().payload(messages, max_tokens)
+
+        # Pooled keep-alive connection instead of a new TLS handshake per request
+        started = time.monotonic()
+        response = get_session(WINDOW_CONCURRENCY).post(
             f"{endpoint}/openai/deployments/{DEPLOYMENT_NAME}/chat/completions?api-version={api_version}",
             headers=headers, json=data
         )
         
         if response.status_code == 200:
             # logging.info("Raw API response: " + str(response.json()))  # Log the entire response
-            return response.json()
+            result = response.json()
+            REQUEST_STATS.record(time.monotonic() - started, result)
+            return result
         elif response.status_code == 429:
-            # Extract retry-after seconds from the response message if present
-            retry_after = 60  # Default to 60 seconds
-            match = re.search(r'retry after (\d+) seconds', response.text)
-            if match:
-                retry_after = int(match.group(1))
+            # The retry decorator waits out Retry-After (header or message text)
+            retry_after = parse_retry_after(response.headers, response.text)
             logging.warning(f"Rate limit hit: Waiting for {retry_after} seconds.")
-            time.sleep(retry_after)
-            raise Exception("Rate limit error")
+            raise RateLimitError(retry_after)
+        elif 400 <= response.status_code < 500:
+            raise NonRetryableError(f"Request failed: {response.status_code} - {response.text}")
         else:
             raise Exception(f"Request failed: {response.status_code} - {response.text}")
     
@@ -97,93 +226,488 @@ def make_api_call(messages):
         raise
 
 
-def process_row(args):
-    file_path, row, output_dir = args
-    subreddit = os.path.basename(file_path).split('_')[0]
-    system_prompt = read_file(get_env('SYSTEM_PROMPT_PATH'))
+def subreddit_from_path(file_path):
+    # <subreddit>_llm.csv; subreddit names may themselves contain underscores
+    filename = os.path.basename(file_path)
+    if filename.endswith('_llm.csv'):
+        return filename[:-len('_llm.csv')]
+    return filename.split('_')[0]
+
 
-    formatted_submission = {
+def format_submission(row):
+    return {
         "Submission Title": row['title'],
         "Submission Body": row['selftext'],
         "Comments": row['body'],
         "ID": row['id']
     }
 
-    user_prompt = json.dumps(formatted_submission, default=str)
 
-    # Define the output path based on row ID
-    output_subdir = os.path.join(output_dir, subreddit)
-    os.makedirs(output_subdir, exist_ok=True)
-    output_path = os.path.join(output_subdir, f'output-{row["id"]}.json')
+def build_messages(row, builder):
+    user_prompt = json.dumps(format_submission(row), default=str)
+    return builder.messages(user_prompt)
+
+
+def build_packed_messages(rows, builder):
+    return builder.messages(packed_user_prompt([format_submission(row) for row in rows]))
+
+
+def validate_analysis(parsed_data):
+    # Map parsed data to AIImpactAnalysis structure
+    return AIImpactAnalysis(
+        anecdotes=[QuoteSummary(**item) for item in parsed_data.get("anecdotes", [])],
+        media_reports=[QuoteSummary(**item) for item in parsed_data.get("media_reports", [])],
+        opinions=[QuoteSummary(**item) for item in parsed_data.get("opinions", [])],
+        other=[QuoteSummary(**item) for item in parsed_data.get("other", [])]
+    )
+
+
+def parse_analysis(response):
+    # Extract and parse the JSON content from the API response
+    response_content = response['choices'][0]['message']['content']
+    parsed_data = json.loads(response_content)  # Parse the JSON string
+    return validate_analysis(parsed_data)
+
+
+def validate_topics(parsed_data):
+    # Multi-topic responses are checked against the model built from the topic definitions:
+    # every topic needs its section; categories missing from a section are empty
+    _, model = get_topics()
+    sections = {key: {category: section.get(category, []) for category in CATEGORIES}
+                if isinstance(section, dict) else section for key, section in parsed_data.items()}
+    return model(**sections).dict(by_alias=True)
+
+
+def parse_result(response):
+    # The analysis dict of a response, or {topic key: analysis dict} in multi-topic mode
+    if get_topics():
+        return validate_topics(json.loads(response['choices'][0]['message']['content']))
+    return parse_analysis(response).dict()
+
+
+def merge_results(results):
+    # Combines the parsed responses of one row's comment windows
+    if get_topics():
+        topics, _ = get_topics()
+        return {topic['key']: merge_analyses([r[topic['key']] for r in results]) for topic in topics}
+    return validate_analysis(merge_analyses(results)).dict()
+
+
+def has_quotes(analysis):
+    sections = analysis.values() if get_topics() else [analysis]
+    return any(any(section.values()) for section in sections)
+
+
+def record_result(sink, manifest, subreddit, row_id, analysis, error=None):
+    # Runs in the dispatching process: the sink only keeps non-empty analyses, and an empty
+    # one clears whatever the row had saved before
+    if error is not None:
+        manifest.record(subreddit, row_id, FAILED, error)
+    elif sink.write(subreddit, row_id, analysis):
+        logging.info(f"Successfully processed and saved output for row {row_id}")
+        manifest.record(subreddit, row_id, DONE)
+    else:
+        logging.info(f"No quotes for row {row_id}; cleared any earlier output")
+        manifest.record(subreddit, row_id, EMPTY)
+
+
+def open_prefilter(output_dir, enabled=PREFILTER):
+    # (Prefilter, ScoreStore) when the prefilter is enabled, otherwise None
+    if not enabled:
+        return None
+    if get_topics():
+        from topics import topic_prefilter
+
+        # Rows pass when they show signs of any topic
+        prefilter = topic_prefilter(get_topics()[0], PREFILTER_TERMS, PREFILTER_TERMS_PATH, PREFILTER_MIN_SCORE,
+                                    PREFILTER_CLASSIFIER, PREFILTER_MIN_SIMILARITY)
+    else:
+        prefilter = load_prefilter(PREFILTER_PROMPT_PATH, PREFILTER_TERMS, PREFILTER_TERMS_PATH, PREFILTER_MIN_SCORE,
+                                   PREFILTER_CLASSIFIER, PREFILTER_MIN_SIMILARITY)
+    store = ScoreStore(PREFILTER_SCORES_PATH or os.path.join(output_dir, 'prefilter_scores.sqlite3'))
+    return prefilter, store
+
+
+def pending_rows(file_path, manifest, prefilter=None):
+    # Rows still needing work, minus those the prefilter rejects (recorded as skipped)
+    subreddit = subreddit_from_path(file_path)
+    rows = manifest.pending(subreddit, iter_rows(file_path))
+    if prefilter is None:
+        return rows
+    prefilter, store = prefilter
+    return apply_prefilter(subreddit, rows, prefilter, store,
+                           lambda row_id, reason: manifest.record(subreddit, row_id, SKIPPED, reason))
+
+
+def plan_file_units(rows, builder, pack_max_rows=None):
+    # No packing in multi-topic mode: the packed response format has no topic sections
+    if get_topics():
+        pack_max_rows = 1
+    return plan_units(rows, builder.system_message['content'], MAX_PROMPT_TOKENS, PACK_MAX_TOKENS,
+                      PACK_MAX_ROWS if pack_max_rows is None else pack_max_rows)
+
 
-    # Check if the output file already exists
-    if os.path.exists(output_path):
-        logging.info(f"Output for row {row['id']} already exists. Skipping processing.")
-        return  # Skip processing if the output already exists
+def unit_messages(kind, rows, builder):
+    # One message list per request the unit needs
+    if kind == 'packed':
+        return [build_packed_messages(rows, builder)]
+    return [build_messages(row, builder) for row in rows]
 
+
+def unit_results(kind, rows, responses):
+    # Turns a unit's responses (dicts, or exceptions for failed requests) into
+    # [(row id, analysis dict or None, error or None)]
+    if kind == 'single':
+        row, response = rows[0], responses[0]
+        if isinstance(response, Exception):
+            return [(row['id'], None, str(response))]
+        return [(row['id'], parse_result(response), None)]
+
+    if kind == 'windows':
+        row_id = rows[0]['id']
+        errors = [str(r) for r in responses if isinstance(r, Exception)]
+        if errors:
+            return [(row_id, None, f"{len(errors)} of {len(responses)} windows failed: {errors[0]}")]
+        return [(row_id, merge_results([parse_result(r) for r in responses]), None)]
+
+    response = responses[0]
+    if isinstance(response, Exception):
+        return [(row['id'], None, str(response)) for row in rows]
+    by_id = split_packed_content(response['choices'][0]['message']['content'], [row['id'] for row in rows])
+    results = []
+    for row in rows:
+        if str(row['id']) in by_id:
+            results.append((row['id'], validate_analysis(by_id[str(row['id'])]).dict(), None))
+        else:
+            # Left FAILED in the manifest so --retry-failed resends it on its own
+            results.append((row['id'], None, "Missing from packed response"))
+    return results
+
+
+def call_sized(messages, operation='single', queue_wait=None):
+    builder = get_builder()
+    max_tokens = builder.max_tokens(messages)
+    _attempts.count = 0
+    with llm_call('generation', operation, queue_wait) as call:
+        try:
+            response = make_api_call(messages, max_tokens)
+            if is_truncated(response) and max_tokens < MAX_OUTPUT_TOKENS:
+                REQUEST_STATS.record_truncated()
+                response = make_api_call(messages, MAX_OUTPUT_TOKENS)
+        finally:
+            call.retries = max(0, _attempts.count - 1)
+        call.response = response
+    return response
+
+
+def call_or_error(messages, operation='single', queue_wait=None):
     try:
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        
-        # Make API call and parse the output
-        response = make_api_call(messages)
-        
-        logging.info(f"response: {response}.")
+        return call_sized(messages, operation, queue_wait)
+    except Exception as e:
+        return e
 
-        # Extract and parse the JSON content from the API response
-        response_content = response['choices'][0]['message']['content']
-        logging.info(f"response content: {response_content}.")
 
-        parsed_data = json.loads(response_content)  # Parse the JSON string
-        
-        # Map parsed data to AIImpactAnalysis structure
-        parsed_output = AIImpactAnalysis(
-            anecdotes=[QuoteSummary(**item) for item in parsed_data.get("anecdotes", [])],
-            media_reports=[QuoteSummary(**item) for item in parsed_data.get("media_reports", [])],
-            opinions=[QuoteSummary(**item) for item in parsed_data.get("opinions", [])],
-            other=[QuoteSummary(**item) for item in parsed_data.get("other", [])]
-        )
-        logging.info(f"parsed outputs: {parsed_output}.")
-
-        # Only save the parsed output if it contains any non-empty field
-        if parsed_output.anecdotes or parsed_output.media_reports or parsed_output.opinions or parsed_output.other:
-            with open(output_path, 'w') as file:
-                json.dump(parsed_output.dict(), file, indent=4)
-            
-            logging.info(f"Successfully processed and saved output for row {row['id']} in {output_path}")
+def reset_worker_metrics():
+    # Pool initializer: forked workers must not send the parent's counters back
+    METRICS.reset()
+
+
+def process_row(args):
+    # Processes one request unit (a row, a windowed row or a pack of rows); returns
+    # (subreddit, [(row id, analysis, error)], request stats snapshot, metrics snapshot)
+    file_path, kind, rows, enqueued = args
+    subreddit = subreddit_from_path(file_path)
+    builder = get_builder()
+    queue_wait = time.time() - enqueued
+
+    # Rows that are already done were filtered out by the run manifest before dispatch
+    try:
+        requests_messages = unit_messages(kind, rows, builder)
+
+        # Comment windows of one thread go out concurrently
+        if len(requests_messages) > 1:
+            with ThreadPoolExecutor(max_workers=WINDOW_CONCURRENCY) as executor:
+                responses = list(executor.map(lambda m: call_or_error(m, kind, queue_wait), requests_messages))
         else:
-            logging.info(f"Skipped saving empty output for row {row['id']}")
+            responses = [call_or_error(requests_messages[0], kind, queue_wait)]
+
+        return subreddit, unit_results(kind, rows, responses), REQUEST_STATS.drain(), METRICS.drain()
 
     except Exception as e:
-        logging.error(f"Error processing row {row['id']} in {file_path}: {str(e)}")
+        logging.error(f"Error processing rows {[row['id'] for row in rows]} in {file_path}: {str(e)}")
+        return subreddit, [(row['id'], None, str(e)) for row in rows], REQUEST_STATS.drain(), METRICS.drain()
+
+
+def process_file(file_path, sink, manifest, prefilter=None):
+    # Pool engine: each worker retries on its own and honours Retry-After, but the workers
+    # share no rate limiter; ENGINE=async is the default for quota-bound runs
+    subreddit = subreddit_from_path(file_path)
+    builder = get_builder()
+    stats = RequestStats()
+    with Pool(POOL_SIZE, initializer=reset_worker_metrics) as pool:
+        rows = pending_rows(file_path, manifest, prefilter)
+        args = ((file_path, kind, unit_rows, time.time()) for kind, unit_rows in plan_file_units(rows, builder))
+        for result in tqdm(bounded_imap_unordered(pool, process_row, args, POOL_SIZE * MAX_PENDING_PER_WORKER),
+                           desc=f"Processing {os.path.basename(file_path)}"):
+            if isinstance(result, Exception):
+                logging.error(f"Worker failed in {file_path}: {result}")
+                continue
+            for row_id, analysis, error in result[1]:
+                record_result(sink, manifest, subreddit, row_id, analysis, error)
+            stats.merge(result[2])
+            METRICS.merge(result[3])
+    sink.flush()
+    manifest.commit()
+    logging.info(f"Request stats for {os.path.basename(file_path)}: {stats.summary()}")
+
+
+async def process_file_async(file_path, sink, manifest, prefilter=None):
+    # Asyncio engine: one shared RPM/TPM budget and AIMD concurrency instead of
+    # per-worker sleeps; throughput follows the deployment quota
+    subreddit = subreddit_from_path(file_path)
+    builder = get_builder()
+
+    limiter = RateLimiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+    concurrency = AdaptiveConcurrency(INITIAL_CONCURRENCY, maximum=MAX_CONCURRENCY)
+    client = AsyncChatClient(
+        f"{endpoint}/openai/deployments/{DEPLOYMENT_NAME}/chat/completions?api-version={api_version}",
+        api_key, limiter, concurrency, max_retries=MAX_RETRIES
+    )
+    progress = tqdm(desc=f"Processing {os.path.basename(file_path)}")
+
+    async def complete_sized(messages, operation):
+        max_tokens = builder.max_tokens(messages)
+        response = await client.complete(messages, max_tokens, operation=operation)
+        if is_truncated(response) and max_tokens < MAX_OUTPUT_TOKENS:
+            client.usage.record_truncated()
+            response = await client.complete(messages, MAX_OUTPUT_TOKENS, operation=operation)
+        return response
+
+    async def handle(unit):
+        kind, rows = unit
+        try:
+            requests_messages = unit_messages(kind, rows, builder)
+            responses = await asyncio.gather(*(complete_sized(m, kind) for m in requests_messages),
+                                             return_exceptions=True)
+            results = unit_results(kind, rows, responses)
+        except Exception as e:
+            logging.error(f"Error processing rows {[row['id'] for row in rows]} in {file_path}: {str(e)}")
+            results = [(row['id'], None, str(e)) for row in rows]
+        for row_id, analysis, error in results:
+            record_result(sink, manifest, subreddit, row_id, analysis, error)
+        progress.update(len(rows))
+
+    try:
+        units = plan_file_units(pending_rows(file_path, manifest, prefilter), builder)
+        await run_bounded(units, handle, MAX_CONCURRENCY * 2)
+    finally:
+        sink.flush()
+        manifest.commit()
+        progress.close()
+        await client.close()
+    logging.info(f"Async engine stats for {os.path.basename(file_path)}: {client.stats}, "
+                 f"final concurrency {concurrency.limit}")
+    logging.info(f"Request stats for {os.path.basename(file_path)}: {client.usage.summary()}")
 
 
-def process_file(file_path, output_dir):
-    df = pd.read_csv(file_path)
-    with Pool(POOL_SIZE) as pool:
-        args = [(file_path, row, output_dir) for _, row in df.iterrows()]
-        for _ in tqdm(pool.imap_unordered(process_row, args), total=len(df),
-                      desc=f"Processing {os.path.basename(file_path)}"):
-            time.sleep(2)  # Add a fixed delay (e.g., 1 second) between each request
+def batch_requests(csv_paths, manifest, builder, prefilter=None):
+    # Same system prompt and formatted_submission shape as the synchronous engines.
+    # Oversized rows become windows with custom IDs "<subreddit>:<id>#<i>/<n>"; packing is
+    # not used here since batch pricing is already per token.
+    for file_path in csv_paths:
+        subreddit = subreddit_from_path(file_path)
+        rows = pending_rows(file_path, manifest, prefilter)
+        for kind, unit_rows in plan_file_units(rows, builder, pack_max_rows=1):
+            messages = unit_messages(kind, unit_rows, builder)
+            if kind == 'windows':
+                for i, window_messages in enumerate(messages):
+                    yield make_custom_id(subreddit, f"{unit_rows[0]['id']}#{i}/{len(messages)}"), window_messages
+            else:
+                yield make_custom_id(subreddit, unit_rows[0]['id']), messages[0]
 
 
-def main(input_dir, output_dir):
+def fan_out_batch_results(output_lines, error_lines, sink, manifest):
+    counts = {"saved": 0, "empty": 0, "failed": 0}
+
+    # Group responses (or errors) by row; windowed rows have several parts
+    parts = {}
+    for line in output_lines + error_lines:
+        subreddit, row_key = split_custom_id(line.get('custom_id', ''))
+        row_id, _, window = row_key.partition('#')
+        index, total = (int(x) for x in window.split('/')) if window else (0, 1)
+        response = line.get('response') or {}
+        if response.get('status_code') == 200:
+            result = response['body']
+            record_llm_call('generation', 'batch', 'ok', response=result)
+        else:
+            record_llm_call('generation', 'batch', 'error', error=response.get('status_code') or line.get('error'))
+            result = Exception(f"Request failed: {response.get('status_code')} - "
+                               f"{response.get('body') or line.get('error')}")
+        entry = parts.setdefault((subreddit, row_id), [None] * total)
+        entry[index] = result
+
+    for (subreddit, row_id), responses in parts.items():
+        responses = [r if r is not None else Exception("Missing from batch output") for r in responses]
+        kind = 'windows' if len(responses) > 1 else 'single'
+        rows = [{'id': row_id}] * len(responses)
+        try:
+            results = unit_results(kind, rows, responses)
+        except Exception as e:
+            results = [(row_id, None, str(e))]
+        for _, analysis, error in results:
+            if error is not None:
+                counts["failed"] += 1
+                logging.error(f"Error processing batch result for row {row_id} in {subreddit}: {error}")
+            else:
+                counts["saved" if has_quotes(analysis) else "empty"] += 1
+            record_result(sink, manifest, subreddit, row_id, analysis, error)
+    sink.flush()
+    manifest.commit()
+    return counts
+
+
+def run_batch(csv_paths, sink, manifest, service=None, batch_dir=None, prefilter=None):
+    # Offline mode: pack every pending row into JSONL batch files, submit and poll them,
+    # then write results into the usual output-<id>.json layout
+    service = service or AzureBatchService(endpoint, api_key, api_version)
+    batch_dir = batch_dir or BATCH_DIRECTORY
+
+    paths = write_batch_files(batch_requests(csv_paths, manifest, get_builder(), prefilter), batch_dir, DEPLOYMENT_NAME)
+    totals = {"saved": 0, "empty": 0, "failed": 0}
+    # Every file is submitted before any is polled, so the batches run side by side
+    submitted = submit_batches(service, paths)
+    for batch, output_lines, error_lines in wait_for_batches(service, submitted, BATCH_POLL_INTERVAL):
+        if batch['status'] != 'completed':
+            logging.error(f"Batch {batch['id']} ended with status {batch['status']}")
+        counts = fan_out_batch_results(output_lines, error_lines, sink, manifest)
+        logging.info(f"Batch {os.path.basename(submitted[batch['id']])}: {counts}")
+        for k in totals:
+            totals[k] += counts[k]
+    return totals
+
+
+def open_manifest(output_dir, retry_failed=False, reprocess_if_prompt_changed=False):
+    path = get_env('RUN_MANIFEST_PATH') or os.path.join(output_dir, 'run_manifest.sqlite3')
+    version = get_builder().version
+    return RunManifest(path, version, retry_failed=retry_failed,
+                       reprocess_if_prompt_changed=reprocess_if_prompt_changed)
+
+
+def write_run_summary(output_dir, engine, started, csv_files, manifest):
+    # End-of-run report: row outcomes from the manifest plus per-operation LLM call metrics
+    run_summary = {
+        "engine": engine,
+        "files": len(csv_files),
+        "seconds": round(time.time() - started, 1),
+        "rows": manifest.summary(),
+        # Subreddits whose outputs changed; subtopics.py refreshes only their theme reports
+        "changed_subreddits": sorted(manifest.changed),
+        "llm": metrics_summary(),
+    }
+    logging.info(f"Run summary: {json.dumps(run_summary)}")
+    with open(os.path.join(output_dir, 'run_summary.json'), 'w') as file:
+        json.dump(run_summary, file, indent=4)
+
+
+def main(input_dir, output_dir, engine='pool', retry_failed=False, reprocess_if_prompt_changed=False,
+         use_prefilter=PREFILTER):
+    started = time.time()
     os.makedirs(output_dir, exist_ok=True)
     csv_files = [f for f in os.listdir(input_dir) if f.endswith('_llm.csv')]
+
+    manifest = open_manifest(output_dir, retry_failed, reprocess_if_prompt_changed)
+    if get_topics():
+        from topics import topic_sinks
+
+        # One manifest row per thread covers all topics; outputs are split per topic
+        sink = topic_sinks(OUTPUT_SINK, get_topics()[0], output_dir)
+        if OUTPUT_STORE_PATH or QUOTE_INDEX_PATH:
+            logging.warning("OUTPUT_STORE_PATH and QUOTE_INDEX_PATH are ignored in multi-topic mode; index a "
+                            "topic with quote_index.py --build on its store under the output directory")
+    else:
+        for csv_file in csv_files:
+            manifest.seed_from_outputs(output_dir, subreddit_from_path(csv_file))
+        sink = get_sink(OUTPUT_SINK, output_dir, OUTPUT_STORE_PATH)
+    if QUOTE_INDEX_PATH and not get_topics():
+        from quote_index import QuoteIndex, QuoteIndexSink
+
+        sink = TeeSink(sink, QuoteIndexSink(QuoteIndex(QUOTE_INDEX_PATH, QUOTE_INDEX_INGEST_STATE)))
+    prefilter = open_prefilter(output_dir, use_prefilter)
+    try:
+        run_files(input_dir, csv_files, engine, sink, manifest, prefilter)
+        sink.flush()
+        fan_out_duplicates(input_dir, output_dir, sink, manifest)
+    finally:
+        sink.close()
+        if prefilter is not None:
+            prefilter[1].close()
+        logging.info(f"Run manifest: {manifest.summary()}")
+        write_run_summary(output_dir, engine, started, csv_files, manifest)
+        manifest.close()
+
+
+def fan_out_duplicates(input_dir, output_dir, sink, manifest):
+    index_path = DEDUP_INDEX_PATH or os.path.join(input_dir, 'near_dup.sqlite3')
+    if not os.path.exists(index_path):
+        return
+    from near_dup import NearDupIndex, fan_out
+
+    location = OUTPUT_STORE_PATH or default_store_path(OUTPUT_SINK, output_dir)
+    load = None
+    if get_topics():
+        from topics import topic_locations, read_topic_analyses
+
+        locations = topic_locations(OUTPUT_SINK, get_topics()[0], output_dir)
+        load = functools.partial(read_topic_analyses, locations)
+    index = NearDupIndex(index_path)
+    try:
+        counts = fan_out(index, manifest, sink, location, load)
+    finally:
+        index.close()
+    logging.info(f"Near-duplicates: {counts}")
+
+
+def run_files(input_dir, csv_files, engine, sink, manifest, prefilter=None):
     total_files = len(csv_files)
 
+    if engine == 'batch':
+        totals = run_batch([os.path.join(input_dir, f) for f in csv_files], sink, manifest, prefilter=prefilter)
+        logging.info(f"Batch run complete: {totals}")
+        return
+
     for i, csv_file in enumerate(csv_files, 1):
         file_path = os.path.join(input_dir, csv_file)
         logging.info(f"Processing file {i} of {total_files}: {csv_file}")
-        process_file(file_path, output_dir)
+        if engine == 'async':
+            asyncio.run(process_file_async(file_path, sink, manifest, prefilter))
+        else:
+            process_file(file_path, sink, manifest, prefilter)
         logging.info(f"Completed file {i} of {total_files}: {csv_file}")
         logging.info(f"Files remaining: {total_files - i}")
 
-        time.sleep(random.uniform(1, 5))
-
 if __name__ == '__main__':
-    input_directory = get_env('INPUT_DIRECTORY')
-    output_directory = get_env('OUTPUT_DIRECTORY')
-    main(input_directory, output_directory)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Extract AI impact quotes from subreddit CSVs")
+    parser.add_argument("--input-dir", default=get_env('INPUT_DIRECTORY'))
+    parser.add_argument("--output-dir", default=get_env('OUTPUT_DIRECTORY'))
+    parser.add_argument("--engine", choices=['pool', 'async', 'batch'], default=ENGINE,
+                        help="'async' (default) shares one RPM/TPM budget and adaptive concurrency across all "
+                             "requests, 'pool' is a multiprocessing pool without a shared limiter, 'batch' the "
+                             "Azure OpenAI Batch API")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Re-send rows whose last attempt failed (failed rows whose text changed are always "
+                             "re-sent)")
+    parser.add_argument("--reprocess-if-prompt-changed", action="store_true",
+                        help="Re-send finished rows that were produced with a different system prompt")
+    parser.add_argument("--prefilter", action=argparse.BooleanOptionalAction, default=PREFILTER,
+                        help="Skip rows that show no sign of the filter prompt's topic (see prefilter.py); "
+                             "--no-prefilter overrides PREFILTER=true")
+    parser.add_argument("--topics", default=get_env('TOPICS_PATH'),
+                        help="JSON list of topic definitions: extract every topic in one pass (see topics.py)")
+    args = parser.parse_args()
+
+    if args.topics:
+        os.environ['TOPICS_PATH'] = args.topics
+    main(args.input_dir, args.output_dir, args.engine, args.retry_failed, args.reprocess_if_prompt_changed,
+         args.prefilter)
@@ -0,0 +1,136 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+
+SUBMISSION = 'submission'
+COMMENT = 'comment'
+
+
+class IngestStore:
+    # Everything ingested so far (submissions and comments, per subreddit) plus a created_utc
+    # high-water mark per subreddit and record kind, so a new monthly dump only adds what is
+    # new. Threads that gained a submission or comments are marked touched until finish().
+    def __init__(self, path, commit_every=5000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS submissions ("
+            "id TEXT PRIMARY KEY, subreddit TEXT NOT NULL, title TEXT NOT NULL, selftext TEXT NOT NULL, "
+            "created REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS comments ("
+            "id TEXT PRIMARY KEY, submission_id TEXT NOT NULL, subreddit TEXT NOT NULL, body TEXT NOT NULL, "
+            "created REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS comments_thread ON comments (submission_id, created)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS touched (subreddit TEXT NOT NULL, submission_id TEXT NOT NULL, "
+            "PRIMARY KEY (subreddit, submission_id))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks (subreddit TEXT NOT NULL, kind TEXT NOT NULL, "
+            "created REAL NOT NULL, PRIMARY KEY (subreddit, kind))"
+        )
+        self.db.commit()
+        self.watermarks = {(s, k): c for s, k, c in self.db.execute("SELECT subreddit, kind, created FROM watermarks")}
+        self.seen = {}
+        self.counts = {"submissions": 0, "comments": 0, "old": 0}
+
+    def is_old(self, subreddit, kind, created):
+        # Older than what earlier runs already ingested. Records at the mark itself are kept
+        # and deduplicated by ID, since several can share one created_utc second.
+        key = (subreddit, kind)
+        if created < self.watermarks.get(key, float('-inf')):
+            self.counts["old"] += 1
+            return True
+        self.seen[key] = max(self.seen.get(key, created), created)
+        return False
+
+    def add_submission(self, record):
+        # record: the spill record of parse_submission_block
+        submission_id, title, selftext, created, subreddit = record
+        if self.is_old(subreddit, SUBMISSION, created):
+            return
+        cursor = self.db.execute("INSERT OR IGNORE INTO submissions VALUES (?, ?, ?, ?, ?)",
+                                 (submission_id, subreddit, title, selftext, created))
+        if cursor.rowcount:
+            self.counts["submissions"] += 1
+            self.touch(subreddit, submission_id)
+
+    def add_comment(self, record):
+        # record: the spill record of parse_comment_block; comments without an ID are keyed
+        # by their content
+        submission_id, body, created, subreddit, comment_id = record
+        if self.is_old(subreddit, COMMENT, created):
+            return
+        comment_id = comment_id or hashlib.sha1(f"{submission_id}\0{created}\0{body}".encode('utf-8')).hexdigest()
+        cursor = self.db.execute("INSERT OR IGNORE INTO comments VALUES (?, ?, ?, ?, ?)",
+                                 (comment_id, submission_id, subreddit, body, created))
+        if cursor.rowcount:
+            self.counts["comments"] += 1
+            self.touch(subreddit, submission_id)
+
+    def touch(self, subreddit, submission_id):
+        self.db.execute("INSERT OR IGNORE INTO touched VALUES (?, ?)", (subreddit, submission_id))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def touched_subreddits(self):
+        return [s for s, in self.db.execute("SELECT DISTINCT subreddit FROM touched ORDER BY subreddit")]
+
+    def touched_threads(self, subreddit):
+        # (id, title, selftext, [comment bodies in creation order]) for every touched thread,
+        # with the full history of the thread, not only what this run added
+        self.commit()
+        threads = self.db.execute(
+            "SELECT t.submission_id, COALESCE(s.title, ''), COALESCE(s.selftext, '') FROM touched t "
+            "LEFT JOIN submissions s ON s.id = t.submission_id WHERE t.subreddit = ? ORDER BY t.submission_id",
+            (subreddit,)
+        )
+        for submission_id, title, selftext in threads:
+            bodies = [body for body, in self.db.execute(
+                "SELECT body FROM comments WHERE submission_id = ? ORDER BY created, id", (submission_id,)
+            )]
+            yield submission_id, title, selftext, bodies
+
+    def finish(self):
+        # Advances the high-water marks and clears the touched set once outputs are written
+        self.db.executemany(
+            "INSERT INTO watermarks VALUES (?, ?, ?) ON CONFLICT (subreddit, kind) "
+            "DO UPDATE SET created = MAX(created, excluded.created)",
+            [(subreddit, kind, created) for (subreddit, kind), created in self.seen.items()]
+        )
+        self.db.execute("DELETE FROM touched")
+        self.commit()
+        for key, created in self.seen.items():
+            self.watermarks[key] = max(self.watermarks.get(key, created), created)
+        self.seen = {}
+        logging.info(f"Ingested {self.counts['submissions']} new submissions and {self.counts['comments']} new "
+                     f"comments; {self.counts['old']} records were below the high-water marks")
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class StoreWriter:
+    # Stands in for a SpillWriter in combine_submissions_comments.spill_file: parsed records
+    # go into the ingest store instead of partition files
+    def __init__(self, add):
+        self.add = add
+
+    def write(self, partition, lines):
+        for line in lines:
+            self.add(json.loads(line))
@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+# Shared LLM call instrumentation: in-process counters and histograms (rendered in the
+# Prometheus text format by server.py's /metrics), sampled structured JSON logs of
+# individual calls, and a run summary for batch jobs. With several server worker processes
+# each one publishes its metrics to METRICS_MULTIPROC_DIR and /metrics merges them all.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+
+# Share of successful calls logged; failed calls are always logged
+LLM_LOG_SAMPLE_RATE = float(os.getenv('LLM_LOG_SAMPLE_RATE', '0.01'))
+# Optional file for the JSON call log (one object per line); otherwise the 'llm_calls' logger
+# propagates to the root handler
+LLM_LOG_PATH = os.getenv('LLM_LOG_PATH')
+# Directory shared by the server's worker processes (serve.py sets it when running several)
+# and how often, in seconds, each worker publishes its metrics there
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR')
+METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', '1'))
+
+event_logger = logging.getLogger('llm_calls')
+if LLM_LOG_PATH:
+    _handler = logging.FileHandler(LLM_LOG_PATH)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    event_logger.addHandler(_handler)
+    event_logger.setLevel(logging.INFO)
+    event_logger.propagate = False
+
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    # Counters, gauges and fixed-bucket histograms keyed by (name, labels). Pool workers
+    # drain() theirs and the dispatching process merge()s the snapshots.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, labels, value):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, labels, value):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # per-bucket counts, then +Inf, sum
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(LATENCY_BUCKETS)] += 1
+            histogram[-1] += value
+
+    def drain(self):
+        with self.lock:
+            snapshot = {'counters': self.counters, 'histograms': self.histograms}
+            self.counters, self.histograms = {}, {}
+        return snapshot
+
+    def snapshot(self):
+        # Copy of the counters and histograms, leaving them in place
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {key: list(values) for key, values in self.histograms.items()}}
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in snapshot['histograms'].items():
+                current = self.histograms.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+                for i, value in enumerate(values):
+                    current[i] += value
+
+    def quantile(self, name, labels, q):
+        # Upper bound of the bucket holding the q-th observation
+        histogram = self.histograms.get((name, label_key(labels)))
+        if not histogram:
+            return None
+        total = sum(histogram[:-1])
+        seen = 0
+        for i, count in enumerate(histogram[:-1]):
+            seen += count
+            if seen >= q * total:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+        return None
+
+    def render(self):
+        # Prometheus text exposition format
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{fmt(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} gauge")
+                    typed.add(name)
+                lines.append(f"{name}{fmt(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{fmt(labels)} {histogram[-1]}")
+                lines.append(f"{name}_count{fmt(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def publish(directory=None, metrics=None):
+    # Writes this process's counters and histograms to <directory>/<pid>.json. Files of
+    # exited workers are kept so merged counters never go backwards.
+    directory = directory or METRICS_MULTIPROC_DIR
+    snapshot = (metrics or METRICS).snapshot()
+    data = {kind: [[name, list(labels), value] for (name, labels), value in entries.items()]
+            for kind, entries in snapshot.items()}
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+    os.replace(path + '.tmp', path)
+
+
+def collect(directory=None, metrics=None):
+    # Metrics merging every worker's published snapshot, with this process's gauges (which
+    # /metrics sets from shared stores just before rendering)
+    directory = directory or METRICS_MULTIPROC_DIR
+    metrics = metrics or METRICS
+    publish(directory, metrics)
+    merged = Metrics()
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            logging.warning(f"Skipping unreadable metrics snapshot {filename}")
+            continue
+        merged.merge({kind: {(name, tuple(map(tuple, labels))): value for name, labels, value in entries}
+                      for kind, entries in data.items()})
+    with metrics.lock:
+        merged.gauges = dict(metrics.gauges)
+    return merged
+
+
+def start_publisher(directory=None, interval=None):
+    # Daemon thread publishing this process's metrics every interval seconds
+    directory = directory or METRICS_MULTIPROC_DIR
+    interval = interval or METRICS_PUBLISH_INTERVAL
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                publish(directory)
+            except OSError as e:
+                logging.warning(f"Could not publish metrics to {directory}: {e}")
+
+    threading.Thread(target=run, name='metrics-publisher', daemon=True).start()
+
+
+def usage_of(response):
+    # (prompt, completion, cached) tokens from a raw response dict or an openai response object
+    if response is None:
+        return 0, 0, 0
+    usage = response.get('usage') if isinstance(response, dict) else getattr(response, 'usage', None)
+    if usage is None:
+        return 0, 0, 0
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, 'model_dump') else vars(usage)
+    cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+    return usage.get('prompt_tokens') or 0, usage.get('completion_tokens') or 0, cached
+
+
+def record_llm_call(component, operation, status, latency=None, queue_wait=None, retries=0, response=None,
+                    error=None, **fields):
+    # One finished LLM call (after its retries). latency/queue_wait are None when unknown,
+    # e.g. for Batch API results.
+    prompt_tokens, completion_tokens, cached_tokens = usage_of(response)
+    labels = {'component': component, 'operation': operation}
+    METRICS.inc('llm_requests_total', dict(labels, status=status))
+    if retries:
+        METRICS.inc('llm_retries_total', labels, retries)
+    if prompt_tokens:
+        METRICS.inc('llm_prompt_tokens_total', labels, prompt_tokens)
+        METRICS.inc('llm_cached_tokens_total', labels, cached_tokens)
+    if completion_tokens:
+        METRICS.inc('llm_completion_tokens_total', labels, completion_tokens)
+    if latency is not None:
+        METRICS.observe('llm_request_seconds', labels, latency)
+    if queue_wait is not None:
+        METRICS.observe('llm_queue_wait_seconds', labels, queue_wait)
+
+    if status != 'ok' or random.random() < LLM_LOG_SAMPLE_RATE:
+        event = {
+            'ts': round(time.time(), 3), 'component': component, 'operation': operation, 'status': status,
+            'latency': round(latency, 4) if latency is not None else None,
+            'queue_wait': round(queue_wait, 4) if queue_wait is not None else None,
+            'retries': retries, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'cached_tokens': cached_tokens,
+        }
+        if error is not None:
+            event['error'] = str(error)[:500]
+        event.update(fields)
+        event_logger.info(json.dumps(event, default=str))
+
+
+class CallRecord:
+    def __init__(self):
+        self.response = None
+        self.retries = 0
+        self.queue_wait = None
+        self.fields = {}
+
+
+@contextmanager
+def llm_call(component, operation, queue_wait=None, **fields):
+    # Times the block; set call.response (and optionally call.retries) inside it
+    call = CallRecord()
+    call.queue_wait = queue_wait
+    call.fields.update(fields)
+    started = time.monotonic()
+    try:
+        yield call
+    except Exception as e:
+        record_llm_call(component, operation, 'error', time.monotonic() - started, call.queue_wait, call.retries,
+                        call.response, error=f"{type(e).__name__}: {e}", **call.fields)
+        raise
+    record_llm_call(component, operation, 'ok', time.monotonic() - started, call.queue_wait, call.retries,
+                    call.response, **call.fields)
+
+
+def chat_completion(component, operation, **kwargs):
+    # openai.chat.completions.create with instrumentation; uses the caller's module-level
+    # openai configuration
+    import openai
+
+    with llm_call(component, operation) as call:
+        call.response = openai.chat.completions.create(**kwargs)
+    return call.response
+
+
+async def achat_completion(client, component, operation, **kwargs):
+    # Same for an async openai client
+    with llm_call(component, operation) as call:
+        call.response = await client.chat.completions.create(**kwargs)
+    return call.response
+
+
+def summary(metrics=None):
+    # Per component/operation totals for end-of-run reporting
+    metrics = metrics or METRICS
+    rows = {}
+    with metrics.lock:
+        for (name, labels), value in metrics.counters.items():
+            labels = dict(labels)
+            key = f"{labels.get('component')}/{labels.get('operation')}"
+            row = rows.setdefault(key, {'requests': 0, 'errors': 0})
+            if name == 'llm_requests_total':
+                row['requests'] += value
+                if labels.get('status') != 'ok':
+                    row['errors'] += value
+            else:
+                field = name[len('llm_'):-len('_total')]
+                row[field] = row.get(field, 0) + value
+    for key, row in rows.items():
+        component, operation = key.split('/', 1)
+        labels = {'component': component, 'operation': operation}
+        for name, short in (('llm_request_seconds', 'latency'), ('llm_queue_wait_seconds', 'queue_wait')):
+            for q in (0.5, 0.95):
+                value = metrics.quantile(name, labels, q)
+                if value is not None:
+                    row[f"{short}_p{int(q * 100)}_le"] = value
+    return rows
@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import threading
+import multiprocessing
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+PENDING = (QUEUED, RUNNING)
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def theme_report(params, progress):
+    from subtopics import build_theme_report
+
+    return build_theme_report(params['input'], params.get('subreddit'), progress)
+
+
+# Job kind -> handler(params, progress). Handlers run in worker processes; progress(stage,
+# done, total) raises JobCancelled once the job has been cancelled.
+HANDLERS = {
+    'theme_report': theme_report,
+}
+
+
+def dedup_key(kind, params):
+    return hashlib.sha256(json.dumps([kind, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class JobStore:
+    # Persistent job state in SQLite, shared by the web processes that submit jobs and the
+    # worker processes that run them. Every connection is short-lived, so any process can
+    # open the same file.
+    def __init__(self, path, stale_after=300, max_attempts=3):
+        self.path = path
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, dedup_key TEXT NOT NULL, "
+                "status TEXT NOT NULL, cancel_requested INTEGER NOT NULL DEFAULT 0, stage TEXT, "
+                "done INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, created REAL NOT NULL, started REAL, "
+                "heartbeat REAL, finished REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, created)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, status)")
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def submit(self, kind, params):
+        # (job id, created); an identical queued or running job is reused instead of adding
+        # another
+        if kind not in HANDLERS:
+            raise ValueError(f"Unknown job kind {kind!r}")
+        key = dedup_key(kind, params)
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                f"SELECT id FROM jobs WHERE dedup_key = ? AND status IN ({','.join('?' * len(PENDING))}) "
+                "AND cancel_requested = 0 ORDER BY created LIMIT 1", (key, *PENDING)
+            ).fetchone()
+            if row is not None:
+                db.execute("COMMIT")
+                return row['id'], False
+            job_id = uuid.uuid4().hex
+            db.execute(
+                "INSERT INTO jobs (id, kind, params, dedup_key, status, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(params), key, QUEUED, time.time())
+            )
+            db.execute("COMMIT")
+            return job_id, True
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def get(self, job_id, with_result=False):
+        db = self.connect()
+        try:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        job = {
+            'id': row['id'], 'kind': row['kind'], 'params': json.loads(row['params']), 'status': row['status'],
+            'progress': {'stage': row['stage'], 'done': row['done'], 'total': row['total']},
+            'cancel_requested': bool(row['cancel_requested']), 'error': row['error'], 'attempts': row['attempts'],
+            'created': row['created'], 'started': row['started'], 'finished': row['finished'],
+        }
+        if with_result:
+            job['result'] = json.loads(row['result']) if row['result'] is not None else None
+        return job
+
+    def cancel(self, job_id):
+        # Queued jobs are cancelled immediately; running ones at their next progress report.
+        # Returns the job's status afterwards, or None for an unknown job.
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            status = row['status']
+            if status == QUEUED:
+                db.execute("UPDATE jobs SET status = ?, cancel_requested = 1, finished = ? WHERE id = ?",
+                           (CANCELLED, time.time(), job_id))
+                status = CANCELLED
+            elif status == RUNNING:
+                db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            db.execute("COMMIT")
+            return status
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def claim(self, worker):
+        # Oldest queued job, atomically marked running for this worker. Running jobs whose
+        # worker stopped heartbeating (crashed or killed) are requeued first, or failed once
+        # they have used up max_attempts, so a job that kills its worker cannot loop forever.
+        now = time.time()
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, finished = ?, heartbeat = NULL, error = ? "
+                "WHERE status = ? AND heartbeat < ? AND attempts >= ?",
+                (FAILED, now, f"Worker stopped responding on all {self.max_attempts} attempts", RUNNING,
+                 now - self.stale_after, self.max_attempts)
+            )
+            db.execute("UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat < ?",
+                       (QUEUED, RUNNING, now - self.stale_after))
+            row = db.execute("SELECT id, kind, params FROM jobs WHERE status = ? ORDER BY created LIMIT 1",
+                             (QUEUED,)).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute(
+                "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, started = ?, heartbeat = ? "
+                "WHERE id = ?", (RUNNING, worker, now, now, row['id'])
+            )
+            db.execute("COMMIT")
+            return row['id'], row['kind'], json.loads(row['params'])
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def progress(self, job_id, stage, done=0, total=0):
+        # Records progress and doubles as the heartbeat; False once cancellation was requested
+        db = self.connect()
+        try:
+            db.execute("UPDATE jobs SET stage = ?, done = ?, total = ?, heartbeat = ? WHERE id = ?",
+                       (stage, done, total, time.time(), job_id))
+            row = db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            db.close()
+        return not (row and row['cancel_requested'])
+
+    def finish(self, job_id, status, result=None, error=None):
+        db = self.connect()
+        try:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, heartbeat = NULL WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+            )
+        finally:
+            db.close()
+
+    def counts(self):
+        db = self.connect()
+        try:
+            return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        finally:
+            db.close()
+
+    def purge(self, older_than):
+        # Deletes finished jobs (and their results) older than older_than seconds
+        db = self.connect()
+        try:
+            placeholders = ','.join('?' * len(FINISHED))
+            return db.execute(f"DELETE FROM jobs WHERE status IN ({placeholders}) AND finished < ?",
+                              (*FINISHED, time.time() - older_than)).rowcount
+        finally:
+            db.close()
+
+
+def run_job(store, job_id, kind, params, heartbeat_interval=30):
+    def progress(stage, done=0, total=0):
+        if not store.progress(job_id, stage, done, total):
+            raise JobCancelled()
+
+    # Keep the heartbeat going while a handler is inside one long call
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(heartbeat_interval):
+            db = store.connect()
+            try:
+                db.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = ?", (time.time(), job_id, RUNNING))
+            finally:
+                db.close()
+
+    threading.Thread(target=beat, daemon=True).start()
+    started = time.monotonic()
+    try:
+        result = HANDLERS[kind](params, progress)
+    except JobCancelled:
+        store.finish(job_id, CANCELLED)
+        logging.info(f"Job {job_id} cancelled")
+        return
+    except Exception as e:
+        store.finish(job_id, FAILED, error=f"{type(e).__name__}: {e}")
+        logging.exception(f"Job {job_id} failed")
+        return
+    finally:
+        stop.set()
+    store.finish(job_id, SUCCEEDED, result=result)
+    logging.info(f"Job {job_id} ({kind}) finished in {time.monotonic() - started:.1f}s")
+
+
+def worker_loop(path, poll_interval=1.0, stale_after=300, stop=None, max_attempts=3):
+    # One worker process: claim, run, repeat
+    store = JobStore(path, stale_after, max_attempts)
+    worker = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+    while stop is None or not stop.is_set():
+        claimed = store.claim(worker)
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+        run_job(store, *claimed, heartbeat_interval=max(1, stale_after / 10))
+
+
+class WorkerPool:
+    # Local worker processes started on first use. Processes are spawned rather than forked
+    # so they never inherit the web process's threads, event loop or open connections.
+    def __init__(self, path, workers=2, poll_interval=1.0, stale_after=300, max_attempts=3):
+        self.path = path
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.processes = []
+        self.pid = None
+
+    def ensure_started(self):
+        with self.lock:
+            if self.pid == os.getpid() and all(p.is_alive() for p in self.processes):
+                return
+            context = multiprocessing.get_context('spawn')
+            if self.pid != os.getpid():
+                self.processes = []
+                self.stop = context.Event()
+            self.processes = [p for p in self.processes if p.is_alive()]
+            while len(self.processes) < self.workers:
+                process = context.Process(target=worker_loop, daemon=True, name="job-worker",
+                                          args=(self.path, self.poll_interval, self.stale_after, self.stop,
+                                                self.max_attempts))
+                process.start()
+                self.processes.append(process)
+            self.pid = os.getpid()
+
+    def shutdown(self, timeout=10):
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.stop.set()
+            for process in self.processes:
+                process.join(timeout)
+            self.processes = []
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # Standalone workers, e.g. on another machine sharing the job database, or when the web
+    # server runs with JOB_WORKERS=0
+    parser = argparse.ArgumentParser(description="Run background job workers")
+    parser.add_argument("--db", default=os.getenv('JOB_DB_PATH', 'jobs/jobs.sqlite3'))
+    parser.add_argument("--workers", type=int, default=int(os.getenv('JOB_WORKERS', '2')))
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--stale-after", type=float, default=300, help="Requeue running jobs silent this long")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Fail a job after its worker stopped responding this many times")
+    parser.add_argument("--purge-days", type=float, help="Delete finished jobs older than this and exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.purge_days is not None:
+        print(f"Purged {JobStore(args.db).purge(args.purge_days * 86400)} jobs")
+    else:
+        pool = WorkerPool(args.db, args.workers, args.poll_interval, args.stale_after, args.max_attempts)
+        pool.ensure_started()
+        try:
+            for process in pool.processes:
+                process.join()
+        except KeyboardInterrupt:
+            pool.shutdown()
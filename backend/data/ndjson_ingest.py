@@ -0,0 +1,123 @@
+import io
+import os
+import json
+import zlib
+import queue
+
+# orjson is several times faster on Pushshift lines; json is the fallback
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def open_text(path):
+    # Plain or zstd-compressed (.zst, as distributed by Pushshift) NDJSON
+    if path.endswith('.zst'):
+        import zstandard
+
+        stream = zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(open(path, 'rb'))
+        return io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8')
+
+
+def byte_ranges(path, block_bytes=BLOCK_BYTES):
+    # Splits an uncompressed file into [start, end) ranges; read_range realigns them on lines
+    size = os.path.getsize(path)
+    return [(start, min(start + block_bytes, size)) for start in range(0, size, block_bytes)]
+
+
+def read_range(path, start, end):
+    # Lines whose first byte lies in [start, end); the line straddling start belongs to
+    # the previous range
+    lines = []
+    with open(path, 'rb') as file:
+        if start > 0:
+            file.seek(start - 1)
+            file.readline()
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                break
+            lines.append(line)
+    return lines
+
+
+def iter_line_blocks(path, block_bytes=BLOCK_BYTES):
+    # Sequential blocks of raw lines, for inputs that cannot be split by offset (.zst)
+    block, size = [], 0
+    with open_text(path) as file:
+        for line in file:
+            block.append(line)
+            size += len(line)
+            if size >= block_bytes:
+                yield block
+                block, size = [], 0
+    if block:
+        yield block
+
+
+def iter_tasks(path, block_bytes=BLOCK_BYTES):
+    # Work items for parse workers: ('range', path, start, end) for plain files, or
+    # ('lines', lines) blocks for compressed files
+    if path.endswith('.zst'):
+        for block in iter_line_blocks(path, block_bytes):
+            yield ('lines', block)
+    else:
+        for start, end in byte_ranges(path, block_bytes):
+            yield ('range', path, start, end)
+
+
+def task_lines(task):
+    if task[0] == 'range':
+        return read_range(task[1], task[2], task[3])
+    return task[1]
+
+
+def partition_of(key, partitions):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(key.encode('utf-8')) % partitions
+
+
+def bounded_imap_unordered(pool, func, iterable, max_pending):
+    # Pool.imap_unordered that only pulls the next task once fewer than max_pending are
+    # outstanding (imap_unordered drains the whole iterable up front), so decompressed
+    # blocks or queued rows do not pile up in memory. Also used by generation.py.
+    results = queue.Queue()
+    pending = 0
+    for item in iterable:
+        if pending >= max_pending:
+            yield results.get()
+            pending -= 1
+        pool.apply_async(func, (item,), callback=results.put, error_callback=results.put)
+        pending += 1
+    while pending:
+        yield results.get()
+        pending -= 1
+
+
+class SpillWriter:
+    # Appends JSON lines to one file per partition under directory/<prefix>-NNN.jsonl
+    def __init__(self, directory, prefix, partitions):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f"{prefix}-{p:03d}.jsonl") for p in range(partitions)]
+        self.files = [open(path, 'w', encoding='utf-8') for path in self.paths]
+
+    def write(self, partition, lines):
+        self.files[partition].writelines(lines)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+
+def read_spill(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            yield json.loads(line)
@@ -0,0 +1,358 @@
+import os
+import re
+import csv
+import sys
+import time
+import json
+import zlib
+import sqlite3
+import hashlib
+import logging
+import itertools
+import numpy as np
+
+from run_manifest import DONE, EMPTY, row_digest
+
+# Comment threads can be far larger than the csv module's default field limit
+csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+ROW_FIELDS = ('id', 'title', 'selftext', 'body')
+WORD_RE = re.compile(r'[a-z0-9]+')
+URL_RE = re.compile(r'https?://\S+')
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def row_text(row):
+    return f"{row.get('title', '')}\n{row.get('selftext', '')}\n{row.get('body', '')}"
+
+
+def shingles(text, size=5):
+    # Hashed word shingles; URLs are dropped so the same post with different tracking
+    # parameters still matches. Texts shorter than one shingle hash as a whole.
+    words = WORD_RE.findall(URL_RE.sub(' ', text.lower()))
+    if len(words) < size:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))} if words else set()
+    return {zlib.crc32(' '.join(words[i:i + size]).encode('utf-8')) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    # num_perm universal hashes (a * x + b) mod p over 32-bit shingle hashes; a and b stay
+    # below 2**32 so the products fit in uint64
+    def __init__(self, num_perm=128, seed=1):
+        generator = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = generator.randint(1, 2 ** 32, size=num_perm, dtype=np.uint64)
+        self.b = generator.randint(0, 2 ** 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes):
+        values = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+        permuted = (values[:, None] * self.a + self.b) % np.uint64(MERSENNE_PRIME)
+        return (permuted & np.uint64(0xFFFFFFFF)).astype(np.uint32).min(axis=0)
+
+
+def similarity(a, b):
+    # Estimated Jaccard similarity of two signatures
+    return float(np.mean(a == b))
+
+
+class NearDupIndex:
+    # MinHash/LSH index of ingested rows in SQLite, so memory stays flat however many rows
+    # go through it. Each row is either a representative or a duplicate linked to one.
+    # Signatures are split into bands of rows_per_band values; every representative is
+    # filed under its band buckets, rows sharing any bucket are candidates, and a candidate
+    # within threshold (estimated Jaccard) is a duplicate. A row whose digest changed since
+    # it was indexed is placed again.
+    def __init__(self, path, threshold=0.8, num_perm=128, bands=16, shingle_size=5, commit_every=1000):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_perm)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # linked: when the row was last placed, so fan_out refreshes rows moved to another
+        # representative
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "id INTEGER PRIMARY KEY, subreddit TEXT NOT NULL, row_id TEXT NOT NULL, rep INTEGER, "
+            "similarity REAL, signature BLOB, digest TEXT, linked REAL, UNIQUE (subreddit, row_id))"
+        )
+        columns = [c[1] for c in self.db.execute("PRAGMA table_info(documents)")]
+        for column, kind in (('digest', 'TEXT'), ('linked', 'REAL')):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE documents ADD COLUMN {column} {kind}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS documents_rep ON documents (rep)")
+        buckets = self.db.execute("SELECT sql FROM sqlite_master WHERE name = 'buckets'").fetchone()
+        rebuild = buckets is not None and 'key INTEGER PRIMARY KEY' in buckets[0]
+        if rebuild:
+            # Indexes from before buckets held every representative kept only the first per bucket
+            self.db.execute("DROP TABLE buckets")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key INTEGER NOT NULL, doc INTEGER NOT NULL, "
+            "PRIMARY KEY (key, doc)) WITHOUT ROWID"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS buckets_doc ON buckets (doc)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        settings = json.dumps([num_perm, bands, shingle_size])
+        stored = self.db.execute("SELECT value FROM settings WHERE name = 'minhash'").fetchone()
+        if stored is None:
+            self.db.execute("INSERT INTO settings VALUES ('minhash', ?)", (settings,))
+        elif stored[0] != settings:
+            raise ValueError(f"{path} was built with num_perm, bands, shingle_size = {stored[0]}")
+        if rebuild:
+            for doc, blob in self.db.execute(
+                "SELECT id, signature FROM documents WHERE rep IS NULL AND signature IS NOT NULL"
+            ).fetchall():
+                self.file(doc, np.frombuffer(blob, dtype=np.uint32))
+        self.db.commit()
+
+    def band_keys(self, signature):
+        keys = []
+        for band in range(self.bands):
+            values = signature[band * self.rows_per_band:(band + 1) * self.rows_per_band]
+            digest = hashlib.blake2b(band.to_bytes(2, 'little') + values.tobytes(), digest_size=8).digest()
+            keys.append(int.from_bytes(digest, 'little', signed=True))
+        return keys
+
+    def signature(self, text):
+        # None for texts too short to compare
+        hashes = shingles(text, self.shingle_size)
+        return self.hasher.signature(hashes) if hashes else None
+
+    def add(self, subreddit, row_id, text, digest=None):
+        # None when the row is kept (new representative, too short to compare, or already
+        # indexed as one), otherwise the (subreddit, row_id) of its representative. digest
+        # (default: a hash of text) identifies the row's content; rows indexed before
+        # digests were stored adopt their current one.
+        row_id = str(row_id)
+        digest = digest or hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        known = self.db.execute(
+            "SELECT d.id, d.rep, d.digest, r.subreddit, r.row_id FROM documents d "
+            "LEFT JOIN documents r ON r.id = d.rep WHERE d.subreddit = ? AND d.row_id = ?", (subreddit, row_id)
+        ).fetchone()
+        if known is None:
+            signature = self.signature(text)
+            doc = self.insert(subreddit, row_id, signature, digest)
+            return self.place(doc, signature)
+
+        doc, rep, stored, rep_subreddit, rep_row_id = known
+        if stored is None:
+            self.db.execute("UPDATE documents SET digest = ? WHERE id = ?", (digest, doc))
+        if stored in (None, digest):
+            return None if rep is None else (rep_subreddit, rep_row_id)
+        return self.replace(doc, self.signature(text), digest)
+
+    def insert(self, subreddit, row_id, signature, digest):
+        cursor = self.db.execute(
+            "INSERT INTO documents (subreddit, row_id, signature, digest) VALUES (?, ?, ?, ?)",
+            (subreddit, row_id, None if signature is None else signature.tobytes(), digest)
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+        return cursor.lastrowid
+
+    def place(self, doc, signature):
+        # Links an unlinked document to its most similar representative, or makes it one
+        # filed under its band buckets; returns the representative's (subreddit, row_id)
+        if signature is None:
+            return None
+        keys = self.band_keys(signature)
+        candidates = self.db.execute(
+            f"SELECT DISTINCT d.id, d.subreddit, d.row_id, d.signature FROM buckets b JOIN documents d ON d.id = b.doc "
+            f"WHERE b.key IN ({','.join('?' * len(keys))}) AND d.id != ?", keys + [doc]
+        ).fetchall()
+        best = None
+        for candidate, rep_subreddit, rep_row_id, blob in candidates:
+            score = similarity(signature, np.frombuffer(blob, dtype=np.uint32))
+            if score >= self.threshold and (best is None or score > best[0]):
+                best = (score, candidate, rep_subreddit, rep_row_id)
+        if best is not None:
+            self.db.execute("UPDATE documents SET rep = ?, similarity = ?, linked = ? WHERE id = ?",
+                            (best[1], best[0], time.time(), doc))
+            return best[2], best[3]
+        self.db.execute("UPDATE documents SET linked = ? WHERE id = ?", (time.time(), doc))
+        self.file(doc, signature)
+        return None
+
+    def file(self, doc, signature):
+        self.db.executemany("INSERT OR IGNORE INTO buckets VALUES (?, ?)",
+                            [(key, doc) for key in self.band_keys(signature)])
+
+    def replace(self, doc, signature, digest):
+        # The row's content changed: place it again from its new signature. When it was a
+        # representative its duplicates are placed again too, against the updated index;
+        # ones indexed before duplicates kept signatures follow it.
+        self.db.execute("DELETE FROM buckets WHERE doc = ?", (doc,))
+        self.db.execute(
+            "UPDATE documents SET rep = NULL, similarity = NULL, signature = ?, digest = ? WHERE id = ?",
+            (None if signature is None else signature.tobytes(), digest, doc)
+        )
+        orphans = self.db.execute("SELECT id, signature FROM documents WHERE rep = ?", (doc,)).fetchall()
+        self.db.execute("UPDATE documents SET rep = NULL, similarity = NULL WHERE rep = ?", (doc,))
+        result = self.place(doc, signature)
+        new_rep = self.db.execute("SELECT rep FROM documents WHERE id = ?", (doc,)).fetchone()[0]
+        for orphan, blob in orphans:
+            if blob is not None:
+                self.place(orphan, np.frombuffer(blob, dtype=np.uint32))
+            else:
+                self.db.execute("UPDATE documents SET rep = ?, linked = ? WHERE id = ?",
+                                (new_rep or doc, time.time(), orphan))
+        self.commit()
+        return result
+
+    def duplicates(self, rep_subreddit):
+        # {representative row id: [(subreddit, row id, digest, linked)]} for one subreddit's
+        # representatives
+        links = {}
+        for rep_row_id, subreddit, row_id, digest, linked in self.db.execute(
+            "SELECT r.row_id, d.subreddit, d.row_id, d.digest, d.linked FROM documents d "
+            "JOIN documents r ON r.id = d.rep WHERE r.subreddit = ? ORDER BY r.row_id", (rep_subreddit,)
+        ):
+            links.setdefault(rep_row_id, []).append((subreddit, row_id, digest, linked))
+        return links
+
+    def rep_subreddits(self):
+        # Subreddits holding at least one representative with duplicates
+        return [s for s, in self.db.execute(
+            "SELECT DISTINCT r.subreddit FROM documents d JOIN documents r ON r.id = d.rep ORDER BY r.subreddit"
+        )]
+
+    def report(self):
+        # {subreddit: {rows, duplicates, ratio}}; a cross-post counts against the subreddit
+        # it was dropped from
+        return {
+            subreddit: {"rows": rows, "duplicates": duplicates, "ratio": round(duplicates / rows, 4)}
+            for subreddit, rows, duplicates in self.db.execute(
+                "SELECT subreddit, COUNT(*), COUNT(rep) FROM documents GROUP BY subreddit ORDER BY subreddit"
+            )
+        }
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def dedup_file(path, subreddit, index):
+    # Rewrites a *_llm.csv in place without the rows the index marks as duplicates
+    temp_path = f"{path}.dedup"
+    kept = dropped = 0
+    with open(path, 'r', newline='', encoding='utf-8') as source, \
+            open(temp_path, 'w', newline='', encoding='utf-8') as target:
+        reader = csv.DictReader(source)
+        writer = csv.DictWriter(target, fieldnames=reader.fieldnames or list(ROW_FIELDS))
+        writer.writeheader()
+        for record in reader:
+            if index.add(subreddit, record['id'], row_text(record), row_digest(record)) is None:
+                writer.writerow(record)
+                kept += 1
+            else:
+                dropped += 1
+    os.replace(temp_path, path)
+    index.commit()
+    logging.info(f"Near-duplicates: kept {kept} and dropped {dropped} rows of {subreddit}")
+    return kept, dropped
+
+
+def dedup_files(paths, index):
+    # paths: {subreddit: csv path}. Files are processed in subreddit order, so the
+    # representative of a cross-post cluster is its first copy in that order.
+    for subreddit in sorted(paths):
+        dedup_file(paths[subreddit], subreddit, index)
+    return index.report()
+
+
+def rep_analyses(location, load, subreddit, row_ids):
+    # (row id, analysis) for the wanted representatives of one subreddit
+    if load is not None:
+        yield from load(subreddit, row_ids).items()
+        return
+    from output_store import read_records, records_to_analysis
+
+    # One pass over the subreddit in the output store
+    current, records = None, []
+    for record in itertools.chain(read_records(location, subreddit), [None]):
+        row_id = record['row_id'] if record is not None else None
+        if row_id != current and records:
+            yield current, records_to_analysis(records)
+            records = []
+        current = row_id
+        if record is not None and row_id in row_ids:
+            records.append(record)
+
+
+def fan_out(index, manifest, sink, location, load=None):
+    # Copies each representative's settled result (done or empty) to its duplicates, in the
+    # sink and the run manifest. A duplicate is refreshed whenever its representative was
+    # recorded, or it was linked, after it, so reprocessed representatives and re-placed
+    # duplicates propagate on the next run. Duplicates are recorded with their own digest,
+    # so one that later stops being a duplicate is processed when its text changed. Results
+    # are read back from the output store at location, or with load(subreddit, row ids) ->
+    # {row id: analysis} when the sink does not write a single store (topics.TopicSinks).
+    counts = {"copied": 0, "empty": 0}
+    for rep_subreddit in index.rep_subreddits():
+        copies = {}
+        for rep_row_id, duplicates in index.duplicates(rep_subreddit).items():
+            rep = manifest.entry(rep_subreddit, rep_row_id)
+            if rep is None or rep[0] not in (DONE, EMPTY):
+                continue
+            stale = []
+            for subreddit, row_id, digest, linked in duplicates:
+                entry = manifest.entry(subreddit, row_id)
+                if entry is None or entry[2] < rep[2] or (linked is not None and entry[2] < linked):
+                    stale.append((subreddit, row_id, digest))
+            if not stale:
+                continue
+            if rep[0] == EMPTY:
+                for subreddit, row_id, digest in stale:
+                    # An empty write clears quotes the duplicate had from an earlier result
+                    sink.write(subreddit, row_id, {})
+                    manifest.record(subreddit, row_id, EMPTY, f"duplicate of {rep_subreddit}/{rep_row_id}", digest)
+                counts["empty"] += len(stale)
+            else:
+                copies[rep_row_id] = stale
+
+        if not copies:
+            continue
+        for rep_row_id, analysis in rep_analyses(location, load, rep_subreddit, copies):
+            for subreddit, duplicate_id, digest in copies[rep_row_id]:
+                sink.write(subreddit, duplicate_id, analysis)
+                manifest.record(subreddit, duplicate_id, DONE, f"duplicate of {rep_subreddit}/{rep_row_id}", digest)
+            counts["copied"] += len(copies[rep_row_id])
+    sink.flush()
+    manifest.commit()
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Drop near-duplicate rows from *_llm.csv inputs before generation")
+    parser.add_argument("input_dir", help="Directory of <subreddit>_llm.csv files (rewritten in place)")
+    parser.add_argument("--index", help="Index path (default: <input_dir>/near_dup.sqlite3)")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Estimated Jaccard similarity for a duplicate")
+    parser.add_argument("--report", action="store_true", help="Only print the per-subreddit dedup ratios")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    index = NearDupIndex(args.index or os.path.join(args.input_dir, 'near_dup.sqlite3'), args.threshold)
+    try:
+        if not args.report:
+            started = time.time()
+            dedup_files({f[:-len('_llm.csv')]: os.path.join(args.input_dir, f)
+                         for f in os.listdir(args.input_dir) if f.endswith('_llm.csv')}, index)
+            logging.info(f"Deduplicated {args.input_dir} in {time.time() - started:.1f}s")
+        print(json.dumps(index.report(), indent=2))
+    finally:
+        index.close()
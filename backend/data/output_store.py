@@ -0,0 +1,328 @@
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+import logging
+
+CATEGORIES = ('anecdotes', 'media_reports', 'opinions', 'other')
+RECORD_FIELDS = ('row_id', 'subreddit', 'category', 'position', 'quote', 'summary')
+# Parquet marker for a row whose latest result is empty; it hides the row's older parts
+TOMBSTONE_CATEGORY = ''
+OUTPUT_FILE_RE = re.compile(r'^output-(.+)\.json$')
+
+
+def analysis_records(subreddit, row_id, analysis):
+    # Flattens an AIImpactAnalysis dict into one record per quote
+    records = []
+    for category in CATEGORIES:
+        for position, entry in enumerate(analysis.get(category) or []):
+            records.append({
+                'row_id': str(row_id),
+                'subreddit': subreddit,
+                'category': category,
+                'position': position,
+                'quote': entry.get('quote', ''),
+                'summary': entry.get('summary', ''),
+            })
+    return records
+
+
+def quote_id(record):
+    # Stable ID of one extracted quote: <subreddit>/<row id>/<category>/<position>
+    return f"{record['subreddit']}/{record['row_id']}/{record['category']}/{record['position']}"
+
+
+def records_to_analysis(records):
+    analysis = {category: [] for category in CATEGORIES}
+    for record in sorted(records, key=lambda r: (CATEGORIES.index(r['category']), r['position'])):
+        analysis[record['category']].append({'quote': record['quote'], 'summary': record['summary']})
+    return analysis
+
+
+class JsonDirSink:
+    # The original layout: <output_dir>/<subreddit>/output-<id>.json, one file per row.
+    # Sinks return whether anything was saved; an empty analysis clears the row's earlier
+    # output, so a re-extraction that finds nothing does not leave stale quotes behind.
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def write(self, subreddit, row_id, analysis):
+        output_subdir = os.path.join(self.output_dir, subreddit)
+        output_path = os.path.join(output_subdir, f'output-{row_id}.json')
+        if not analysis_records(subreddit, row_id, analysis):
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return False
+        os.makedirs(output_subdir, exist_ok=True)
+        with open(output_path, 'w') as file:
+            json.dump(analysis, file, indent=4)
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteSink:
+    # All records in one table; rewriting a row replaces its previous records
+    def __init__(self, path, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self.buffer = []
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS quotes ("
+            "row_id TEXT NOT NULL, subreddit TEXT NOT NULL, category TEXT NOT NULL, position INTEGER NOT NULL, "
+            "quote TEXT NOT NULL, summary TEXT NOT NULL, PRIMARY KEY (subreddit, row_id, category, position))"
+        )
+        self.db.commit()
+
+    def write(self, subreddit, row_id, analysis):
+        records = analysis_records(subreddit, row_id, analysis)
+        # Empty rows are buffered too: flushing them deletes their previous records
+        self.buffer.append((subreddit, str(row_id), records))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        return bool(records)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with self.db:
+            self.db.executemany("DELETE FROM quotes WHERE subreddit = ? AND row_id = ?",
+                                [(subreddit, row_id) for subreddit, row_id, _ in self.buffer])
+            self.db.executemany(
+                "INSERT INTO quotes (row_id, subreddit, category, position, quote, summary) VALUES (?, ?, ?, ?, ?, ?)",
+                [tuple(r[f] for f in RECORD_FIELDS) for _, _, records in self.buffer for r in records]
+            )
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class ParquetSink:
+    # Append-only Parquet dataset partitioned by subreddit; each flush writes one part file
+    # per subreddit. Rewrites of a row are resolved at read time (last part wins); an empty
+    # rewrite is stored as a tombstone record.
+    def __init__(self, directory, batch_size=5000):
+        import pyarrow  # noqa: F401  (fail early when the optional dependency is missing)
+
+        self.directory = directory
+        self.batch_size = batch_size
+        self.buffer = []
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, subreddit, row_id, analysis):
+        records = analysis_records(subreddit, row_id, analysis)
+        self.buffer.extend(records or [{'row_id': str(row_id), 'subreddit': subreddit,
+                                        'category': TOMBSTONE_CATEGORY, 'position': -1, 'quote': '', 'summary': ''}])
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        return bool(records)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        by_subreddit = {}
+        for record in self.buffer:
+            by_subreddit.setdefault(record['subreddit'], []).append(record)
+        for subreddit, records in by_subreddit.items():
+            partition = os.path.join(self.directory, f"subreddit={subreddit}")
+            os.makedirs(partition, exist_ok=True)
+            table = pa.Table.from_pylist([{f: r[f] for f in RECORD_FIELDS if f != 'subreddit'} for r in records])
+            # Part names sort by write order so later rewrites win on read
+            pq.write_table(table, os.path.join(partition, f"part-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.parquet"))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+class TeeSink:
+    # Writes through to a primary sink and any number of secondary ones (e.g. the quote
+    # search index); the primary's answer decides whether the row counts as saved
+    def __init__(self, primary, *secondaries):
+        self.sinks = (primary,) + secondaries
+
+    def write(self, subreddit, row_id, analysis):
+        saved = self.sinks[0].write(subreddit, row_id, analysis)
+        for sink in self.sinks[1:]:
+            sink.write(subreddit, row_id, analysis)
+        return saved
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def default_store_path(kind, output_dir):
+    if kind == 'sqlite':
+        return os.path.join(output_dir, 'outputs.sqlite3')
+    if kind == 'parquet':
+        return os.path.join(output_dir, 'outputs.parquet')
+    return output_dir
+
+
+def get_sink(kind, output_dir, path=None):
+    # OUTPUT_SINK=json (default) | sqlite | parquet
+    path = path or default_store_path(kind, output_dir)
+    if kind == 'sqlite':
+        return SQLiteSink(path)
+    if kind == 'parquet':
+        return ParquetSink(path)
+    if kind == 'json':
+        return JsonDirSink(path)
+    raise ValueError(f"Unknown output sink: {kind}")
+
+
+def store_kind(location):
+    if location.endswith('.sqlite3') or location.endswith('.db'):
+        return 'sqlite'
+    if location.endswith('.parquet'):
+        return 'parquet'
+    return 'json'
+
+
+def has_output_files(path):
+    return any(OUTPUT_FILE_RE.match(name) for name in os.listdir(path))
+
+
+def json_subreddit_dirs(directory):
+    # Subdirectories holding output-<id>.json files; caches, batch files and other
+    # directories next to them are not subreddits
+    return [e for e in sorted(os.listdir(directory))
+            if os.path.isdir(os.path.join(directory, e)) and has_output_files(os.path.join(directory, e))]
+
+
+def iter_json_records(directory, subreddit=None):
+    # Accepts either the per-subreddit layout or a flat directory of output files; only
+    # output-<id>.json files are rows (not run_summary.json and the like)
+    subdirs = json_subreddit_dirs(directory)
+    if subdirs:
+        sources = [(s, os.path.join(directory, s)) for s in subdirs if subreddit in (None, s)]
+    else:
+        sources = [(subreddit or os.path.basename(os.path.normpath(directory)), directory)]
+
+    for name, path in sources:
+        for filename in sorted(os.listdir(path)):
+            match = OUTPUT_FILE_RE.match(filename)
+            if not match:
+                continue
+            with open(os.path.join(path, filename), 'r') as file:
+                data = json.load(file)
+            yield from analysis_records(name, match.group(1), data)
+
+
+def iter_sqlite_records(path, subreddit=None):
+    db = sqlite3.connect(path)
+    try:
+        query = f"SELECT {', '.join(RECORD_FIELDS)} FROM quotes"
+        params = ()
+        if subreddit is not None:
+            query += " WHERE subreddit = ?"
+            params = (subreddit,)
+        for row in db.execute(query + " ORDER BY subreddit, row_id, category, position", params):
+            yield dict(zip(RECORD_FIELDS, row))
+    finally:
+        db.close()
+
+
+def iter_parquet_records(directory, subreddit=None):
+    import pyarrow.parquet as pq
+
+    partitions = sorted(p for p in os.listdir(directory) if p.startswith('subreddit='))
+    for partition in partitions:
+        name = partition[len('subreddit='):]
+        if subreddit not in (None, name):
+            continue
+        latest = {}
+        for part in sorted(os.listdir(os.path.join(directory, partition))):
+            for record in pq.read_table(os.path.join(directory, partition, part)).to_pylist():
+                record['subreddit'] = name
+                rows = latest.setdefault(record['row_id'], {})
+                if rows.get('_part') != part:
+                    # A newer part rewrote this row: drop the older records
+                    rows.clear()
+                    rows['_part'] = part
+                if record['category'] != TOMBSTONE_CATEGORY:
+                    rows[(record['category'], record['position'])] = record
+        for row_id in sorted(latest):
+            for key, record in sorted((k, v) for k, v in latest[row_id].items() if k != '_part'):
+                yield record
+
+
+def read_records(location, subreddit=None):
+    kind = store_kind(location)
+    if kind == 'sqlite':
+        return iter_sqlite_records(location, subreddit)
+    if kind == 'parquet':
+        return iter_parquet_records(location, subreddit)
+    return iter_json_records(location, subreddit)
+
+
+def list_subreddits(location):
+    # Subreddits with records in a store; a flat JSON directory counts as one, named after it
+    kind = store_kind(location)
+    if not os.path.exists(location):
+        return []
+    if kind == 'sqlite':
+        db = sqlite3.connect(location)
+        try:
+            return [s for s, in db.execute("SELECT DISTINCT subreddit FROM quotes ORDER BY subreddit")]
+        finally:
+            db.close()
+    if kind == 'parquet':
+        return sorted(p[len('subreddit='):] for p in os.listdir(location) if p.startswith('subreddit='))
+    subdirs = json_subreddit_dirs(location)
+    if subdirs:
+        return subdirs
+    return [os.path.basename(os.path.normpath(location))] if has_output_files(location) else []
+
+
+def export_json(location, output_dir, subreddit=None):
+    # Compatibility exporter: rebuilds <output_dir>/<subreddit>/output-<id>.json from a store
+    sink = JsonDirSink(output_dir)
+    count = 0
+    current, records = None, []
+    for record in read_records(location, subreddit):
+        key = (record['subreddit'], record['row_id'])
+        if key != current and records:
+            sink.write(current[0], current[1], records_to_analysis(records))
+            count += 1
+            records = []
+        current = key
+        records.append(record)
+    if records:
+        sink.write(current[0], current[1], records_to_analysis(records))
+        count += 1
+    logging.info(f"Exported {count} rows from {location} to {output_dir}")
+    return count
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export a consolidated output store to the JSON layout")
+    parser.add_argument("store", help="Path to outputs.sqlite3 or outputs.parquet")
+    parser.add_argument("output_dir", help="Directory to write <subreddit>/output-<id>.json files into")
+    parser.add_argument("--subreddit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    export_json(args.store, args.output_dir, args.subreddit)
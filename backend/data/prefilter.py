@@ -0,0 +1,275 @@
+import os
+import re
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+
+from run_manifest import DONE, EMPTY
+
+# The topic sentence of filter_prompt.txt: "... strictly related to the impact of <topic>."
+# and "... discuss the impact of <topic> on <context>."
+TOPIC_RE = re.compile(r'strictly related to the impact of (.+?)\.', re.IGNORECASE)
+CONTEXT_RE = re.compile(r'impact of .+? on (.+?)\.', re.IGNORECASE)
+WORD_RE = re.compile(r"[a-z][a-z'-]+")
+STOP_WORDS = {'and', 'or', 'the', 'of', 'on', 'in', 'for', 'to', 'with', 'its', 'their', 'a', 'an', 'impact'}
+SUFFIXES = ('ations', 'ation', 'ings', 'ing', 'ities', 'ity', 'ies', 'es', 'ed', 's')
+BODY_WEIGHT = 1.0
+HEADER_WEIGHT = 2.0
+
+
+def read_topic(prompt_text):
+    # (topic, context) from the filter prompt; context may be None
+    topic = TOPIC_RE.search(prompt_text)
+    if not topic:
+        raise ValueError("No 'strictly related to the impact of <topic>.' sentence in the filter prompt")
+    context = CONTEXT_RE.search(prompt_text)
+    return topic.group(1).strip(), context.group(1).strip() if context else None
+
+
+def stem(word):
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[:-len(suffix)]
+    return word
+
+
+def topic_patterns(topic, extra_terms=()):
+    # One prefix regex per topic content word ("Earnings" -> \bearn\w*), plus extra terms
+    # (regular expressions) from PREFILTER_TERMS / PREFILTER_TERMS_PATH
+    patterns = {}
+    for word in WORD_RE.findall(topic.lower()):
+        if word not in STOP_WORDS and len(word) > 2:
+            patterns[word] = re.compile(rf"\b{re.escape(stem(word))}\w*", re.IGNORECASE)
+    for term in extra_terms:
+        patterns[term] = re.compile(term, re.IGNORECASE)
+    return patterns
+
+
+def read_terms(path):
+    # One regular expression per line; blank lines and '#' comments are ignored
+    with open(path, 'r', encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+
+
+class Prefilter:
+    # Cheap local relevance check in front of the LLM. A row passes when its weighted keyword
+    # score reaches min_score, or, with a classifier, when its similarity to the topic reaches
+    # min_similarity.
+    def __init__(self, topic, context=None, extra_terms=(), min_score=1.0, embedder=None,
+                 min_similarity=0.2, body_chars=20000):
+        self.topic = topic
+        self.context = context
+        self.patterns = topic_patterns(topic, extra_terms)
+        self.min_score = min_score
+        self.embedder = embedder
+        self.min_similarity = min_similarity
+        self.body_chars = body_chars
+        self.topic_vector = None
+        if embedder is not None:
+            self.topic_vector = embedder.embed([f"{topic} {context or ''}".strip()])[0]
+        self.config = hashlib.sha256(json.dumps(
+            [sorted(self.patterns), min_score, getattr(embedder, 'name', None), min_similarity]
+        ).encode('utf-8')).hexdigest()[:16]
+
+    def keyword_score(self, row):
+        header = f"{row.get('title', '')} {row.get('selftext', '')}"
+        body = (row.get('body') or '')[:self.body_chars]
+        score, matched = 0.0, []
+        for term, pattern in self.patterns.items():
+            hits = HEADER_WEIGHT * len(pattern.findall(header)) + BODY_WEIGHT * len(pattern.findall(body))
+            if hits:
+                score += hits
+                matched.append(term)
+        return score, matched
+
+    def similarity(self, row):
+        if self.embedder is None:
+            return None
+        text = f"{row.get('title', '')} {row.get('selftext', '')} {(row.get('body') or '')[:self.body_chars]}"
+        return float(self.embedder.embed([text])[0] @ self.topic_vector)
+
+    def evaluate(self, row):
+        # (passed, keyword score, similarity, reason)
+        score, matched = self.keyword_score(row)
+        similarity = self.similarity(row)
+        if score >= self.min_score:
+            return True, score, similarity, f"keywords: {', '.join(matched)}"
+        if similarity is not None and similarity >= self.min_similarity:
+            return True, score, similarity, f"similarity {similarity:.3f}"
+        reason = f"keyword score {score:g} < {self.min_score:g}"
+        if similarity is not None:
+            reason += f", similarity {similarity:.3f} < {self.min_similarity:g}"
+        return False, score, similarity, reason
+
+
+class AnyPrefilter:
+    # Passes a row when any of several prefilters passes it (one per topic in multi-topic
+    # mode); a rejected row reports its best score and similarity across them
+    def __init__(self, prefilters):
+        self.prefilters = prefilters
+        self.config = hashlib.sha256(json.dumps([p.config for p in prefilters]).encode('utf-8')).hexdigest()[:16]
+
+    def evaluate(self, row):
+        results = []
+        for prefilter in self.prefilters:
+            ok, score, similarity, reason = prefilter.evaluate(row)
+            if ok:
+                return True, score, similarity, f"{prefilter.topic}: {reason}"
+            results.append((score, similarity))
+        similarities = [similarity for _, similarity in results if similarity is not None]
+        return (False, max(score for score, _ in results), max(similarities) if similarities else None,
+                f"no topic passed (best keyword score {max(score for score, _ in results):g})")
+
+
+class ScoreStore:
+    # Persists every prefilter decision so thresholds can be tuned without rescoring
+    def __init__(self, path, commit_every=500):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "subreddit TEXT NOT NULL, row_id TEXT NOT NULL, config TEXT NOT NULL, keyword_score REAL NOT NULL, "
+            "similarity REAL, passed INTEGER NOT NULL, reason TEXT, updated REAL NOT NULL, "
+            "PRIMARY KEY (subreddit, row_id))"
+        )
+        self.db.commit()
+
+    def record(self, subreddit, row_id, config, passed, score, similarity, reason):
+        self.db.execute(
+            "INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (subreddit, str(row_id), config, score, similarity, int(passed), reason, time.time())
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def load_prefilter(prompt_path, extra_terms=(), terms_path=None, min_score=1.0, classifier=None,
+                   min_similarity=0.2):
+    # classifier: None, or an embedder spec for embeddings.get_embedder ('hashing',
+    # 'sentence-transformers:<model>')
+    with open(prompt_path, 'r', encoding='utf-8') as file:
+        topic, context = read_topic(file.read())
+    terms = list(extra_terms)
+    if terms_path:
+        terms += read_terms(terms_path)
+    embedder = None
+    if classifier:
+        from embeddings import get_embedder
+
+        embedder = get_embedder(classifier)
+    logging.info(f"Prefilter topic: {topic!r} ({context or 'no context'}), {len(terms)} extra terms, "
+                 f"classifier: {classifier or 'none'}")
+    return Prefilter(topic, context, terms, min_score, embedder, min_similarity)
+
+
+def apply_prefilter(subreddit, rows, prefilter, store, on_skip):
+    # Passes relevant rows through; on_skip(row_id, reason) is called for the rest
+    passed = skipped = 0
+    for row in rows:
+        ok, score, similarity, reason = prefilter.evaluate(row)
+        store.record(subreddit, row['id'], prefilter.config, ok, score, similarity, reason)
+        if ok:
+            passed += 1
+            yield row
+        else:
+            skipped += 1
+            on_skip(row['id'], reason)
+    store.commit()
+    logging.info(f"Prefilter passed {passed} and skipped {skipped} rows for {subreddit}")
+
+
+def evaluate_against_labels(prefilter, labeled_rows, thresholds=(0.5, 1, 2, 3, 5, 8)):
+    # labeled_rows: (row, has_output) pairs, where has_output comes from a finished LLM run.
+    # Returns metrics at the configured threshold plus a sweep over keyword thresholds.
+    scored = []
+    for row, label in labeled_rows:
+        ok, score, similarity, _ = prefilter.evaluate(row)
+        scored.append((ok, score, similarity, label))
+
+    def metrics(predictions):
+        tp = sum(1 for p, label in predictions if p and label)
+        fp = sum(1 for p, label in predictions if p and not label)
+        fn = sum(1 for p, label in predictions if not p and label)
+        total = len(predictions)
+        return {
+            "rows": total,
+            "positives": tp + fn,
+            "sent": tp + fp,
+            "precision": tp / (tp + fp) if tp + fp else 0.0,
+            "recall": tp / (tp + fn) if tp + fn else 1.0,
+            "skip_rate": 1 - (tp + fp) / total if total else 0.0,
+        }
+
+    def passes(score, similarity, threshold):
+        return score >= threshold or (similarity is not None and similarity >= prefilter.min_similarity)
+
+    report = metrics([(ok, label) for ok, _, _, label in scored])
+    report["sweep"] = {
+        threshold: metrics([(passes(score, similarity, threshold), label) for _, score, similarity, label in scored])
+        for threshold in thresholds
+    }
+    return report
+
+
+def labeled_rows(input_dir, manifest_path):
+    # Rows the run manifest has settled: done (non-empty output) is relevant, empty is not
+    from generation import iter_rows, subreddit_from_path
+
+    db = sqlite3.connect(manifest_path)
+    try:
+        labels = {
+            (subreddit, row_id): status == DONE
+            for subreddit, row_id, status in db.execute("SELECT subreddit, row_id, status FROM rows")
+            if status in (DONE, EMPTY)
+        }
+    finally:
+        db.close()
+
+    for filename in sorted(os.listdir(input_dir)):
+        if not filename.endswith('_llm.csv'):
+            continue
+        subreddit = subreddit_from_path(filename)
+        for row in iter_rows(os.path.join(input_dir, filename)):
+            label = labels.get((subreddit, str(row['id'])))
+            if label is not None:
+                yield row, label
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure the prefilter's precision and recall against labeled outputs")
+    parser.add_argument("--input-dir", default=os.getenv('INPUT_DIRECTORY'))
+    parser.add_argument("--manifest", required=True, help="run_manifest.sqlite3 of a run made without the prefilter")
+    parser.add_argument("--prompt", default=os.path.join(os.path.dirname(__file__), '..', 'prompts', 'filter_prompt.txt'))
+    parser.add_argument("--terms", action="append", default=[], help="Extra term regex (repeatable)")
+    parser.add_argument("--terms-path")
+    parser.add_argument("--min-score", type=float, default=1.0)
+    parser.add_argument("--classifier", help="Embedder spec, e.g. 'hashing' or 'sentence-transformers:all-MiniLM-L6-v2'")
+    parser.add_argument("--min-similarity", type=float, default=0.2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    prefilter = load_prefilter(args.prompt, args.terms, args.terms_path, args.min_score, args.classifier,
+                               args.min_similarity)
+    report = evaluate_against_labels(prefilter, labeled_rows(args.input_dir, args.manifest))
+    sweep = report.pop("sweep")
+    print(json.dumps(report, indent=2))
+    print("min_score  precision  recall  skip_rate")
+    for threshold, m in sweep.items():
+        print(f"{threshold:>9g}  {m['precision']:>9.3f}  {m['recall']:>6.3f}  {m['skip_rate']:>9.3f}")
@@ -0,0 +1,126 @@
+import re
+import json
+
+# Separator combine_submissions_comments puts between comments; older CSVs used a single
+# space, in which case windows fall back to sentence boundaries
+COMMENT_SEPARATOR = "\n\n"
+SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+CATEGORIES = ('anecdotes', 'media_reports', 'opinions', 'other')
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+
+    def count_tokens(text):
+        return len(_encoding.encode(text or '', disallowed_special=()))
+except ImportError:
+    def count_tokens(text):
+        # ~4 characters per token for English text
+        return len(text or '') // 4 + 1
+
+
+def split_comments(body):
+    body = body or ''
+    if COMMENT_SEPARATOR in body:
+        return [c for c in body.split(COMMENT_SEPARATOR) if c.strip()]
+    return [c for c in SENTENCE_RE.split(body) if c.strip()]
+
+
+def hard_split(text, max_tokens):
+    # Last resort for a single comment larger than the budget: cut by characters
+    size = max(1, len(text) * max_tokens // max(count_tokens(text), 1))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def comment_windows(row, budget):
+    # Splits row['body'] into consecutive windows whose comments fit the budget. Each window
+    # is a copy of the row with a reduced body; a row that fits is returned unchanged.
+    if count_tokens(row['body']) <= budget:
+        return [row]
+
+    windows, current, used = [], [], 0
+    for comment in split_comments(row['body']):
+        pieces = hard_split(comment, budget) if count_tokens(comment) > budget else [comment]
+        for piece in pieces:
+            cost = count_tokens(piece) + 1
+            if current and used + cost > budget:
+                windows.append(current)
+                current, used = [], 0
+            current.append(piece)
+            used += cost
+    if current:
+        windows.append(current)
+    return [dict(row, body=COMMENT_SEPARATOR.join(window)) for window in windows]
+
+
+def row_tokens(row):
+    return sum(count_tokens(row[field]) for field in ('title', 'selftext', 'body')) + 20
+
+
+def plan_units(rows, system_prompt, max_prompt_tokens, pack_max_tokens, pack_max_rows):
+    # Turns a row stream into request units:
+    #   ('single', [row])          one row, one request
+    #   ('windows', [w1, w2, ...]) one oversized row split into comment windows
+    #   ('packed', [r1, r2, ...])  several small rows sharing one request
+    overhead = count_tokens(system_prompt) + 50
+    pack, pack_tokens = [], 0
+    for row in rows:
+        tokens = row_tokens(row)
+        if overhead + tokens > max_prompt_tokens:
+            fixed = overhead + row_tokens(dict(row, body=''))
+            yield 'windows', comment_windows(row, max(max_prompt_tokens - fixed, 256))
+            continue
+        if pack_max_rows <= 1 or tokens > pack_max_tokens:
+            yield 'single', [row]
+            continue
+        if pack and (pack_tokens + tokens > pack_max_tokens or len(pack) >= pack_max_rows):
+            yield ('packed', pack) if len(pack) > 1 else ('single', pack)
+            pack, pack_tokens = [], 0
+        pack.append(row)
+        pack_tokens += tokens
+    if pack:
+        yield ('packed', pack) if len(pack) > 1 else ('single', pack)
+
+
+def normalize_quote(quote):
+    return ' '.join(str(quote).lower().split())
+
+
+def merge_analyses(analyses):
+    # Combines per-window analyses of one row; a quote seen in an earlier window or category
+    # is dropped
+    merged = {category: [] for category in CATEGORIES}
+    seen = set()
+    for analysis in analyses:
+        for category in CATEGORIES:
+            for entry in analysis.get(category) or []:
+                key = normalize_quote(entry.get('quote', ''))
+                if key and key not in seen:
+                    seen.add(key)
+                    merged[category].append(entry)
+    return merged
+
+
+PACKED_INSTRUCTION = (
+    "The input below contains several Reddit submissions. Analyze each submission independently, "
+    "exactly as instructed above, and return a single JSON object of the form "
+    '{"results": [{"ID": "<submission ID>", "anecdotes": [...], "media_reports": [...], "opinions": [...], '
+    '"other": [...]}]} with one entry per submission ID. No other text.'
+)
+
+
+def packed_user_prompt(formatted_submissions):
+    return PACKED_INSTRUCTION + "\n\n" + json.dumps({"Submissions": formatted_submissions}, default=str)
+
+
+def split_packed_content(content, ids):
+    # {row id: analysis dict} for every ID the model answered; missing IDs are left out
+    results = json.loads(content).get("results", [])
+    wanted = {str(i) for i in ids}
+    by_id = {}
+    for result in results:
+        row_id = str(result.get("ID", ""))
+        if row_id in wanted and row_id not in by_id:
+            by_id[row_id] = {category: result.get(category, []) for category in CATEGORIES}
+    return by_id
@@ -0,0 +1,285 @@
+import os
+import re
+import json
+import time
+import base64
+import sqlite3
+import logging
+import threading
+
+from output_store import analysis_records, quote_id, read_records, records_to_analysis
+
+TERM_RE = re.compile(r'\w+\*?', re.UNICODE)
+MAX_LIMIT = 100
+
+
+def match_expression(text):
+    # User input as an FTS5 query: every word must match, "word*" is a prefix search, and
+    # FTS5 operators or quotes in the input are taken literally instead of raising
+    terms = []
+    for term in TERM_RE.findall(text or ''):
+        prefix = term.endswith('*')
+        terms.append(f'"{term.rstrip("*")}"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    if not (isinstance(values, list) and len(values) == 2):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+class QuoteIndex:
+    # Full-text index (SQLite FTS5, BM25 ranking) over every extracted quote and summary,
+    # with subreddit, category, theme and date facets. Quote rows live in docs and the FTS
+    # table indexes them as external content, kept in sync by triggers. The date is the
+    # post's created_utc when an ingest store (ingest_state.py) is given, otherwise the time
+    # the quote was indexed. Themes come from a theme store (theme_store.py) attached at
+    # query time, so rematerialized themes apply without reindexing.
+    def __init__(self, path, ingest_state=None, theme_store=None):
+        self.path = path
+        self.ingest_state = ingest_state if ingest_state and os.path.exists(ingest_state) else None
+        self.theme_store = theme_store if theme_store and os.path.exists(theme_store) else None
+        self.local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = self.connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, quote_id TEXT NOT NULL UNIQUE, "
+            "subreddit TEXT NOT NULL, row_id TEXT NOT NULL, category TEXT NOT NULL, position INTEGER NOT NULL, "
+            "quote TEXT NOT NULL, summary TEXT NOT NULL, date REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS docs_row ON docs (subreddit, row_id)")
+        db.execute("CREATE INDEX IF NOT EXISTS docs_facets ON docs (subreddit, category, date)")
+        db.execute("CREATE INDEX IF NOT EXISTS docs_date ON docs (date, id)")
+        db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5("
+            "quote, summary, content='docs', content_rowid='id', tokenize='porter unicode61')"
+        )
+        db.execute(
+            "CREATE TRIGGER IF NOT EXISTS docs_insert AFTER INSERT ON docs BEGIN "
+            "INSERT INTO docs_fts (rowid, quote, summary) VALUES (new.id, new.quote, new.summary); END"
+        )
+        db.execute(
+            "CREATE TRIGGER IF NOT EXISTS docs_delete AFTER DELETE ON docs BEGIN "
+            "INSERT INTO docs_fts (docs_fts, rowid, quote, summary) VALUES ('delete', old.id, old.quote, old.summary); "
+            "END"
+        )
+        db.commit()
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30)
+            if self.ingest_state:
+                db.execute("ATTACH DATABASE ? AS ingest", (self.ingest_state,))
+            if self.theme_store:
+                db.execute("ATTACH DATABASE ? AS themes", (self.theme_store,))
+        return db
+
+    def replace_rows(self, rows):
+        # rows: [(subreddit, row id, records)]; each row's previous quotes are dropped first
+        db = self.connect()
+        now = time.time()
+        date = "COALESCE((SELECT created FROM ingest.submissions WHERE id = ?), ?)" if self.ingest_state else "?"
+        with db:
+            db.executemany("DELETE FROM docs WHERE subreddit = ? AND row_id = ?",
+                           [(subreddit, str(row_id)) for subreddit, row_id, _ in rows])
+            db.executemany(
+                "INSERT INTO docs (quote_id, subreddit, row_id, category, position, quote, summary, date) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, {date})",
+                [(quote_id(r), r['subreddit'], r['row_id'], r['category'], r['position'], r['quote'], r['summary'],
+                  *((r['row_id'], now) if self.ingest_state else (now,)))
+                 for _, _, records in rows for r in records]
+            )
+
+    def filters(self, subreddit=None, category=None, theme=None, since=None, until=None):
+        clauses, params = [], []
+        if subreddit:
+            clauses.append("d.subreddit = ?")
+            params.append(subreddit)
+        if category:
+            clauses.append("d.category = ?")
+            params.append(category)
+        if since is not None:
+            clauses.append("d.date >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("d.date < ?")
+            params.append(until)
+        if theme:
+            if not self.theme_store:
+                raise ValueError("Theme filters need a theme store")
+            clauses.append(
+                "d.quote_id IN (SELECT tq.quote_id FROM themes.theme_quotes tq JOIN themes.themes t "
+                "ON t.key = tq.key AND t.position = tq.position WHERE t.title = ?)"
+            )
+            params.append(theme)
+        return clauses, params
+
+    def matches(self, query, filters):
+        # (FROM ... WHERE sql, params) for the matching docs
+        clauses, params = filters
+        if query:
+            sql = "FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid WHERE docs_fts MATCH ?"
+            params = [query] + params
+        else:
+            sql = "FROM docs d WHERE 1"
+        for clause in clauses:
+            sql += f" AND {clause}"
+        return sql, params
+
+    def search(self, text='', subreddit=None, category=None, theme=None, since=None, until=None, cursor=None,
+               limit=20, facets=False):
+        # One page of results, best first (newest first without a query). next_cursor resumes
+        # after the last result; facet counts cover all matches, not just this page.
+        query = match_expression(text)
+        limit = min(max(int(limit), 1), MAX_LIMIT)
+        where, params = self.matches(query, self.filters(subreddit, category, theme, since, until))
+        columns = "d.id, d.quote_id, d.subreddit, d.row_id, d.category, d.quote, d.summary, d.date"
+        page_params = list(params)
+        if query:
+            # Lower BM25 is better; quote matches weigh twice as much as summary matches
+            sql = f"SELECT * FROM (SELECT {columns}, bm25(docs_fts, 2.0, 1.0) AS score {where})"
+            if cursor:
+                sql += " WHERE (score, id) > (?, ?)"
+                page_params += decode_cursor(cursor)
+            sql += " ORDER BY score, id"
+        else:
+            # Browsing walks the (date, id) index backwards, newest first, from the cursor
+            sql = f"SELECT {columns}, d.date AS score {where}"
+            if cursor:
+                sql += " AND (d.date, d.id) < (?, ?)"
+                page_params += decode_cursor(cursor)
+            sql += " ORDER BY d.date DESC, d.id DESC"
+        sql += " LIMIT ?"
+        page_params.append(limit + 1)
+
+        db = self.connect()
+        rows = db.execute(sql, page_params).fetchall()
+        snippets = {}
+        if query and rows:
+            # Highlighting only for the page, not for every match
+            ids = [row[0] for row in rows[:limit]]
+            snippets = dict(db.execute(
+                "SELECT rowid, snippet(docs_fts, 0, '<mark>', '</mark>', '…', 24) FROM docs_fts "
+                f"WHERE docs_fts MATCH ? AND rowid IN ({','.join('?' * len(ids))})", [query] + ids
+            ).fetchall())
+        results = [
+            {"id": qid, "subreddit": sub, "row_id": row_id, "category": category_, "quote": quote,
+             "summary": summary, "date": date, "score": round(-score, 4) if query else None,
+             "snippet": snippets.get(id_, quote)}
+            for id_, qid, sub, row_id, category_, quote, summary, date, score in rows[:limit]
+        ]
+        page = {"results": results, "next_cursor": None}
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            page["next_cursor"] = encode_cursor([last[8], last[0]])
+        if facets:
+            page["facets"] = self.facet_counts(where, params)
+        return page
+
+    def facet_counts(self, where, params, top=50):
+        db = self.connect()
+        counts = {}
+        for name, expression in (("subreddit", "d.subreddit"), ("category", "d.category"),
+                                 ("month", "strftime('%Y-%m', d.date, 'unixepoch')")):
+            counts[name] = dict(db.execute(
+                f"SELECT {expression} AS value, COUNT(*) AS n {where} GROUP BY value ORDER BY n DESC LIMIT ?",
+                params + [top]
+            ).fetchall())
+        if self.theme_store:
+            counts["theme"] = dict(db.execute(
+                f"SELECT t.title, COUNT(*) AS n FROM (SELECT d.quote_id {where}) m "
+                "JOIN themes.theme_quotes tq ON tq.quote_id = m.quote_id "
+                "JOIN themes.themes t ON t.key = tq.key AND t.position = tq.position "
+                "GROUP BY t.title ORDER BY n DESC LIMIT ?", params + [top]
+            ).fetchall())
+        return counts
+
+    def count(self):
+        return self.connect().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+class QuoteIndexSink:
+    # Output sink that keeps a QuoteIndex current as generation writes results; meant to run
+    # next to the primary sink (output_store.TeeSink). Empty analyses still clear a row.
+    def __init__(self, index, batch_size=500):
+        self.index = index
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def write(self, subreddit, row_id, analysis):
+        records = analysis_records(subreddit, row_id, analysis)
+        self.buffer.append((subreddit, str(row_id), records))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        return bool(records)
+
+    def flush(self):
+        if self.buffer:
+            self.index.replace_rows(self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.index.close()
+
+
+def build_index(location, index, subreddit=None):
+    # Backfills the index from an existing output store, one row at a time
+    sink = QuoteIndexSink(index)
+    current, records, rows = None, [], 0
+    for record in read_records(location, subreddit):
+        key = (record['subreddit'], record['row_id'])
+        if key != current and records:
+            sink.write(current[0], current[1], records_to_analysis(records))
+            rows += 1
+            records = []
+        current = key
+        records.append(record)
+    if records:
+        sink.write(current[0], current[1], records_to_analysis(records))
+        rows += 1
+    sink.flush()
+    logging.info(f"Indexed {rows} rows from {location}; the index holds {index.count()} quotes")
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the quote search index from an output store, or query it")
+    parser.add_argument("--index", default=os.getenv('QUOTE_INDEX_PATH', 'search/quotes.sqlite3'))
+    parser.add_argument("--ingest-state", default=os.getenv('QUOTE_INDEX_INGEST_STATE'),
+                        help="ingest_state.sqlite3, for post dates")
+    parser.add_argument("--theme-store", default=os.getenv('THEME_STORE_PATH'))
+    parser.add_argument("--build", metavar="LOCATION", help="Index a JSON output directory, outputs.sqlite3 or outputs.parquet")
+    parser.add_argument("--subreddit")
+    parser.add_argument("--query", help="Search instead of building")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    quote_index = QuoteIndex(args.index, args.ingest_state, args.theme_store)
+    try:
+        if args.build:
+            build_index(args.build, quote_index, args.subreddit)
+        if args.query is not None:
+            print(json.dumps(quote_index.search(args.query, subreddit=args.subreddit, facets=True), indent=2))
+    finally:
+        quote_index.close()
@@ -0,0 +1,122 @@
+import os
+import threading
+import functools
+
+from run_manifest import prompt_version
+
+
+@functools.lru_cache(maxsize=None)
+def load_prompt(path):
+    # Read and hash once per process: (text, version). Every request then carries the exact
+    # same system-message bytes, which is what provider-side prompt caching keys on.
+    with open(path, 'r') as file:
+        text = file.read()
+    return text, prompt_version(text)
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size=8):
+    # One keep-alive requests.Session per process (recreated after fork so pool workers
+    # never share sockets with the parent)
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+class RequestBuilder:
+    # Chat-completions payloads with a fixed layout: the system prompt first, byte-identical
+    # on every request, then the per-row user content. max_tokens is sized from the user
+    # content instead of always reserving the maximum.
+    def __init__(self, system_prompt, min_output_tokens=512, max_output_tokens=4096, output_ratio=0.5):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.version = prompt_version(system_prompt)
+        self.min_output_tokens = min_output_tokens
+        self.max_output_tokens = max_output_tokens
+        self.output_ratio = output_ratio
+
+    def messages(self, user_content):
+        return [self.system_message, {"role": "user", "content": user_content}]
+
+    def max_tokens(self, messages):
+        # Quotes are copied out of the input, so output grows with it; ~4 characters per token
+        input_tokens = sum(len(m['content']) for m in messages if m['role'] != 'system') // 4
+        return max(self.min_output_tokens,
+                   min(self.max_output_tokens, self.min_output_tokens + int(input_tokens * self.output_ratio)))
+
+    def payload(self, messages, max_tokens=None):
+        return {"messages": messages, "max_tokens": max_tokens or self.max_tokens(messages)}
+
+
+def is_truncated(response):
+    # The sized max_tokens was too small; the caller retries once at the maximum
+    choices = response.get('choices') or [{}]
+    return choices[0].get('finish_reason') == 'length'
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class RequestStats:
+    # Per-run token and latency counters. Pool workers drain() theirs after every unit and
+    # the dispatching process merge()s the snapshots.
+    COUNTERS = ('requests', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'truncated')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.latencies = []
+
+    def record(self, latency, response):
+        usage = response.get('usage') or {}
+        with self.lock:
+            self.counts['requests'] += 1
+            self.counts['prompt_tokens'] += usage.get('prompt_tokens') or 0
+            self.counts['cached_tokens'] += (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+            self.counts['completion_tokens'] += usage.get('completion_tokens') or 0
+            self.latencies.append(latency)
+
+    def record_truncated(self):
+        with self.lock:
+            self.counts['truncated'] += 1
+
+    def drain(self):
+        with self.lock:
+            snapshot = {'counts': self.counts, 'latencies': self.latencies}
+            self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot['counts'].items():
+                self.counts[key] += value
+            self.latencies.extend(snapshot['latencies'])
+
+    def summary(self):
+        with self.lock:
+            counts = dict(self.counts)
+            latencies = list(self.latencies)
+        counts['cache_hit_rate'] = round(counts['cached_tokens'] / counts['prompt_tokens'], 3) \
+            if counts['prompt_tokens'] else 0.0
+        counts['latency_p50'] = round(percentile(latencies, 0.5), 3)
+        counts['latency_p95'] = round(percentile(latencies, 0.95), 3)
+        return counts
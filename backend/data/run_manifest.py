@@ -0,0 +1,159 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+
+DONE = 'done'
+EMPTY = 'empty'
+FAILED = 'failed'
+# Rejected by the prefilter; rescored (locally) on every run
+SKIPPED = 'skipped'
+
+OUTPUT_FILE_RE = re.compile(r'^output-(.+)\.json$')
+
+
+def prompt_version(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+
+
+def row_digest(row):
+    # Changes when a thread's text does, e.g. when an incremental ingest added comments
+    text = f"{row.get('title', '')}\0{row.get('selftext', '')}\0{row.get('body', '')}"
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class RunManifest:
+    # Persistent per-row status (done / empty / failed / skipped, attempts, prompt version, content
+    # digest) so reruns only dispatch rows that still need work. Only the dispatching process
+    # writes to it.
+    def __init__(self, path, version, retry_failed=False, reprocess_if_prompt_changed=False, commit_every=200):
+        self.version = version
+        self.retry_failed = retry_failed
+        self.reprocess_if_prompt_changed = reprocess_if_prompt_changed
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        # Digests of dispatched rows, stored when their result is recorded
+        self.digests = {}
+        # Subreddits with rows settled (done or empty) during this run
+        self.changed = set()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS rows ("
+            "subreddit TEXT NOT NULL, row_id TEXT NOT NULL, prompt_version TEXT, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated REAL NOT NULL, "
+            "PRIMARY KEY (subreddit, row_id))"
+        )
+        if 'digest' not in [c[1] for c in self.db.execute("PRAGMA table_info(rows)")]:
+            self.db.execute("ALTER TABLE rows ADD COLUMN digest TEXT")
+        self.db.commit()
+
+    def load(self, subreddit):
+        rows = self.db.execute(
+            "SELECT row_id, status, prompt_version, digest FROM rows WHERE subreddit = ?", (subreddit,)
+        ).fetchall()
+        return {row_id: (status, version, digest) for row_id, status, version, digest in rows}
+
+    def seed_from_outputs(self, output_dir, subreddit):
+        # Adopt output files written before the manifest existed (one directory listing,
+        # no per-row stat); their prompt version is unknown
+        output_subdir = os.path.join(output_dir, subreddit)
+        if not os.path.isdir(output_subdir):
+            return 0
+        known = self.load(subreddit)
+        now = time.time()
+        adopted = []
+        for filename in os.listdir(output_subdir):
+            match = OUTPUT_FILE_RE.match(filename)
+            if match and match.group(1) not in known:
+                adopted.append((subreddit, match.group(1), None, DONE, 1, None, now))
+        self.db.executemany("INSERT OR IGNORE INTO rows (subreddit, row_id, prompt_version, status, attempts, error, "
+                            "updated) VALUES (?, ?, ?, ?, ?, ?, ?)", adopted)
+        self.db.commit()
+        if adopted:
+            logging.info(f"Manifest adopted {len(adopted)} existing outputs for {subreddit}")
+        return len(adopted)
+
+    def entry(self, subreddit, row_id):
+        # (status, prompt version, updated) for one row, or None
+        return self.db.execute(
+            "SELECT status, prompt_version, updated FROM rows WHERE subreddit = ? AND row_id = ?",
+            (subreddit, str(row_id))
+        ).fetchone()
+
+    def needs_work(self, entry, digest=None):
+        if entry is None:
+            return True
+        status, version, stored = entry
+        if status == SKIPPED:
+            return True
+        # Changed text needs work whatever the row's previous status
+        if digest is not None and stored is not None and digest != stored:
+            return True
+        if status == FAILED:
+            return self.retry_failed
+        # Adopted outputs have no recorded version: unknown is not treated as changed
+        return self.reprocess_if_prompt_changed and version is not None and version != self.version
+
+    def pending(self, subreddit, rows):
+        # Filters rows before they are dispatched to any engine. Settled rows recorded before
+        # digests existed adopt the digest of their current text.
+        known = self.load(subreddit)
+        skipped = changed = 0
+        adopted = []
+        for row in rows:
+            row_id = str(row['id'])
+            entry = known.get(row_id)
+            digest = row_digest(row)
+            if self.needs_work(entry, digest):
+                changed += entry is not None and entry[0] in (DONE, EMPTY) and entry[2] not in (None, digest)
+                self.digests[(subreddit, row_id)] = digest
+                yield row
+            else:
+                skipped += 1
+                if entry[2] is None:
+                    adopted.append((digest, subreddit, row_id))
+        if adopted:
+            self.db.executemany("UPDATE rows SET digest = ? WHERE subreddit = ? AND row_id = ?", adopted)
+            self.commit()
+        logging.info(f"Manifest skipped {skipped} rows for {subreddit}; {changed} settled rows changed since")
+
+    def record(self, subreddit, row_id, status, error=None, digest=None):
+        # digest: the row's content digest when it was not dispatched (e.g. a duplicate given
+        # its representative's result)
+        row_id = str(row_id)
+        digest = self.digests.pop((subreddit, row_id), digest)
+        self.db.execute(
+            "INSERT INTO rows (subreddit, row_id, prompt_version, status, attempts, error, updated, digest) "
+            "VALUES (?, ?, ?, ?, 1, ?, ?, ?) "
+            "ON CONFLICT (subreddit, row_id) DO UPDATE SET prompt_version = excluded.prompt_version, "
+            "status = excluded.status, attempts = rows.attempts + 1, error = excluded.error, "
+            "updated = excluded.updated, digest = COALESCE(excluded.digest, rows.digest)",
+            (subreddit, row_id, self.version, status, error, time.time(), digest)
+        )
+        if status in (DONE, EMPTY):
+            self.changed.add(subreddit)
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def summary(self, subreddit=None):
+        query = "SELECT status, COUNT(*) FROM rows"
+        params = ()
+        if subreddit is not None:
+            query += " WHERE subreddit = ?"
+            params = (subreddit,)
+        return dict(self.db.execute(query + " GROUP BY status", params).fetchall())
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import logging
+import pandas as pd
+import numpy as np
+from embeddings import get_embedder, top_k
+
+VECTORS_FILE = 'vectors.npy'
+META_FILE = 'meta.json'
+
+
+def read_catalog(csv_path):
+    # The catalog needs a 'name' column; an optional 'description' column improves matching
+    df = pd.read_csv(csv_path)
+    names = df['name'].astype(str).tolist()
+    if 'description' in df.columns:
+        descriptions = df['description'].fillna('').astype(str).tolist()
+    else:
+        descriptions = [''] * len(names)
+    return names, descriptions
+
+
+def file_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def build_index(csv_path, index_dir, embedder=None):
+    embedder = embedder or get_embedder()
+    names, descriptions = read_catalog(csv_path)
+    texts = [f"{name.replace('r/', '', 1)} {description}".strip() for name, description in zip(names, descriptions)]
+    vectors = embedder.embed(texts)
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, VECTORS_FILE), vectors)
+    meta = {
+        'names': names,
+        'embedder': embedder.name,
+        'source_hash': file_hash(csv_path),
+        'dim': int(vectors.shape[1]),
+    }
+    with open(os.path.join(index_dir, META_FILE), 'w') as file:
+        json.dump(meta, file)
+    logging.info(f"Built subreddit index with {len(names)} entries in {index_dir}")
+    return meta
+
+
+class SubredditIndex:
+    def __init__(self, vectors, names, embedder):
+        self.vectors = vectors
+        self.names = names
+        self.embedder = embedder
+
+    def search(self, query, k=20):
+        query_vector = self.embedder.embed([query])[0]
+        idx, scores = top_k(self.vectors, query_vector, k)
+        return [(self.names[i], float(s)) for i, s in zip(idx, scores)]
+
+
+def load_index(csv_path, index_dir, embedder=None):
+    # Memory-maps the persisted vectors, rebuilding first if the catalog or embedder changed
+    embedder = embedder or get_embedder()
+    meta_path = os.path.join(index_dir, META_FILE)
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as file:
+            meta = json.load(file)
+    if meta is None or meta.get('embedder') != embedder.name or meta.get('source_hash') != file_hash(csv_path):
+        meta = build_index(csv_path, index_dir, embedder)
+
+    vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode='r')
+    return SubredditIndex(vectors, meta['names'], embedder)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the subreddit embedding index")
+    parser.add_argument("--csv", default=os.path.join(os.path.dirname(__file__), 'subreddits.csv'))
+    parser.add_argument("--index-dir", default=os.path.join(os.path.dirname(__file__), 'subreddit_index'))
+    parser.add_argument("--query", help="Optional topic to search after building")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    build_index(args.csv, args.index_dir)
+    if args.query:
+        for name, score in load_index(args.csv, args.index_dir).search(args.query, args.k):
+            print(f"{score:.3f}  {name}")
@@ -1,9 +1,15 @@
 import os
 import json
 import openai
+import random
+import numpy as np
 from dotenv import load_dotenv
 from collections import Counter
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from output_store import read_records
+from embeddings import get_embedder
+from instrumentation import chat_completion
 
 # Load environment variables
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
@@ -24,6 +30,26 @@ MAX_RETRIES = get_env('MAX_RETRIES', 5, int)
 MIN_RETRY_WAIT = get_env('MIN_RETRY_WAIT', 1, int)
 MAX_RETRY_WAIT = get_env('MAX_RETRY_WAIT', 60, int)
 
+# Quote classification: 'batch' packs many quotes per call, 'single' is one call per quote,
+# 'embedding' assigns by nearest theme and only asks the LLM about ambiguous quotes
+CLASSIFY_MODE = get_env('CLASSIFY_MODE', 'batch')
+EMBED_NONE_THRESHOLD = get_env('EMBED_NONE_THRESHOLD', 0.15, float)
+EMBED_MIN_MARGIN = get_env('EMBED_MIN_MARGIN', 0.03, float)
+EMBED_BATCH_SIZE = get_env('EMBED_BATCH_SIZE', 1024, int)
+EMBED_AGREEMENT_SAMPLE = get_env('EMBED_AGREEMENT_SAMPLE', 0, int)
+
+# Themes per report: the prompts ask for the top 5
+THEME_COUNT = 5
+
+# Map-reduce theme extraction for corpora larger than one prompt
+THEME_SHARD_TOKENS = get_env('THEME_SHARD_TOKENS', 60000, int)
+THEME_CANDIDATES_PER_SHARD = get_env('THEME_CANDIDATES_PER_SHARD', 8, int)
+THEME_MERGE_SIMILARITY = get_env('THEME_MERGE_SIMILARITY', 0.75, float)
+THEME_MAP_CONCURRENCY = get_env('THEME_MAP_CONCURRENCY', 8, int)
+CLASSIFY_BATCH_TOKENS = get_env('CLASSIFY_BATCH_TOKENS', 6000, int)
+CLASSIFY_MAX_BATCH = get_env('CLASSIFY_MAX_BATCH', 60, int)
+CLASSIFY_CONCURRENCY = get_env('CLASSIFY_CONCURRENCY', 8, int)
+
 # Azure OpenAI settings
 endpoint = get_env('AZURE_OPENAI_ENDPOINT')
 api_key = get_env('AZURE_OPENAI_API_KEY')
@@ -56,7 +82,23 @@ def read_json_files(directory):
 
     return summaries, all_quotes
 
+def read_outputs(location, subreddit=None):
+    # Same result as read_json_files, but for any output store (JSON directory, SQLite or
+    # Parquet), optionally restricted to one subreddit
+    summaries = []
+    all_quotes = []
+    for record in read_records(location, subreddit):
+        if record['summary']:
+            summaries.append(record['summary'])
+        if record['quote']:
+            all_quotes.append(record['quote'])
+    return summaries, all_quotes
+
 def get_themes_from_chatgpt(summaries):
+    # Corpora that do not fit one shard go through the map-reduce path
+    if sum(estimate_tokens(summary) for summary in summaries) > THEME_SHARD_TOKENS:
+        return get_themes_map_reduce(summaries)
+
     combined_summaries = "\n".join(summaries)
     prompt = (
         "Based on the following summaries, identify the top 5 common themes. "
@@ -73,7 +115,8 @@ def get_themes_from_chatgpt(summaries):
         f"{combined_summaries}"
     )
 
-    response = openai.chat.completions.create(
+    response = chat_completion(
+        'subtopics', 'themes',
         model=deployment_name,
         messages=[{"role": "user", "content": prompt}]
     )
@@ -87,78 +130,415 @@ def get_themes_from_chatgpt(summaries):
 
     return json_str
 
+def extract_json_object(raw_response):
+    return json.loads(raw_response[raw_response.find('{'):raw_response.rfind('}') + 1])
+
+def shard_summaries(summaries, token_budget):
+    shards = []
+    shard, used = [], 0
+    for summary in summaries:
+        cost = estimate_tokens(summary) + 1
+        if shard and used + cost > token_budget:
+            shards.append(shard)
+            shard, used = [], 0
+        shard.append(summary)
+        used += cost
+    if shard:
+        shards.append(shard)
+    return shards
+
+def extract_candidate_themes(shard, count):
+    # Map step: candidate themes for one shard of summaries
+    prompt = (
+        f"Based on the following summaries, identify up to {count} common themes. "
+        "Respond only with JSON in this format:\n"
+        '{"themes": ["<theme1>", "<theme2>"]}\n\n'
+        + "\n".join(shard)
+    )
+    response = chat_completion(
+        'subtopics', 'theme_candidates',
+        model=deployment_name,
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"}
+    )
+    return [str(theme).strip() for theme in extract_json_object(response.choices[0].message.content)["themes"] if str(theme).strip()]
+
+def merge_candidate_themes(candidates, similarity, embedder=None):
+    # Greedy clustering of near-duplicate themes by embedding cosine similarity.
+    # Returns [(representative theme, number of shards proposing it)], most supported first.
+    counts = Counter(candidates)
+    unique = [theme for theme, _ in counts.most_common()]
+    if not unique:
+        return []
+    embedder = embedder or get_embedder()
+    vectors = embedder.embed(unique)
+
+    clusters = []  # [representative index, support]
+    for i in range(len(unique)):
+        for cluster in clusters:
+            if float(vectors[i] @ vectors[cluster[0]]) >= similarity:
+                cluster[1] += counts[unique[i]]
+                break
+        else:
+            clusters.append([i, counts[unique[i]]])
+    clusters.sort(key=lambda c: -c[1])
+    return [(unique[i], support) for i, support in clusters]
+
+def reduce_themes(merged, count):
+    # Reduce step: pick the final top themes from the merged candidates
+    candidate_lines = "\n".join(f"- {theme} (proposed by {support} shards)" for theme, support in merged)
+    prompt = (
+        f"The following candidate themes were extracted from different parts of a large set of summaries. "
+        f"Merge overlapping candidates and identify the top {count} common themes, favouring those with more support. "
+        "Respond only with JSON in this format:\n"
+        '{"themes": ["<theme1>", "<theme2>"]}\n\n'
+        f"{candidate_lines}"
+    )
+    response = chat_completion(
+        'subtopics', 'theme_reduce',
+        model=deployment_name,
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"}
+    )
+    themes = extract_json_object(response.choices[0].message.content)["themes"][:count]
+    return json.dumps({"themes": themes})
+
+def get_themes_map_reduce(summaries, count=THEME_COUNT):
+    # Same contract as get_themes_from_chatgpt (a JSON string with a "themes" list), but the
+    # corpus size is no longer bounded by one context window
+    shards = shard_summaries(summaries, THEME_SHARD_TOKENS)
+    print(f"Extracting themes from {len(shards)} shards")
+
+    candidates = []
+    with ThreadPoolExecutor(max_workers=THEME_MAP_CONCURRENCY) as executor:
+        futures = [executor.submit(extract_candidate_themes, shard, THEME_CANDIDATES_PER_SHARD) for shard in shards]
+        for i, future in enumerate(futures):
+            try:
+                candidates.extend(future.result())
+            except Exception as e:
+                print(f"Theme extraction failed for shard {i}: {e}")
+
+    merged = merge_candidate_themes(candidates, THEME_MERGE_SIMILARITY)
+    if not merged:
+        raise ValueError(f"No candidate themes from any of {len(shards)} shards")
+    if len(merged) <= count:
+        return json.dumps({"themes": [theme for theme, _ in merged]})
+    return reduce_themes(merged, count)
+
 def classify_quote_with_theme(quote, themes):
+    theme_lines = "\n".join(f"{i}. {theme}" for i, theme in enumerate(themes, 1))
     prompt = (
         f"Please classify the following quote into one of these themes:\n"
-        f"1. {themes[0]}\n"
-        f"2. {themes[1]}\n"
-        f"3. {themes[2]}\n"
-        f"4. {themes[3]}\n"
-        f"5. {themes[4]}\n\n"
+        f"{theme_lines}\n\n"
         f"Quote: \"{quote}\"\n\n"
-        f"Respond with the theme number (1-5) or 'none' if it doesn't fit any theme."
+        f"Respond with the theme number (1-{len(themes)}) or 'none' if it doesn't fit any theme."
     )
 
-    response = openai.chat.completions.create(
+    response = chat_completion(
+        'subtopics', 'classify_quote',
         model=deployment_name,  # Specify your model
         messages=[
             {"role": "user", "content": prompt}
         ]
     )
 
-    print("HELLO????")
-    print(response)
-
     return response.choices[0].message.content.strip()
 
-def map_quotes_to_themes(all_quotes, themes):
+def estimate_tokens(text):
+    # Rough count (~4 characters per token), good enough for packing prompts
+    return len(text) // 4 + 1
+
+def make_quote_batches(all_quotes, token_budget, max_batch):
+    # Groups (index, quote) pairs so each batch's quotes fit the token budget
+    batches = []
+    batch, used = [], 0
+    for index, quote in enumerate(all_quotes):
+        cost = estimate_tokens(quote) + 8  # numbering and answer overhead
+        if batch and (used + cost > token_budget or len(batch) >= max_batch):
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append((index, quote))
+        used += cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+def classify_quote_batch(batch, themes):
+    # One call for many quotes; returns {quote index: 0-based theme number or None}.
+    # Raises ValueError when the answer is not valid JSON or misses a quote.
+    theme_lines = "\n".join(f"{i}. {theme}" for i, theme in enumerate(themes, 1))
+    quote_lines = "\n".join(f"[{n}] \"{quote}\"" for n, (_, quote) in enumerate(batch, 1))
+    prompt = (
+        f"Please classify each of the following quotes into one of these themes:\n"
+        f"{theme_lines}\n\n"
+        f"Quotes:\n{quote_lines}\n\n"
+        f"Respond only with JSON in this format, with one entry per quote number:\n"
+        '{"assignments": [{"quote": 1, "theme": 3}, {"quote": 2, "theme": "none"}]}\n'
+        f"Use the theme number (1-{len(themes)}) or \"none\" if the quote doesn't fit any theme."
+    )
+
+    response = chat_completion(
+        'subtopics', 'classify_batch',
+        model=deployment_name,
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"}
+    )
+
+    try:
+        assignments = json.loads(response.choices[0].message.content)["assignments"]
+        answers = {int(a["quote"]): a["theme"] for a in assignments}
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Malformed batch classification: {e}")
+
+    results = {}
+    for n, (index, _) in enumerate(batch, 1):
+        if n not in answers:
+            raise ValueError(f"Batch classification is missing quote {n}")
+        theme = str(answers[n]).strip()
+        results[index] = int(theme) - 1 if theme.isdigit() and 1 <= int(theme) <= len(themes) else None
+    return results
+
+def classify_batch_with_split(batch, themes):
+    # A malformed answer is retried as two smaller batches; single quotes fall back
+    # to the one-quote prompt. API errors (throttling, timeouts) are left to the openai
+    # client's retries and then propagate: splitting would only multiply the calls.
+    if len(batch) == 1:
+        index, quote = batch[0]
+        theme_classification = classify_quote_with_theme(quote, themes)
+        if theme_classification.isdigit() and 1 <= int(theme_classification) <= len(themes):
+            return {index: int(theme_classification) - 1}
+        return {index: None}
+    try:
+        return classify_quote_batch(batch, themes)
+    except ValueError as e:
+        print(f"Splitting batch of {len(batch)} quotes after error: {e}")
+        middle = len(batch) // 2
+        results = classify_batch_with_split(batch[:middle], themes)
+        results.update(classify_batch_with_split(batch[middle:], themes))
+        return results
+
+def map_quotes_to_themes_batched(all_quotes, themes, progress=None):
+    batches = make_quote_batches(all_quotes, CLASSIFY_BATCH_TOKENS, CLASSIFY_MAX_BATCH)
+    assignments = {}
+    with ThreadPoolExecutor(max_workers=CLASSIFY_CONCURRENCY) as executor:
+        try:
+            for results in executor.map(lambda batch: classify_batch_with_split(batch, themes), batches):
+                assignments.update(results)
+                if progress:
+                    progress('classifying', len(assignments), len(all_quotes))
+        except BaseException:
+            # A failed batch or a cancelled job drops the batches not started yet instead
+            # of waiting for all of them
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    # Keep quotes in their original order within each theme
+    theme_quotes = defaultdict(list)
+    for index, quote in enumerate(all_quotes):
+        theme_number = assignments.get(index)
+        if theme_number is not None:
+            theme_quotes[themes[theme_number]].append(quote)
+    return theme_quotes
+
+def embed_in_batches(embedder, texts, batch_size):
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.vstack([embedder.embed(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)])
+
+def assign_by_embedding(all_quotes, themes, embedder=None, none_threshold=None, min_margin=None):
+    # Nearest-centroid assignment by cosine similarity. Returns (assignments, ambiguous):
+    # assignments maps quote index -> 0-based theme number or None (below none_threshold);
+    # ambiguous lists indices whose best and second-best themes are within min_margin.
+    embedder = embedder or get_embedder()
+    none_threshold = EMBED_NONE_THRESHOLD if none_threshold is None else none_threshold
+    min_margin = EMBED_MIN_MARGIN if min_margin is None else min_margin
+
+    theme_vectors = embedder.embed(list(themes))
+    quote_vectors = embed_in_batches(embedder, list(all_quotes), EMBED_BATCH_SIZE)
+    if len(all_quotes) == 0:
+        return {}, []
+    scores = quote_vectors @ theme_vectors.T
+
+    order = np.argsort(-scores, axis=1)
+    best = order[:, 0]
+    best_scores = scores[np.arange(len(all_quotes)), best]
+    if len(themes) > 1:
+        margins = best_scores - scores[np.arange(len(all_quotes)), order[:, 1]]
+    else:
+        margins = np.full(len(all_quotes), np.inf)
+
+    assignments = {}
+    ambiguous = []
+    for index in range(len(all_quotes)):
+        assignments[index] = int(best[index]) if best_scores[index] >= none_threshold else None
+        if margins[index] < min_margin or abs(best_scores[index] - none_threshold) < min_margin:
+            ambiguous.append(index)
+    return assignments, ambiguous
+
+def map_quotes_to_themes_embedding(all_quotes, themes, embedder=None):
+    assignments, ambiguous = assign_by_embedding(all_quotes, themes, embedder)
+    print(f"Embedding assignment: {len(ambiguous)} of {len(all_quotes)} quotes sent to the LLM")
+
+    # Only low-margin quotes pay for an LLM call
+    for batch in make_quote_batches([all_quotes[i] for i in ambiguous], CLASSIFY_BATCH_TOKENS, CLASSIFY_MAX_BATCH):
+        batch = [(ambiguous[n], quote) for n, quote in batch]
+        assignments.update(classify_batch_with_split(batch, themes))
+
+    theme_quotes = defaultdict(list)
+    for index, quote in enumerate(all_quotes):
+        if assignments.get(index) is not None:
+            theme_quotes[themes[assignments[index]]].append(quote)
+    return theme_quotes
+
+def embedding_agreement(all_quotes, themes, sample_size=200, embedder=None, seed=0):
+    # Compares the embedding-only assignment with the batched LLM classifier on a random
+    # sample; "none" counts as a label. Use before trusting CLASSIFY_MODE=embedding.
+    rng = random.Random(seed)
+    sample = rng.sample(range(len(all_quotes)), min(sample_size, len(all_quotes)))
+    quotes = [all_quotes[i] for i in sample]
+
+    embedded, ambiguous = assign_by_embedding(quotes, themes, embedder)
+    llm = {}
+    for batch in make_quote_batches(quotes, CLASSIFY_BATCH_TOKENS, CLASSIFY_MAX_BATCH):
+        llm.update(classify_batch_with_split(batch, themes))
+
+    agree = sum(1 for i in range(len(quotes)) if embedded[i] == llm.get(i))
+    confident = [i for i in range(len(quotes)) if i not in set(ambiguous)]
+    agree_confident = sum(1 for i in confident if embedded[i] == llm.get(i))
+    return {
+        "sample_size": len(quotes),
+        "agreement": agree / len(quotes) if quotes else 0.0,
+        "confident_agreement": agree_confident / len(confident) if confident else 0.0,
+        "ambiguous_fraction": len(ambiguous) / len(quotes) if quotes else 0.0,
+    }
+
+def map_quotes_to_themes(all_quotes, themes, progress=None):
+    # progress(stage, done, total) is called as quotes are classified
+    if CLASSIFY_MODE == 'batch':
+        return map_quotes_to_themes_batched(all_quotes, themes, progress)
+    if CLASSIFY_MODE == 'embedding':
+        return map_quotes_to_themes_embedding(all_quotes, themes)
+
     theme_quotes = defaultdict(list)
 
-    for quote in all_quotes:
+    for done, quote in enumerate(all_quotes, 1):
         theme_classification = classify_quote_with_theme(quote, themes)
         
-        if theme_classification.isdigit() and 1 <= int(theme_classification) <= 5:
+        if theme_classification.isdigit() and 1 <= int(theme_classification) <= len(themes):
             theme_number = int(theme_classification) - 1  # Convert to 0-based index
             theme_quotes[themes[theme_number]].append(quote)
+        if progress:
+            progress('classifying', done, len(all_quotes))
 
-    print("HELLO!!!")
-
-    print(theme_quotes)
     return theme_quotes
 
-def main():
-    directory = r'C:\Users\mwang\PolicyPulse\output_raw\combined'
-    summaries, all_quotes = read_json_files(directory)
-    
-    if summaries:
-        # Get the top 5 themes
-        json_response = get_themes_from_chatgpt(summaries)
+def build_theme_evidence(location, subreddit=None, progress=None):
+    # The full report: read outputs, extract the top themes, map quotes to them. Returns
+    # {"themes": [{"theme", "records"}]} where records are the supporting output records
+    # (see output_store.RECORD_FIELDS), or None when there are no summaries. progress(stage,
+    # done, total) may raise to abandon the report (jobs.py uses this for cancellation).
+    progress = progress or (lambda stage, done=0, total=0: None)
+    progress('reading')
+    records = list(read_records(location, subreddit))
+    summaries = [r['summary'] for r in records if r['summary']]
+    quote_records = [r for r in records if r['quote']]
+    all_quotes = [r['quote'] for r in quote_records]
+    if not summaries:
+        return None
+
+    # Get the top 5 themes
+    progress('themes', 0, len(summaries))
+    json_response = get_themes_from_chatgpt(summaries)
+    try:
+        themes = json.loads(json_response)['themes']
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        raise ValueError(f"Error decoding themes response: {e}; raw response: {json_response[:500]}")
+    # Up to THEME_COUNT distinct, non-empty titles; classification numbers them 1-N
+    if not isinstance(themes, list):
+        raise ValueError(f"Themes response is not a list: {json_response[:500]}")
+    themes = list(dict.fromkeys(str(theme).strip() for theme in themes if str(theme).strip()))[:THEME_COUNT]
+    if not themes:
+        raise ValueError("Themes response has no themes")
+
+    # Check the embedding fast path against the LLM on a sample before relying on it
+    if CLASSIFY_MODE == 'embedding' and EMBED_AGREEMENT_SAMPLE > 0:
+        print("Embedding vs LLM agreement:", embedding_agreement(all_quotes, themes, EMBED_AGREEMENT_SAMPLE))
+
+    # Map quotes to their respective themes
+    progress('classifying', 0, len(all_quotes))
+    theme_quotes = map_quotes_to_themes(all_quotes, themes, progress)
+
+    # Every mode keeps quotes in their original order, so equal texts map back to their
+    # records in turn
+    by_text = defaultdict(list)
+    for record in quote_records:
+        by_text[record['quote']].append(record)
+    positions = Counter()
+    evidence = []
+    for theme in themes:
+        theme_records = []
+        for quote in theme_quotes[theme]:
+            theme_records.append(by_text[quote][positions[quote] % len(by_text[quote])])
+            positions[quote] += 1
+        evidence.append({"theme": theme, "records": theme_records})
+    return {"themes": evidence}
+
+def build_theme_report(location, subreddit=None, progress=None):
+    # build_theme_evidence with plain quote texts: {"themes": [{"theme", "quotes"}]}
+    evidence = build_theme_evidence(location, subreddit, progress)
+    if evidence is None:
+        return None
+    return {"themes": [{"theme": t["theme"], "quotes": [r["quote"] for r in t["records"]]}
+                       for t in evidence["themes"]]}
+
+def refresh_theme_reports(location, subreddits, report_dir):
+    # Rebuilds <report_dir>/<subreddit>.json for the given subreddits only, e.g. the
+    # changed_subreddits of an incremental generation run; other reports are left as they are
+    os.makedirs(report_dir, exist_ok=True)
+    written = []
+    for subreddit in subreddits:
         try:
-            # Parse the JSON response
-            themes_data = json.loads(json_response)
-            themes = themes_data['themes']
-
-            # Map quotes to their respective themes
-            theme_quotes = map_quotes_to_themes(all_quotes, themes)
-
-            # Prepare final output
-            output_data = {
-                "themes": []
-            }
-            for theme in themes:
-                output_data["themes"].append({
-                    "theme": theme,
-                    "quotes": theme_quotes[theme]
-                })
-
-            # Print the final output in JSON format
-            print("Extracted themes and associated quotes:")
-            print(json.dumps(output_data, indent=2))  # Pretty print the JSON response
-        except json.JSONDecodeError as e:
-            print("Error decoding JSON response:", e)
-            print("Raw response:", json_response)
-    else:
+            output_data = build_theme_report(location, subreddit)
+        except ValueError as e:
+            print(f"{subreddit}: {e}")
+            continue
+        if output_data is None:
+            print(f"{subreddit}: no summaries found")
+            continue
+        with open(os.path.join(report_dir, f"{subreddit}.json"), 'w') as file:
+            json.dump(output_data, file, indent=2)
+        written.append(subreddit)
+    return written
+
+def main():
+    # A JSON output directory, outputs.sqlite3 or outputs.parquet
+    directory = get_env('THEME_INPUT') or get_env('OUTPUT_DIRECTORY')
+    if not directory:
+        raise SystemExit("Set THEME_INPUT to a JSON output directory, outputs.sqlite3 or outputs.parquet")
+
+    # THEME_RUN_SUMMARY: a generation run_summary.json; only its changed subreddits are rebuilt
+    run_summary_path = get_env('THEME_RUN_SUMMARY')
+    if run_summary_path:
+        with open(run_summary_path, 'r') as file:
+            subreddits = json.load(file).get('changed_subreddits', [])
+        report_dir = get_env('THEME_REPORT_DIR', 'theme_reports')
+        written = refresh_theme_reports(directory, subreddits, report_dir)
+        print(f"Refreshed {len(written)} of {len(subreddits)} changed subreddits in {report_dir}")
+        return
+
+    try:
+        output_data = build_theme_report(directory, get_env('THEME_SUBREDDIT'))
+    except ValueError as e:
+        print(e)
+        return
+
+    if output_data is None:
         print("No summaries found.")
+        return
+
+    # Print the final output in JSON format
+    print("Extracted themes and associated quotes:")
+    print(json.dumps(output_data, indent=2))  # Pretty print the JSON response
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,189 @@
+import os
+import csv
+import json
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from output_store import quote_id
+
+
+def subreddit_key(name):
+    # "r/AskNYC", "asknyc" and " AskNYC " all map to "asknyc"
+    key = " ".join(str(name or "").lower().split())
+    return key[2:] if key.startswith("r/") else key
+
+
+class ThemeStore:
+    # Materialized, evidence-backed themes per subreddit: the themes subtopics.py finds in the
+    # extracted outputs, with their supporting quotes ranked in output order. Every read is a
+    # primary-key lookup, and quote pages are rank ranges, so serving cost does not grow with
+    # the corpus. Connections are per thread, so one store can be shared by a threaded server.
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = self.connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS subreddits (key TEXT PRIMARY KEY, name TEXT NOT NULL, "
+            "theme_count INTEGER NOT NULL, quote_count INTEGER NOT NULL, built REAL NOT NULL) WITHOUT ROWID"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS themes (key TEXT NOT NULL, position INTEGER NOT NULL, title TEXT NOT NULL, "
+            "quote_count INTEGER NOT NULL, post_count INTEGER NOT NULL, PRIMARY KEY (key, position)) WITHOUT ROWID"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS theme_quotes (key TEXT NOT NULL, position INTEGER NOT NULL, "
+            "rank INTEGER NOT NULL, quote_id TEXT NOT NULL, row_id TEXT NOT NULL, category TEXT NOT NULL, "
+            "quote TEXT NOT NULL, summary TEXT NOT NULL, PRIMARY KEY (key, position, rank)) WITHOUT ROWID"
+        )
+        # Theme facets of the quote search index (quote_index.py) join on quote IDs
+        db.execute("CREATE INDEX IF NOT EXISTS theme_quotes_quote ON theme_quotes (quote_id)")
+        db.commit()
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30)
+        return db
+
+    def put(self, name, evidence):
+        # Replaces a subreddit's themes with build_theme_evidence output in one transaction
+        key = subreddit_key(name)
+        db = self.connect()
+        with db:
+            db.execute("DELETE FROM subreddits WHERE key = ?", (key,))
+            db.execute("DELETE FROM themes WHERE key = ?", (key,))
+            db.execute("DELETE FROM theme_quotes WHERE key = ?", (key,))
+            quote_count = 0
+            for position, theme in enumerate(evidence["themes"]):
+                records = theme["records"]
+                db.execute("INSERT INTO themes VALUES (?, ?, ?, ?, ?)",
+                           (key, position, theme["theme"], len(records), len({r['row_id'] for r in records})))
+                db.executemany(
+                    "INSERT INTO theme_quotes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(key, position, rank, quote_id(r), r['row_id'], r['category'], r['quote'], r['summary'])
+                     for rank, r in enumerate(records)]
+                )
+                quote_count += len(records)
+            db.execute("INSERT INTO subreddits VALUES (?, ?, ?, ?, ?)",
+                       (key, name, len(evidence["themes"]), quote_count, time.time()))
+
+    def quotes(self, name, position, page=1, per_page=10):
+        # One page of a theme's supporting quotes, or None for an unknown theme
+        key = subreddit_key(name)
+        db = self.connect()
+        row = db.execute("SELECT quote_count FROM themes WHERE key = ? AND position = ?", (key, position)).fetchone()
+        if row is None:
+            return None
+        start = (max(page, 1) - 1) * per_page
+        quotes = [
+            {"id": quote_id, "row_id": row_id, "category": category, "quote": quote, "summary": summary}
+            for quote_id, row_id, category, quote, summary in db.execute(
+                "SELECT quote_id, row_id, category, quote, summary FROM theme_quotes "
+                "WHERE key = ? AND position = ? AND rank >= ? AND rank < ? ORDER BY rank",
+                (key, position, start, start + per_page)
+            )
+        ]
+        return {"page": max(page, 1), "per_page": per_page, "total": row[0], "quotes": quotes}
+
+    def themes(self, name, per_page=5):
+        # The /get_themes payload with the first page of quotes per theme, or None on a miss
+        key = subreddit_key(name)
+        db = self.connect()
+        rows = db.execute("SELECT position, title, quote_count, post_count FROM themes WHERE key = ? ORDER BY position",
+                          (key,)).fetchall()
+        if not rows:
+            return None
+        return [
+            {
+                "id": position,
+                "title": title,
+                "description": f"{quote_count} supporting quotes from {post_count} posts",
+                "count": quote_count,
+                "posts": post_count,
+                "evidence": self.quotes(name, position, 1, per_page),
+            }
+            for position, title, quote_count, post_count in rows
+        ]
+
+    def built(self):
+        # {key: build time} for every materialized subreddit
+        return dict(self.connect().execute("SELECT key, built FROM subreddits").fetchall())
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+
+def read_catalog(subreddits_csv):
+    # Catalog names without the r/ prefix, as generation.py names its outputs
+    with open(subreddits_csv, 'r', encoding='utf-8', newline='') as f:
+        names = [record['name'].strip() for record in csv.DictReader(f)]
+    return [name[2:] if name.lower().startswith('r/') else name for name in names if name]
+
+
+def materialize(location, subreddits, store, workers=4):
+    # Builds and stores themes for each subreddit that has outputs; reports are computed
+    # concurrently and written from this thread. Returns {"built", "empty", "failed"}.
+    from subtopics import build_theme_evidence
+
+    counts = {"built": 0, "empty": 0, "failed": 0}
+
+    def build(name):
+        try:
+            return name, build_theme_evidence(location, name), None
+        except Exception as e:
+            return name, None, e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, evidence, error in executor.map(build, subreddits):
+            if error is not None:
+                counts["failed"] += 1
+                logging.error(f"Theme materialization failed for {name}: {error}")
+            elif evidence is None:
+                counts["empty"] += 1
+            else:
+                store.put(name, evidence)
+                counts["built"] += 1
+                logging.info(f"Materialized {len(evidence['themes'])} themes for {name}")
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Materialize evidence-backed themes for the /get_themes endpoint")
+    parser.add_argument("--input", default=os.getenv('THEME_INPUT') or os.getenv('OUTPUT_DIRECTORY'),
+                        help="JSON output directory, outputs.sqlite3 or outputs.parquet")
+    parser.add_argument("--store", default=os.getenv('THEME_STORE_PATH', 'themes/themes.sqlite3'))
+    parser.add_argument("--subreddits", default=os.path.join(os.path.dirname(__file__), 'subreddits.csv'))
+    parser.add_argument("--run-summary", help="Only rebuild the changed_subreddits of this generation run_summary.json")
+    parser.add_argument("--workers", type=int, default=4, help="Subreddits built concurrently")
+    args = parser.parse_args()
+    if not args.input:
+        parser.error("--input (or THEME_INPUT) is required")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from output_store import list_subreddits
+
+    # Catalog subreddits that have outputs, in the spelling the outputs use
+    available = {subreddit_key(s): s for s in list_subreddits(args.input)}
+    names = [available[subreddit_key(name)] for name in read_catalog(args.subreddits)
+             if subreddit_key(name) in available]
+    if args.run_summary:
+        with open(args.run_summary, 'r') as file:
+            changed = {subreddit_key(s) for s in json.load(file).get('changed_subreddits', [])}
+        names = [name for name in names if subreddit_key(name) in changed]
+    started = time.time()
+    theme_store = ThemeStore(args.store)
+    try:
+        counts = materialize(args.input, names, theme_store, args.workers)
+    finally:
+        theme_store.close()
+    logging.info(f"Materialized themes for {len(names)} subreddits in {time.time() - started:.1f}s: {counts}")
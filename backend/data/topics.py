@@ -0,0 +1,122 @@
+import os
+import re
+import json
+import logging
+
+from pydantic import Field, create_model
+from output_store import CATEGORIES, default_store_path, get_sink, read_records, records_to_analysis
+
+KEY_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]*$')
+DEFAULT_TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), '..', 'prompts', 'multi_topic_prompt.txt')
+
+
+def load_topics(path):
+    # Topic definitions: a JSON list of {"key", "topic", "context"?, "terms"?}. The key names
+    # the topic's section in responses and its output directory; terms are extra prefilter
+    # regular expressions.
+    with open(path, 'r', encoding='utf-8') as file:
+        topics = json.load(file)
+    if not isinstance(topics, list) or not topics:
+        raise ValueError(f"{path} must hold a non-empty JSON list of topics")
+    keys = set()
+    for topic in topics:
+        key = topic.get('key') if isinstance(topic, dict) else None
+        if not key or not KEY_RE.match(key) or not topic.get('topic'):
+            raise ValueError(f"Each topic needs a 'topic' and a 'key' of letters, digits, '_' or '-': {topic!r}")
+        if key in keys:
+            raise ValueError(f"Duplicate topic key: {key}")
+        keys.add(key)
+    return topics
+
+
+def topic_prompt(topics, template_path=None):
+    # One system prompt covering every topic, so a thread is sent once for all of them
+    with open(template_path or DEFAULT_TEMPLATE_PATH, 'r', encoding='utf-8') as file:
+        template = file.read()
+    lines = []
+    for topic in topics:
+        line = f'- "{topic["key"]}": the impact of {topic["topic"]}'
+        if topic.get('context'):
+            line += f' on {topic["context"]}'
+        lines.append(line + '.')
+    entry = [{"quote": "Full quote", "summary": "Brief summary, with context if needed"}]
+    example = {topic['key']: {category: entry if category == CATEGORIES[0] else [] for category in CATEGORIES}
+               for topic in topics}
+    return template.replace('{topics}', '\n'.join(lines)).replace('{format}', json.dumps(example, indent=2))
+
+
+def topic_model(topics, section_model):
+    # Pydantic model of a multi-topic response: one required section_model field per topic.
+    # Fields are aliased to the topic keys so keys like "json" or "schema" cannot shadow
+    # BaseModel attributes.
+    fields = {f"topic_{i}": (section_model, Field(..., alias=topic['key'])) for i, topic in enumerate(topics)}
+    return create_model('MultiTopicAnalysis', **fields)
+
+
+def topic_prefilter(topics, extra_terms=(), terms_path=None, min_score=1.0, classifier=None, min_similarity=0.2):
+    # One prefilter per topic (its topic, context and terms, plus the shared extra terms),
+    # combined so a row passes when it is relevant to any topic
+    from prefilter import AnyPrefilter, Prefilter, read_terms
+
+    shared = list(extra_terms) + (read_terms(terms_path) if terms_path else [])
+    embedder = None
+    if classifier:
+        from embeddings import get_embedder
+
+        embedder = get_embedder(classifier)
+    prefilters = [Prefilter(topic['topic'], topic.get('context'), shared + list(topic.get('terms', [])), min_score,
+                            embedder, min_similarity) for topic in topics]
+    logging.info(f"Prefilter topics: {', '.join(topic['key'] for topic in topics)}, {len(shared)} shared extra "
+                 f"terms, classifier: {classifier or 'none'}")
+    return AnyPrefilter(prefilters)
+
+
+class TopicSinks:
+    # Output sink for multi-topic analyses ({topic key: section}): each section goes to its
+    # topic's own sink, so every topic keeps the usual output layout. A row counts as saved
+    # when any topic saved something.
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, subreddit, row_id, analysis):
+        saved = False
+        for key, sink in self.sinks.items():
+            saved = sink.write(subreddit, row_id, analysis.get(key) or {}) or saved
+        return saved
+
+    def flush(self):
+        for sink in self.sinks.values():
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks.values():
+            sink.close()
+
+
+def topic_locations(kind, topics, output_dir):
+    # {topic key: store location}; each topic's store sits in <output_dir>/<topic key>/,
+    # laid out as a single-topic run would write it
+    return {topic['key']: default_store_path(kind, os.path.join(output_dir, topic['key'])) for topic in topics}
+
+
+def topic_sinks(kind, topics, output_dir):
+    sinks = {}
+    for key, location in topic_locations(kind, topics, output_dir).items():
+        sinks[key] = get_sink(kind, os.path.dirname(location), location)
+    logging.info(f"Writing {len(sinks)} topics to {output_dir}: {', '.join(sinks)}")
+    return TopicSinks(sinks)
+
+
+def read_topic_analyses(locations, subreddit, row_ids):
+    # {row id: {topic key: section}} for the wanted rows of one subreddit, read back from
+    # every topic's store; topics without records for a row get an empty section
+    wanted = {str(row_id) for row_id in row_ids}
+    records = {}
+    for key, location in locations.items():
+        if not os.path.exists(location):
+            continue
+        for record in read_records(location, subreddit):
+            if record['row_id'] in wanted:
+                records.setdefault(record['row_id'], {}).setdefault(key, []).append(record)
+    return {row_id: {key: records_to_analysis(by_topic.get(key, [])) for key in locations}
+            for row_id, by_topic in records.items()}
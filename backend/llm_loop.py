@@ -0,0 +1,44 @@
+import os
+import asyncio
+import threading
+
+from instrumentation import achat_completion
+
+
+class BackgroundLoop:
+    # One asyncio event loop on a daemon thread, shared by every request thread. LLM calls run
+    # on it through a single pooled async client, so a slow model call holds a coroutine and a
+    # pooled connection rather than its own client, and in-flight calls are capped in one place.
+    # The loop is created lazily per process (gunicorn forks workers after import).
+    def __init__(self, client_factory, max_concurrency=32):
+        self.client_factory = client_factory
+        self.max_concurrency = max_concurrency
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True, name="llm-loop")
+            self.thread.start()
+            self.client = None
+            self.semaphore = None
+            self.pid = os.getpid()
+
+    def submit(self, coro):
+        # concurrent.futures.Future for a coroutine run on the shared loop
+        self._start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+    async def chat(self, component, operation, **kwargs):
+        # Must be awaited on the shared loop (via submit/run)
+        if self.client is None:
+            self.client = self.client_factory()
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            return await achat_completion(self.client, component, operation, **kwargs)
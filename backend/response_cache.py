@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    # Case- and whitespace-insensitive form of a user input
+    return " ".join(str(text or "").lower().split())
+
+
+def template_hash(template):
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+
+class ResponseCache:
+    # Two-tier cache for JSON-serializable LLM results: an in-process LRU in front of a
+    # SQLite table. Entries expire after ttl seconds; each tier is capped by entry count.
+    def __init__(self, path, max_memory_entries=1024, max_disk_entries=100000, ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "shared": 0, "evictions": 0}
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self.db.commit()
+
+    @staticmethod
+    def make_key(namespace, normalized_input, template, deployment):
+        raw = json.dumps([namespace, normalized_input, template_hash(template), deployment])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created < self.ttl:
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return True, value
+                del self.memory[key]
+
+            row = self.db.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                if now - row[1] < self.ttl:
+                    self.db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+                    self.db.commit()
+                    value = json.loads(row[0])
+                    self._remember(key, row[1], value)
+                    self.counters["disk_hits"] += 1
+                    return True, value
+                self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.db.commit()
+
+            self.counters["misses"] += 1
+            return False, None
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self._remember(key, now, value)
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+            self._evict_disk(now)
+            self.db.commit()
+
+    def get_or_compute(self, key, compute, should_cache=None):
+        # Single-flight: concurrent callers with the same key wait for one computation.
+        # should_cache(value) can veto storing a result (e.g. partial answers).
+        found, value = self.get(key)
+        if found:
+            return value
+
+        with self.lock:
+            event = self.in_flight.get(key)
+            leader = event is None
+            if leader:
+                event = self.in_flight[key] = threading.Event()
+
+        if not leader:
+            event.wait()
+            found, value = self.get(key)
+            if found:
+                with self.lock:
+                    self.counters["shared"] += 1
+                return value
+            # The leader failed or vetoed caching; compute independently
+            return compute()
+
+        try:
+            value = compute()
+            if should_cache is None or should_cache(value):
+                self.set(key, value)
+            return value
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self.memory)
+            stats["disk_entries"] = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def _remember(self, key, created, value):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _evict_disk(self, now):
+        self.db.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+        count = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_disk_entries:
+            overflow = count - self.max_disk_entries
+            self.db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)", (overflow,)
+            )
+            self.counters["evictions"] += overflow
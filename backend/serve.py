@@ -0,0 +1,66 @@
+import os
+import sys
+import glob
+
+# Production entry point: `python serve.py` from backend/. gunicorn with threaded workers on
+# POSIX, waitress elsewhere. Each worker imports server.py itself, so the LLM event loop,
+# the response cache connection and the subreddit index are per process.
+#
+# SERVER_WORKERS   worker processes (gunicorn only). With several, each worker publishes its
+#                  metrics to METRICS_MULTIPROC_DIR and /metrics merges them, so one scrape
+#                  target covers every worker.
+# SERVER_THREADS   request threads per worker; a streaming search holds one for its duration
+# SERVER_TIMEOUT   seconds before gunicorn restarts a silent worker
+SERVER_BACKEND = os.getenv("SERVER_BACKEND", "waitress" if sys.platform == "win32" else "gunicorn")
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "5050"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", str(min(4, os.cpu_count() or 1))))
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "16"))
+SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", "300"))
+
+
+def run_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    if SERVER_WORKERS > 1:
+        # Directory for the workers' metric snapshots, emptied of the previous run's; set
+        # before the workers start so each one imports instrumentation with it
+        directory = os.path.abspath(os.getenv("METRICS_MULTIPROC_DIR") or os.path.join("metrics", "multiproc"))
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            os.remove(path)
+        os.environ["METRICS_MULTIPROC_DIR"] = directory
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{SERVER_HOST}:{SERVER_PORT}")
+            self.cfg.set("workers", SERVER_WORKERS)
+            self.cfg.set("threads", SERVER_THREADS)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("timeout", SERVER_TIMEOUT)
+            self.cfg.set("accesslog", "-")
+
+        def load(self):
+            from server import app
+            return app
+
+    Application().run()
+
+
+def run_waitress():
+    from waitress import serve
+    from server import app
+
+    # waitress is a single process; scale with threads instead
+    serve(app, host=SERVER_HOST, port=SERVER_PORT, threads=SERVER_THREADS * SERVER_WORKERS,
+          channel_timeout=SERVER_TIMEOUT)
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # server.py loads paths relative to backend/
+    if SERVER_BACKEND == "gunicorn":
+        run_gunicorn()
+    elif SERVER_BACKEND == "waitress":
+        run_waitress()
+    else:
+        raise SystemExit(f"Unknown SERVER_BACKEND {SERVER_BACKEND!r} (gunicorn or waitress)")
@@ -1,9 +1,24 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, Response, g, stream_with_context
 import openai
 import os  # For accessing environment variables
 from dotenv import load_dotenv
 import pandas as pd
 import json
+import sys
+import time
+import queue
+import asyncio
+
+# Shared pipeline helpers live alongside the data scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+from subreddit_index import load_index
+from response_cache import ResponseCache, normalize_text
+from instrumentation import METRICS, METRICS_MULTIPROC_DIR, collect, start_publisher
+from llm_loop import BackgroundLoop
+from jobs import JobStore, WorkerPool, SUCCEEDED, PENDING
+from theme_store import ThemeStore
+from quote_index import QuoteIndex
+from output_store import CATEGORIES
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,6 +40,14 @@ openai.api_type = "azure"  # Specify the API type as Azure
 openai.api_version = azure_api_version  # Set the API version
 openai.deployment_name = deployment_name  # Set the deployment name
 
+# Every LLM call goes through one async client on a shared event loop; LLM_MAX_CONCURRENCY
+# caps in-flight calls per server process
+llm = BackgroundLoop(
+    lambda: openai.AsyncAzureOpenAI(azure_endpoint=azure_endpoint, api_key=azure_api_key,
+                                    api_version=azure_api_version),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+)
+
 template_dir = os.path.abspath('../frontend/build')
 static_dir = os.path.abspath('../frontend/static')
 
@@ -36,6 +59,10 @@ app = Flask(
     static_folder=static_dir, 
     template_folder=template_dir)
 
+# Under several serve.py workers, publish this worker's metrics for /metrics to merge
+if METRICS_MULTIPROC_DIR:
+    start_publisher()
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -45,6 +72,19 @@ def subreddit(subreddit):
     # You could fetch subreddit data here and return it as JSON
     return jsonify({'message': f'You selected subreddit {subreddit}'})
 
+# Cached LLM responses, keyed on normalized input, prompt template and deployment
+response_cache = ResponseCache(
+    os.getenv("RESPONSE_CACHE_PATH", "cache/responses.sqlite3"),
+    max_memory_entries=int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "1024")),
+    max_disk_entries=int(os.getenv("RESPONSE_CACHE_DISK_ENTRIES", "100000")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+)
+
+def related_subreddits_key(topic):
+    template = json.dumps([SUBREDDIT_SEARCH_MODE, SUBREDDIT_TOP_K, SUBREDDIT_RERANK, SUBREDDIT_CHUNK_SIZE,
+                           SUBREDDIT_CHUNK_PROMPT, SUBREDDIT_RERANK_PROMPT])
+    return ResponseCache.make_key("related_subreddits", normalize_text(topic), template, deployment_name)
+
 @app.route('/get_related_subreddits', methods=['POST'])
 def get_related_subreddits():
     data = request.json
@@ -52,43 +92,64 @@ def get_related_subreddits():
     print(topic)
 
     # Call your function to get relevant subreddits based on the topic
-    related_subreddits = get_relevant_subreddits(topic)
+    try:
+        related_subreddits, _ = response_cache.get_or_compute(
+            related_subreddits_key(topic), lambda: search_subreddits(topic), should_cache=lambda result: result[1])
+    except Exception as e:
+        print(f"Error fetching related subreddits: {e}")
+        return jsonify({"error": "Failed to retrieve related subreddits."}), 500
 
     return jsonify({'related_subreddits': related_subreddits})
 
-@app.route('/get_themes/<subreddit>', methods=['GET'])
-def get_themes(subreddit):
-    print(f"Requested subreddit: {subreddit}")  # Log the received subreddit
-    # Create a prompt for the OpenAI API
-    prompt = f"Generate a list of 6 themes that policymakers and policy researchers would be interested in learning more about, related to the subreddit '{subreddit}', each with a title ('title') and a very brief description ('description'). Return the themes in JSON format."
+@app.route('/stream_related_subreddits', methods=['POST'])
+def stream_related_subreddits():
+    # NDJSON stream of search events (see stream_subreddits) so the page can show subreddits
+    # as each chunk resolves; complete results are cached like /get_related_subreddits
+    topic = (request.json or {}).get('topic')
+    key = related_subreddits_key(topic)
+    found, cached = response_cache.get(key)
 
-    # Call the OpenAI API to get themes
-    try:
-        response = openai.chat.completions.create(
-            model=deployment_name,  # Specify your model
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        print(response)
-        
+    def events():
+        if found:
+            yield json.dumps({"subreddits": cached[0], "replace": True}) + "\n"
+            yield json.dumps({"done": True, "complete": True, "subreddits": cached[0]}) + "\n"
+            return
+        try:
+            for event in stream_subreddits(topic):
+                if event.get("done") and event["complete"]:
+                    response_cache.set(key, [event["subreddits"], True])
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            print(f"Error streaming subreddits: {e}")
+            yield json.dumps({"error": "Failed to retrieve related subreddits."}) + "\n"
+
+    return Response(stream_with_context(events()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+THEMES_PROMPT = "Generate a list of 6 themes that policymakers and policy researchers would be interested in learning more about, related to the subreddit '{subreddit}', each with a title ('title') and a very brief description ('description'). Return the themes in JSON format."
 
-        # Extract the content from the response
-        themes_json = response.choices[0].message.content.strip()
-        print("THEMES THEMES THEMES")
-        print(themes_json)
+# Evidence-backed themes materialized offline by `python data/theme_store.py`; the live LLM
+# call below only covers subreddits the store does not have yet
+theme_store = ThemeStore(os.getenv("THEME_STORE_PATH", "themes/themes.sqlite3"))
+MAX_QUOTES_PER_PAGE = 100
 
-        # Extract only the JSON part by removing the Markdown formatting
-        # Assuming the JSON is wrapped in ```json ... ```
-        json_start = themes_json.find("[")  # Find the start of the JSON array
-        json_end = themes_json.rfind("]") + 1  # Find the end of the JSON array
-        clean_json_string = themes_json[json_start:json_end]
+def page_args(default_per_page):
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', default_per_page, type=int)
+    return max(page, 1), min(max(per_page, 1), MAX_QUOTES_PER_PAGE)
 
-        # Print the cleaned JSON string for debugging
-        print("Cleaned JSON String:", clean_json_string)
+@app.route('/get_themes/<subreddit>', methods=['GET'])
+def get_themes(subreddit):
+    print(f"Requested subreddit: {subreddit}")  # Log the received subreddit
+    _, per_page = page_args(5)
+    materialized = theme_store.themes(subreddit, per_page)
+    if materialized is not None:
+        return jsonify(materialized)
+
+    key = ResponseCache.make_key("themes", normalize_text(subreddit).removeprefix("r/"), THEMES_PROMPT, deployment_name)
 
-        # Parse the cleaned JSON string to a Python dictionary
-        themes_data = json.loads(clean_json_string)
+    try:
+        themes_data = response_cache.get_or_compute(key, lambda: generate_themes(subreddit))
 
         # Return the JSON response
         return jsonify(themes_data)
@@ -96,37 +157,289 @@ def get_themes(subreddit):
     except Exception as e:
         print(f"Error fetching themes: {e}")
         return jsonify({"error": "Failed to retrieve themes."}), 500
+
+@app.route('/get_themes/<subreddit>/<int:theme>/quotes', methods=['GET'])
+def get_theme_quotes(subreddit, theme):
+    # ?page=&per_page= over a materialized theme's supporting quotes
+    page, per_page = page_args(10)
+    quotes = theme_store.quotes(subreddit, theme, page, per_page)
+    if quotes is None:
+        return jsonify({"error": "No materialized theme for this subreddit."}), 404
+    return jsonify(quotes)
+
+# Full-text search over every extracted quote (quote_index.py), with facets from the theme
+# store above; generation.py keeps the index current when QUOTE_INDEX_PATH is set
+quote_index = QuoteIndex(os.getenv("QUOTE_INDEX_PATH", "search/quotes.sqlite3"),
+                         os.getenv("QUOTE_INDEX_INGEST_STATE"), theme_store.path)
+
+@app.route('/search_quotes', methods=['GET'])
+def search_quotes():
+    # ?q=&subreddit=&category=&theme=&since=&until=&cursor=&limit=&facets=1; since/until are
+    # unix timestamps. Results are BM25-ranked; pass next_cursor back for the next page.
+    args = request.args
+    category = args.get('category') or None
+    if category is not None and category not in CATEGORIES:
+        return jsonify({"error": f"category must be one of {', '.join(CATEGORIES)}."}), 400
+    try:
+        page = quote_index.search(
+            args.get('q', ''), subreddit=args.get('subreddit') or None, category=category,
+            theme=args.get('theme') or None, since=args.get('since', type=float), until=args.get('until', type=float),
+            cursor=args.get('cursor') or None, limit=args.get('limit', 20, type=int),
+            facets=args.get('facets', 'false').lower() in ('true', '1', 'yes', 'on')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(page)
+
+# Theme reports (subtopics.build_theme_report) take minutes, so they run as background jobs in
+# local worker processes; JOB_WORKERS=0 leaves them to a separate `python data/jobs.py`
+REPORT_INPUT = os.getenv("THEME_INPUT") or os.getenv("OUTPUT_DIRECTORY")
+job_store = JobStore(os.getenv("JOB_DB_PATH", "jobs/jobs.sqlite3"),
+                     stale_after=float(os.getenv("JOB_STALE_AFTER", "300")))
+job_workers = WorkerPool(job_store.path, workers=int(os.getenv("JOB_WORKERS", "2")),
+                         stale_after=job_store.stale_after)
+
+@app.route('/reports', methods=['POST'])
+def submit_report():
+    data = request.json or {}
+    subreddit = data.get('subreddit')
+    if REPORT_INPUT is None:
+        return jsonify({"error": "Reports are not configured (set THEME_INPUT)."}), 503
+    params = {"input": REPORT_INPUT, "subreddit": normalize_text(subreddit).removeprefix("r/") or None}
+    job_id, created = job_store.submit('theme_report', params)
+    if job_workers.workers:
+        job_workers.ensure_started()
+    return jsonify({"job_id": job_id, "created": created, "status": job_store.get(job_id)['status']}), 202
+
+@app.route('/reports/<job_id>', methods=['GET'])
+def report_status(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown report."}), 404
+    job.pop('params')
+    return jsonify(job)
+
+@app.route('/reports/<job_id>/result', methods=['GET'])
+def report_result(job_id):
+    job = job_store.get(job_id, with_result=True)
+    if job is None:
+        return jsonify({"error": "Unknown report."}), 404
+    if job['status'] in PENDING:
+        return jsonify({"status": job['status'], "progress": job['progress']}), 202
+    if job['status'] != SUCCEEDED:
+        return jsonify({"status": job['status'], "error": job['error']}), 409
+    if job['result'] is None:
+        return jsonify({"status": job['status'], "error": "No summaries found."}), 404
+    return jsonify(job['result'])
+
+@app.route('/reports/<job_id>', methods=['DELETE'])
+def cancel_report(job_id):
+    status = job_store.cancel(job_id)
+    if status is None:
+        return jsonify({"error": "Unknown report."}), 404
+    return jsonify({"job_id": job_id, "status": status})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.before_request
+def start_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def record_request(response):
+    # Per-route request counts and latency; the route template keeps label cardinality bounded
+    if request.url_rule is not None and hasattr(g, 'request_started'):
+        labels = {'route': request.url_rule.rule, 'method': request.method}
+        METRICS.inc('http_requests_total', dict(labels, status=response.status_code))
+        METRICS.observe('http_request_seconds', labels, time.monotonic() - g.request_started)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus scrape endpoint: LLM call and HTTP metrics plus response cache gauges
+    for name, value in response_cache.stats().items():
+        METRICS.set_gauge(f'response_cache_{name}', {}, value)
+    for status, count in job_store.counts().items():
+        METRICS.set_gauge('jobs', {'status': status}, count)
+    source = collect() if METRICS_MULTIPROC_DIR else METRICS
+    return Response(source.render(), mimetype='text/plain; version=0.0.4')
+
+def generate_themes(subreddit):
+    # Create a prompt for the OpenAI API
+    prompt = THEMES_PROMPT.format(subreddit=subreddit)
+
+    # Call the OpenAI API to get themes
+    response = llm.run(llm.chat(
+        'server', 'themes',
+        model=deployment_name,  # Specify your model
+        messages=[
+            {"role": "user", "content": prompt}
+        ]
+    ))
+
+    # Extract the content from the response
+    themes_json = response.choices[0].message.content.strip()
+
+    # Extract only the JSON part by removing the Markdown formatting
+    # Assuming the JSON is wrapped in ```json ... ```
+    json_start = themes_json.find("[")  # Find the start of the JSON array
+    json_end = themes_json.rfind("]") + 1  # Find the end of the JSON array
+    clean_json_string = themes_json[json_start:json_end]
+
+    # Parse the cleaned JSON string to a Python dictionary
+    return json.loads(clean_json_string)
     
 # Load the CSV file with subreddits
 subreddits = pd.read_csv("data/subreddits.csv")['name'].tolist()
 
+# Subreddit search settings: 'index' uses the local embedding index, 'llm' scans every chunk
+SUBREDDIT_SEARCH_MODE = os.getenv("SUBREDDIT_SEARCH_MODE", "index")
+SUBREDDIT_TOP_K = int(os.getenv("SUBREDDIT_TOP_K", "20"))
+SUBREDDIT_RERANK = os.getenv("SUBREDDIT_RERANK", "true").lower() in ('true', '1', 'yes', 'on')
+SUBREDDIT_INDEX_DIR = os.getenv("SUBREDDIT_INDEX_DIR", "data/subreddit_index")
+
+# Built (or loaded from disk) once at startup and memory-mapped
+subreddit_index = load_index("data/subreddits.csv", SUBREDDIT_INDEX_DIR) if SUBREDDIT_SEARCH_MODE == "index" else None
+
+SUBREDDIT_CHUNK_PROMPT = "Here is a list of subreddits: {subreddits}. Based on the topic '{topic}', please provide a list of the most relevant subreddits from the list. If there are multiple relevant subreddits, separate their names with commas. If none are relevant, respond with a blank line."
+SUBREDDIT_RERANK_PROMPT = "Here is a list of subreddits: {subreddits}. Based on the topic '{topic}', please provide a list of the most relevant subreddits from the list, most relevant first. If there are multiple relevant subreddits, separate their names with commas. If none are relevant, respond with a blank line."
+
 def get_relevant_subreddits(topic):
-    # Process subreddits in chunks
-    relevant_subreddits = []
-    chunk_size = 200
-    print(len(subreddits))
-
-    for i in range(0, len(subreddits), chunk_size):
-        subreddits_chunk = subreddits[i:i + chunk_size]
-        prompt = f"Here is a list of subreddits: {subreddits_chunk}. Based on the topic '{topic}', please provide a list of the most relevant subreddits from the list. If there are multiple relevant subreddits, separate their names with commas. If none are relevant, respond with a blank line."
-        # prompt = "how is the weather?"
-        # Call the OpenAI API
-        response = openai.chat.completions.create(
-            model=deployment_name,
-            messages=[{"role": "user", "content": prompt}]
-        )
+    return search_subreddits(topic)[0]
+
+def search_subreddits(topic):
+    # Returns (subreddit names, complete); complete is False when part of the search failed
+    for event in stream_subreddits(topic):
+        if event.get("done"):
+            return event["subreddits"], event["complete"]
+
+def stream_subreddits(topic):
+    # Yields {"subreddits": [...]} as results arrive ("replace": true when the list supersedes
+    # everything sent so far), then {"done": true, "complete": bool, "subreddits": final list}
+    if subreddit_index is None:
+        yield from stream_subreddit_chunks(topic)
+        return
+
+    candidates = [name for name, _ in subreddit_index.search(topic, SUBREDDIT_TOP_K)]
+    if not (SUBREDDIT_RERANK and candidates):
+        yield {"subreddits": candidates, "replace": True}
+        yield {"done": True, "complete": True, "subreddits": candidates}
+        return
+
+    # Nearest neighbours first, then the reranked list once the LLM answers
+    yield {"subreddits": candidates, "replace": True, "stage": "candidates"}
+    try:
+        ranked = rerank_subreddits(topic, candidates)
+    except Exception as e:
+        print(f"Error reranking subreddits: {e}")
+        yield {"done": True, "complete": False, "subreddits": candidates}
+        return
+    yield {"subreddits": ranked, "replace": True}
+    yield {"done": True, "complete": True, "subreddits": ranked}
+
+def rerank_subreddits(topic, candidates):
+    # A single LLM call over the nearest neighbours only
+    prompt = SUBREDDIT_RERANK_PROMPT.format(subreddits=candidates, topic=topic)
+    response = llm.run(llm.chat(
+        'server', 'subreddit_rerank',
+        model=deployment_name,
+        messages=[{"role": "user", "content": prompt}]
+    ))
+
+    content = response.choices[0].message.content if response.choices else None
+    return normalize_subreddit_names([content or ""], candidates)
+
+def normalize_subreddit_names(responses, allowed):
+    # Split comma-separated LLM answers, strip whitespace/quotes and map back onto catalog
+    # spelling (case-insensitive, with or without the r/ prefix), dropping duplicates
+    catalog = {name.lower().removeprefix("r/"): name for name in allowed}
+    seen = set()
+    names = []
+    for content in responses:
+        for raw in content.split(","):
+            key = raw.strip().strip("'\"[]`.").strip().lower().removeprefix("r/")
+            name = catalog.get(key)
+            if name and name not in seen:
+                seen.add(name)
+                names.append(name)
+    return names
+
+# Chunked LLM scan settings
+SUBREDDIT_CHUNK_SIZE = int(os.getenv("SUBREDDIT_CHUNK_SIZE", "200"))
+SUBREDDIT_CHUNK_CONCURRENCY = int(os.getenv("SUBREDDIT_CHUNK_CONCURRENCY", "8"))
+SUBREDDIT_CHUNK_TIMEOUT = float(os.getenv("SUBREDDIT_CHUNK_TIMEOUT", "30"))
+
+async def classify_subreddit_chunk(topic, subreddits_chunk):
+    prompt = SUBREDDIT_CHUNK_PROMPT.format(subreddits=subreddits_chunk, topic=topic)
+    response = await llm.chat(
+        'server', 'subreddit_chunk',
+        model=deployment_name,
+        messages=[{"role": "user", "content": prompt}],
+        timeout=SUBREDDIT_CHUNK_TIMEOUT
+    )
+
+    # Retrieve response content if it exists
+    if response.choices and response.choices[0].message.content:
+        return response.choices[0].message.content
+    return ""
+
+def get_relevant_subreddits_llm(topic):
+    return scan_subreddit_chunks(topic)[0]
+
+def scan_subreddit_chunks(topic):
+    for event in stream_subreddit_chunks(topic):
+        if event.get("done"):
+            return event["subreddits"], event["complete"]
+
+async def classify_chunks(topic, chunks, results):
+    # Runs on the shared loop; puts (chunk index, content or exception) on the thread-safe
+    # results queue as each chunk resolves
+    semaphore = asyncio.Semaphore(SUBREDDIT_CHUNK_CONCURRENCY)
+
+    async def classify(i, chunk):
+        async with semaphore:
+            try:
+                results.put((i, await classify_subreddit_chunk(topic, chunk)))
+            except Exception as e:
+                results.put((i, e))
+
+    await asyncio.gather(*(classify(i, chunk) for i, chunk in enumerate(chunks)))
+
+def stream_subreddit_chunks(topic):
+    # Fan the chunks out concurrently (capped by SUBREDDIT_CHUNK_CONCURRENCY) so a search
+    # costs roughly the slowest chunk; each chunk's new matches are yielded as it resolves and
+    # failed or timed-out chunks are skipped
+    chunks = [subreddits[i:i + SUBREDDIT_CHUNK_SIZE] for i in range(0, len(subreddits), SUBREDDIT_CHUNK_SIZE)]
+    results = queue.Queue()
+    future = llm.submit(classify_chunks(topic, chunks, results))
+    # Leave room for chunks that queue behind the concurrency cap
+    waves = -(-len(chunks) // SUBREDDIT_CHUNK_CONCURRENCY)
+    deadline = time.monotonic() + SUBREDDIT_CHUNK_TIMEOUT * max(waves, 1)
 
-        print(response)
-        
-        # Retrieve and print response content if it exists
-        if response.choices and response.choices[0].message.content:
-            responses = response.choices[0].message.content.split(",")
-            print(response.choices[0].message.content)
-            for r in responses:
-                relevant_subreddits.append(r)
-        
+    names, answered, pending = [], 0, set(range(len(chunks)))
+    while pending:
+        try:
+            i, content = results.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            future.cancel()
+            for i in sorted(pending):
+                print(f"Subreddit chunk {i} timed out")
+            break
+        pending.discard(i)
+        if isinstance(content, Exception):
+            print(f"Subreddit chunk {i} failed: {content}")
+            continue
+        answered += 1
+        new = [name for name in normalize_subreddit_names([content], subreddits) if name not in names]
+        names += new
+        if new:
+            yield {"subreddits": new}
 
-    return relevant_subreddits
+    if chunks and not answered:
+        raise RuntimeError("All subreddit chunks failed")
+    yield {"done": True, "complete": answered == len(chunks), "subreddits": names}
 
 
 # def main():
@@ -134,6 +447,7 @@ def get_relevant_subreddits(topic):
 #     for s in relevant_subreddits:
 #         print(s)
 
-# Run the main function
+# Development server only; use serve.py in production
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5050, debug=True)
+    app.run(host='0.0.0.0', port=5050, threaded=True,
+            debug=os.getenv("FLASK_DEBUG", "false").lower() in ('true', '1', 'yes', 'on'))
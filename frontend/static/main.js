@@ -67,79 +67,106 @@ searchForm.addEventListener('submit', async function (event){
     // Clear out any existing buttons
     subredditButtonsDiv.innerHTML = '';
 
-    // Create some buttons based on the query (this is a placeholder logic)
+    // Stream subreddits from the server: one JSON event per line, buttons are added as each
+    // chunk of the search resolves
     try {
-        const response = await fetch('/get_related_subreddits', {
+        const response = await fetch('/stream_related_subreddits', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({ topic: query })
         });
-        
-        // Parse the JSON response from the server
-        const data = await response.json();
-        const relatedSubreddits = data.related_subreddits;
-        console.log('Related Subreddits:', relatedSubreddits);
-
-    // Dynamically create subreddit buttons
-        relatedSubreddits.forEach(subreddit => {
-            const button = document.createElement('button');
-            button.textContent = subreddit;
-            button.classList.add('subreddit-button');
-
-            // Add click event listener for each button
-            button.addEventListener('click', async function () {
-                console.log("Button clicked for subreddit:", subreddit);
-                // Show the theme section
-                themeSection.classList.remove('hidden');
-
-                // Fetch themes based on the selected subreddit
-                try {
-                    const cleanedSubreddit = subreddit.trim().replace(/^r\//, ''); // Clean subreddit name
-                    // alert("Fetching themes from: " + `/get_themes/${subreddit}`); // Log the URL
-                    // alert("Fetching themes from: " + `/get_themes/${cleanedSubreddit}`); // Log the URL
-
-                    // Fetch themes based on the selected subreddit
-                    const themeResponse = await fetch(`/get_themes/${cleanedSubreddit}`, {
-                        method: 'GET',  // Method is GET for this request
-                        headers: {
-                            'Content-Type': 'application/json' // Optional for GET, but can be included
-                        }
-                    });  
-
-                    alert(themeResponse)
-
-                    if (!themeResponse.ok) {
-                        throw new Error('Failed to retrieve themes');
-                    }
-                    const themeData = await themeResponse.json();
-
-                    // Generate theme boxes with the fetched theme data
-                    generateThemes(themeData);
-
-                    // Move the theme search bar below the themes after themes are displayed
-                    themesContainer.after(searchBar);
-                    searchBar.classList.remove('hidden'); // Ensure search bar is visible
-                } catch (error) {
-                    console.error('Error fetching themes:', error);
-                    alert('Failed to retrieve themes. Please tryy again.');
-                }
-            });
-
-            subredditButtonsDiv.appendChild(button);
-            console.log('Button created for subreddit:', subreddit);
-
-        });
-
-        // Show the subreddit buttons container
-        subredditButtonsContainer.classList.remove('hidden');
+        if (!response.ok) {
+            throw new Error('Failed to retrieve related subreddits');
+        }
+
+        // Show the subreddit buttons container as soon as the first results arrive
+        const handleEvent = event => {
+            if (event.error) {
+                throw new Error(event.error);
+            }
+            if (event.done) {
+                console.log('Related Subreddits:', event.subreddits, 'complete:', event.complete);
+                return;
+            }
+            if (event.replace) {
+                subredditButtonsDiv.innerHTML = '';
+            }
+            event.subreddits.forEach(addSubredditButton);
+            subredditButtonsContainer.classList.remove('hidden');
+        };
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffered += decoder.decode(value, { stream: true });
+            const lines = buffered.split('\n');
+            buffered = lines.pop();
+            lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+        }
+        if (buffered.trim()) {
+            handleEvent(JSON.parse(buffered));
+        }
     } catch (error) {
         console.error('Error fetching related subreddits:', error);
         alert('Failed to retrieve related subreddits. Please try again.')
     }
 });
 
+function addSubredditButton(subreddit) {
+    const button = document.createElement('button');
+    button.textContent = subreddit;
+    button.classList.add('subreddit-button');
+
+    // Add click event listener for each button
+    button.addEventListener('click', async function () {
+        console.log("Button clicked for subreddit:", subreddit);
+        // Show the theme section
+        themeSection.classList.remove('hidden');
+
+        // Fetch themes based on the selected subreddit
+        try {
+            const cleanedSubreddit = subreddit.trim().replace(/^r\//, ''); // Clean subreddit name
+            // alert("Fetching themes from: " + `/get_themes/${subreddit}`); // Log the URL
+            // alert("Fetching themes from: " + `/get_themes/${cleanedSubreddit}`); // Log the URL
+
+            // Fetch themes based on the selected subreddit
+            const themeResponse = await fetch(`/get_themes/${cleanedSubreddit}`, {
+                method: 'GET',  // Method is GET for this request
+                headers: {
+                    'Content-Type': 'application/json' // Optional for GET, but can be included
+                }
+            });  
+
+            alert(themeResponse)
+
+            if (!themeResponse.ok) {
+                throw new Error('Failed to retrieve themes');
+            }
+            const themeData = await themeResponse.json();
+
+            // Generate theme boxes with the fetched theme data
+            generateThemes(themeData);
+
+            // Move the theme search bar below the themes after themes are displayed
+            themesContainer.after(searchBar);
+            searchBar.classList.remove('hidden'); // Ensure search bar is visible
+        } catch (error) {
+            console.error('Error fetching themes:', error);
+            alert('Failed to retrieve themes. Please tryy again.');
+        }
+    });
+
+    subredditButtonsDiv.appendChild(button);
+    console.log('Button created for subreddit:', subreddit);
+}
+
 function generateThemes(themeData) {
     themesContainer.innerHTML = ''; // Clear previous themes
 